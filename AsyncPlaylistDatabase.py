@@ -0,0 +1,794 @@
+#!/usr/bin/env python3
+
+#
+# An asyncio version of PlaylistDatabase, on aiomysql.
+#
+# PlaylistDatabase runs every call under one lock on one cursor, so a
+# process only ever has one query in flight. Here every call borrows its
+# own connection from an aiomysql pool, so many station updates and web
+# requests can wait on the database at the same time.
+#
+# The public functions are the same ones, awaited:
+#
+#   db = AsyncPlaylistDatabase(config_file='PlaylistDatabaseConfig.ini')
+#   await db.connect()
+#   for channel_dict in await db.get_station_data():
+#       url = await db.look_up_song_youtube(artist,album,title)
+#       await db.add_track_to_station_playlist(name,artist,album,title,date,url)
+#   await db.close()
+#
+# It runs the same statements and builds rows and return values the same
+# way as PlaylistDatabase (the module level _* helpers there), so changes
+# to those show up here too. When adding a function to both, put its SQL
+# in a helper there rather than writing it out twice.
+#
+# The maintenance functions (rebuild_track_stats, check_track_stats,
+# rebuild_daily_plays) are left out, they're run from the command line
+# by track_stats.py and daily_plays.py.
+#
+# Needs aiomysql (pip3 install aiomysql) and only talks to MySQL. It
+# doesn't create or migrate the schema, PlaylistDatabase or migrations.py
+# do that. There are no read replicas here either, everything goes to
+# the primary, so read_your_writes and primary_reads do nothing.
+#
+
+import datetime
+
+from time import monotonic
+from configparser import ConfigParser
+from contextlib import asynccontextmanager, contextmanager
+
+import migrations
+from cache import LRUCache
+from backends import (FULLTEXT_CHECK, FULLTEXT_INDEXES, FULLTEXT_RECHECK_INTERVAL, PLAYLIST_FOREIGN_KEY_CHECK,
+                      mysql_search_query)
+from youtube_links import get_video_id, make_short_link
+from ignore_rules import check_rule, EXACT
+from PlaylistDatabase import (PlaylistDatabase, MissingReference, _chunks, _placeholders, _song_key, _track_dict,
+                              _station_dicts, _stations_with_latest_query,
+                              _STATION_ID_SELECT, _ARTIST_INSERT, _ARTIST_ID_SELECT, _ALBUM_INSERT,
+                              _ALBUM_ID_SELECT, _TRACK_UPSERT, _TRACK_ID_SELECT, _PLAYLIST_INSERT,
+                              _SONG_LINK_SELECT, _track_row, _ignore_rule_fingerprints_query,
+                              _ignore_rules_query, _cached_ignore_rules, _compile_ignore_rules,
+                              _track_stats_rows, _track_stats_refresh, _TRACK_STATS_UPSERT,
+                              _TRACK_STATION_STATS_UPSERT, _day, _daily_plays_rows, _daily_plays_refresh,
+                              _DAILY_STATION_UPSERT, _DAILY_TRACK_UPSERT, _DAILY_ARTIST_UPSERT,
+                              _STATIONS_SELECT, _STATION_SELECT, _STATION_INSERT,
+                              _STATION_BY_PLAYLIST_SELECT, _IGNORE_RULE_INSERT, _IGNORE_RULE_DELETE,
+                              _station_row, _station_rule_rows, _playlist_station_dict,
+                              _station_ids_query, _artist_ids_query, _album_ids_query, _track_ids_query,
+                              _PLAYLIST_INSERT_IGNORE, _references_query, _playlist_batch_rows, _playlist_batch_tracks,
+                              _playlist_batch_entries, _latest_tracks_query, _station_history_query,
+                              _search_fields, _TRACKS_BY_VIDEO_SELECT, _VIDEO_IDS_SELECT,
+                              _TRACK_LINK_UPDATE, _track_link_row, _PENDING_REBUILD_SELECT,
+                              REBUILD_CHECK_INTERVAL,
+                              _track_stats_queries, _collect_track_stats, _daily_source,
+                              _top_tracks_query, _top_artists_query, _trend_period, _trend_query,
+                              _trend_counts, _db_time, _SEARCH_RESULT_SELECT, _search_result_ids,
+                              _SEARCH_HITS_UPDATE, _search_hit_rows, _SEARCH_RESULT_UPSERT,
+                              _SEARCH_EXPIRED_DELETE, _SEARCH_LRU_CUTOFF_SELECT, _SEARCH_LRU_DELETE,
+                              _cache_metrics)
+
+# MySQL's "foreign key points at a row that doesn't exist"
+ER_NO_REFERENCED_ROW_2 = 1452
+
+class AsyncPlaylistDatabase():
+    '''
+    PlaylistDatabase for asyncio code. Every public function is a
+    coroutine and runs on its own pooled connection, in its own
+    transaction. The commit kwargs are only there so calls look the same
+    as PlaylistDatabase's; everything is committed when the call returns.
+    '''
+
+    def __init__(self,user='root',password='password',host='127.0.0.1',config_file=None,database='PlaylistDB',
+                 id_cache_size=10000,pool_size=10,pool_max_lifetime=3600,
+                 song_cache_size=10000,song_cache_ttl=600,song_cache_miss_ttl=60):
+
+        self._user = user
+        self._password = password
+        self._host = host
+        self._database = database
+
+        if config_file is not None:
+            config = ConfigParser()
+            config.read(config_file)
+            self._user = config['database'].get('user',user)
+            self._password = config['database'].get('password',password)
+            self._host = config['database'].get('host',host)
+            self._database = config['database'].get('database',database)
+            id_cache_size = config['database'].getint('id_cache_size',id_cache_size)
+            # pool_size is PlaylistDatabase's and 0 there means no pool
+            pool_size = config['database'].getint('async_pool_size',pool_size)
+            pool_max_lifetime = config['database'].getint('pool_max_lifetime',pool_max_lifetime)
+            song_cache_size = config['database'].getint('song_cache_size',song_cache_size)
+            song_cache_ttl = config['database'].getint('song_cache_ttl',song_cache_ttl)
+            song_cache_miss_ttl = config['database'].getint('song_cache_miss_ttl',song_cache_miss_ttl)
+
+        self._pool_size = pool_size
+        self._pool_max_lifetime = pool_max_lifetime
+        self._pool = None
+
+        # Shared by every coroutine. Same keys and values as PlaylistDatabase's.
+        self._id_cache = LRUCache(id_cache_size)
+        self._song_cache = LRUCache(song_cache_size,ttl=song_cache_ttl)
+        self._song_cache_miss_ttl = song_cache_miss_ttl
+        self._ignore_rules = {}
+        # Summary tables we've seen filled, and when the others were last
+        # seen pending, see _rebuild_pending
+        self._rebuilt = set()
+        self._pending_checked = {}
+        # Whether the FULLTEXT indexes are there and when that was
+        # checked, see _check_fulltext
+        self._fulltext = True
+        self._fulltext_checked = None
+        # Whether Playlist's foreign keys are there, see connect
+        self._playlist_foreign_keys = True
+
+    async def connect(self):
+        '''
+        Open the connection pool. Returns self so you can
+        db = await AsyncPlaylistDatabase(...).connect()
+        '''
+        try:
+            import aiomysql
+        except ImportError:
+            raise ImportError('AsyncPlaylistDatabase needs aiomysql: pip3 install aiomysql')
+
+        self._IntegrityError = aiomysql.IntegrityError
+        self._SSCursor = aiomysql.SSCursor
+        self._pool = await aiomysql.create_pool(user=self._user,password=self._password,host=self._host,
+                                                db=self._database,minsize=1,maxsize=self._pool_size,
+                                                pool_recycle=self._pool_max_lifetime,autocommit=False,
+                                                charset='utf8mb4')
+
+        async with self._cursor() as cur:
+            await cur.execute('''SELECT SchemaVersion.version FROM SchemaVersion''')
+            applied = set(row[0] for row in await cur.fetchall())
+            # The FULLTEXT migration is only run by hand, search with
+            # substring matches until it has been
+            await self._check_fulltext(cur,force=True)
+            await cur.execute(PLAYLIST_FOREIGN_KEY_CHECK)
+            self._playlist_foreign_keys = (await cur.fetchone())[0] > 0
+        missing = [str(m[0]) for m in migrations.MIGRATIONS
+                   if m[0] not in applied and m[0] not in migrations.MANUAL_MIGRATIONS]
+        if missing:
+            print('Warning: the database schema is missing migrations ' + ', '.join(missing) + '. Run migrations.py.')
+
+        return self
+
+    async def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            await self._pool.wait_closed()
+            self._pool = None
+
+    async def __aenter__(self):
+        if self._pool is None:
+            await self.connect()
+        return self
+
+    async def __aexit__(self,exc_type,exc_value,exc_traceback):
+        await self.close()
+
+    @asynccontextmanager
+    async def _cursor(self,cursor_class=None):
+        '''
+        A cursor on a pooled connection. Commits if the block finishes,
+        rolls back if it raises.
+        '''
+        async with self._pool.acquire() as conn:
+            if cursor_class is None:
+                cur = await conn.cursor()
+            else:
+                cur = await conn.cursor(cursor_class)
+            try:
+                yield cur
+                await conn.commit()
+            except:
+                await conn.rollback()
+                raise
+            finally:
+                await cur.close()
+
+    def _is_missing_reference(self,e):
+        return isinstance(e,MissingReference) or e.args[0] == ER_NO_REFERENCED_ROW_2
+
+    async def _check_references(self,cur,entries):
+        '''
+        See PlaylistDatabase._check_references
+        '''
+        if self._playlist_foreign_keys:
+            return
+        query,params,expected = _references_query(entries)
+        await cur.execute(query,params)
+        if tuple(await cur.fetchone()) != expected:
+            raise MissingReference('A cached station or track ID no longer exists')
+
+    #
+    # The same helpers as PlaylistDatabase, on the cursor they're given
+    #
+
+    async def _get_station_id_from_name(self,cur,name):
+        station_id = self._id_cache.get(('station',name))
+        if station_id is not None:
+            return station_id
+
+        await cur.execute(_STATION_ID_SELECT,(name,))
+        row = await cur.fetchone()
+        if row is None:
+            raise LookupError('Station: ' + str(name) + ' could not be found.')
+
+        self._id_cache.put(('station',name),row[0])
+        return row[0]
+
+    async def _make_artist(self,cur,name,commit=True):
+        artist_id = self._id_cache.get(('artist',name))
+        if artist_id is not None:
+            return artist_id
+
+        await cur.execute(_ARTIST_INSERT,(name,))
+        # Like PlaylistDatabase, so a later rollback can't take back
+        # a row we've cached the ID of
+        if commit:
+            await cur.connection.commit()
+        await cur.execute(_ARTIST_ID_SELECT,(name,))
+        artist_id = (await cur.fetchone())[0]
+        self._id_cache.put(('artist',name),artist_id)
+        return artist_id
+
+    async def _make_album(self,cur,artist_id,album,commit=True):
+        album_id = self._id_cache.get(('album',album,artist_id))
+        if album_id is not None:
+            return album_id
+
+        await cur.execute(_ALBUM_INSERT,(album,artist_id))
+        if commit:
+            await cur.connection.commit()
+        await cur.execute(_ALBUM_ID_SELECT,(album,artist_id))
+        album_id = (await cur.fetchone())[0]
+        self._id_cache.put(('album',album,artist_id),album_id)
+        return album_id
+
+    async def _make_track(self,cur,name,album_id,artist_id,yt_link='',fs_link='',commit=True):
+        cached = self._id_cache.get(('track',name,album_id,artist_id))
+        if cached is not None and cached[1:] == (yt_link,fs_link):
+            return cached[0]
+
+        await cur.execute(_TRACK_UPSERT,_track_row(name,album_id,artist_id,yt_link,fs_link))
+        if commit:
+            await cur.connection.commit()
+        await cur.execute(_TRACK_ID_SELECT,(name,album_id,artist_id))
+        track_id = (await cur.fetchone())[0]
+        self._id_cache.put(('track',name,album_id,artist_id),(track_id,yt_link,fs_link))
+        return track_id
+
+    async def _add_track(self,cur,station_name,artist,album,track,date,youtube_link):
+        station_id = await self._get_station_id_from_name(cur,station_name)
+        artist_id = await self._make_artist(cur,artist)
+        album_id = await self._make_album(cur,artist_id,album)
+        track_id = await self._make_track(cur,track,album_id,artist_id,youtube_link)
+
+        play_time = date.strftime('%Y-%m-%d %H:%M:%S.%f')
+        await self._check_references(cur,[(station_id,track_id,play_time)])
+        await cur.execute(_PLAYLIST_INSERT,(track_id,station_id,play_time))
+        playlist_id = cur.lastrowid
+        await self._add_track_stats(cur,[(station_id,track_id,play_time)])
+        await self._add_daily_plays(cur,[(station_id,track_id,play_time)],{track_id:artist_id})
+        return playlist_id
+
+    async def _add_track_stats(self,cur,entries):
+        '''
+        See PlaylistDatabase._add_track_stats
+        '''
+        tracks,stations = _track_stats_rows(entries)
+        await cur.executemany(_TRACK_STATS_UPSERT,tracks)
+        await cur.executemany(_TRACK_STATION_STATS_UPSERT,stations)
+
+    async def _add_daily_plays(self,cur,entries,artist_ids):
+        '''
+        See PlaylistDatabase._add_daily_plays
+        '''
+        for statement,rows in zip((_DAILY_STATION_UPSERT,_DAILY_TRACK_UPSERT,_DAILY_ARTIST_UPSERT),
+                                  _daily_plays_rows(entries,artist_ids)):
+            await cur.executemany(statement,rows)
+
+    async def _add_playlist_entries(self,cur,entries,artist_ids):
+        '''
+        See PlaylistDatabase._add_playlist_entries
+        '''
+        await cur.executemany(_PLAYLIST_INSERT_IGNORE,
+                              [(track_id,station_id,play_time) for station_id,track_id,play_time in entries])
+        added = cur.rowcount
+
+        if added == len(entries):
+            await self._add_track_stats(cur,entries)
+            await self._add_daily_plays(cur,entries,artist_ids)
+        else:
+            # The same thing refresh_track_stats and refresh_daily_plays run
+            for chunk in _chunks(sorted(set(track_id for station_id,track_id,play_time in entries)),1000):
+                for statement in _track_stats_refresh('track_id IN (' + _placeholders(len(chunk)) + ')'):
+                    await cur.execute(statement,chunk)
+            for station_id,day in sorted(set((station_id,_day(play_time)) for station_id,track_id,play_time in entries)):
+                next_day = _day(datetime.datetime.strptime(day,'%Y-%m-%d') + datetime.timedelta(days=1))
+                for statement in _daily_plays_refresh():
+                    await cur.execute(statement,(station_id,day,next_day))
+        return added
+
+    async def _get_station_ids_from_names(self,cur,names):
+        '''
+        See PlaylistDatabase._get_station_ids_from_names
+        '''
+        station_ids = {}
+        missing = []
+        for name in names:
+            station_id = self._id_cache.get(('station',name))
+            if station_id is None:
+                missing.append(name)
+            else:
+                station_ids[name] = station_id
+
+        if missing:
+            await cur.execute(_station_ids_query(len(missing)),missing)
+            for station_id,name in await cur.fetchall():
+                station_ids[name] = station_id
+                self._id_cache.put(('station',name),station_id)
+
+        for name in missing:
+            if name not in station_ids:
+                station_ids[name] = await self._get_station_id_from_name(cur,name)
+        return station_ids
+
+    async def _make_artists(self,cur,names):
+        '''
+        See PlaylistDatabase._make_artists
+        '''
+        artist_ids = {}
+        missing = []
+        for name in names:
+            artist_id = self._id_cache.get(('artist',name))
+            if artist_id is None:
+                missing.append(name)
+            else:
+                artist_ids[name] = artist_id
+        if not missing:
+            return artist_ids
+
+        await cur.executemany(_ARTIST_INSERT,[(n,) for n in missing])
+        await cur.execute(_artist_ids_query(len(missing)),missing)
+        for artist_id,name in await cur.fetchall():
+            artist_ids[name] = artist_id
+            self._id_cache.put(('artist',name),artist_id)
+
+        for name in missing:
+            if name not in artist_ids:
+                artist_ids[name] = await self._make_artist(cur,name,commit=False)
+        return artist_ids
+
+    async def _make_albums(self,cur,albums):
+        '''
+        See PlaylistDatabase._make_albums
+        '''
+        album_ids = {}
+        missing = []
+        for album,artist_id in albums:
+            album_id = self._id_cache.get(('album',album,artist_id))
+            if album_id is None:
+                missing.append((album,artist_id))
+            else:
+                album_ids[(album,artist_id)] = album_id
+        if not missing:
+            return album_ids
+
+        await cur.executemany(_ALBUM_INSERT,missing)
+        await cur.execute(_album_ids_query(len(missing)),[v for a in missing for v in a])
+        for album_id,name,artist_id in await cur.fetchall():
+            album_ids[(name,artist_id)] = album_id
+            self._id_cache.put(('album',name,artist_id),album_id)
+
+        for album,artist_id in missing:
+            if (album,artist_id) not in album_ids:
+                album_ids[(album,artist_id)] = await self._make_album(cur,artist_id,album,commit=False)
+        return album_ids
+
+    async def _make_tracks(self,cur,tracks):
+        '''
+        See PlaylistDatabase._make_tracks
+        '''
+        track_ids = {}
+        missing = []
+        for key,yt_link in tracks.items():
+            cached = self._id_cache.get(('track',)+key)
+            if cached is not None and cached[1:] == (yt_link,''):
+                track_ids[key] = cached[0]
+            else:
+                missing.append(key)
+        if not missing:
+            return track_ids
+
+        await cur.executemany(_TRACK_UPSERT,[_track_row(key[0],key[1],key[2],tracks[key],'') for key in missing])
+        await cur.execute(_track_ids_query(len(missing)),[v for k in missing for v in k])
+        for track_id,name,album_id,artist_id in await cur.fetchall():
+            key = (name,album_id,artist_id)
+            if key in tracks:
+                track_ids[key] = track_id
+                self._id_cache.put(('track',)+key,(track_id,tracks[key],''))
+
+        for key in missing:
+            if key not in track_ids:
+                name,album_id,artist_id = key
+                track_ids[key] = await self._make_track(cur,name,album_id,artist_id,tracks[key],commit=False)
+        return track_ids
+
+    async def _add_playlist_batch(self,cur,plays):
+        '''
+        See PlaylistDatabase._add_playlist_batch
+        '''
+        rows = _playlist_batch_rows(plays,self._song_cache)
+        if not rows:
+            return 0
+
+        station_ids = await self._get_station_ids_from_names(cur,set(r[0] for r in rows))
+        artist_ids = await self._make_artists(cur,set(r[1] for r in rows))
+        album_ids = await self._make_albums(cur,set((r[2],artist_ids[r[1]]) for r in rows))
+        track_ids = await self._make_tracks(cur,_playlist_batch_tracks(rows,artist_ids,album_ids))
+
+        entries,track_artists = _playlist_batch_entries(rows,station_ids,artist_ids,album_ids,track_ids)
+        await self._check_references(cur,entries)
+        return await self._add_playlist_entries(cur,entries,track_artists)
+
+    async def _rebuild_pending(self,cur,name):
+        '''
+        See PlaylistDatabase._rebuild_pending
+        '''
+        if name in self._rebuilt:
+            return False
+        checked = self._pending_checked.get(name)
+        if checked is not None and monotonic() - checked < REBUILD_CHECK_INTERVAL:
+            return True
+        await cur.execute(_PENDING_REBUILD_SELECT,(name,))
+        pending = (await cur.fetchone())[0] > 0
+        if pending:
+            self._pending_checked[name] = monotonic()
+        else:
+            self._rebuilt.add(name)
+        return pending
+
+    async def _daily_source(self,cur,table,start,end,station):
+        '''
+        See PlaylistDatabase._daily_source
+        '''
+        station_id = await self._get_station_id_from_name(cur,station) if station is not None else None
+        return _daily_source(table,start,end,station_id,await self._rebuild_pending(cur,'daily_plays'))
+
+    async def _trend(self,cur,table,key_filter,key_params,start,end,station,granularity):
+        '''
+        See PlaylistDatabase._trend
+        '''
+        period = _trend_period(granularity)
+
+        source,where,params = await self._daily_source(cur,table,start,end,station)
+        if key_filter:
+            where += ' AND ' + key_filter
+            params += key_params
+        await cur.execute(_trend_query(table,source,where),params)
+        return _trend_counts(await cur.fetchall(),start,end,period)
+
+    async def _get_ignore_rules(self,cur,station_ids):
+        '''
+        See PlaylistDatabase._get_ignore_rules
+        '''
+        station_ids = list(station_ids)
+        if not station_ids:
+            return {}
+
+        await cur.execute(_ignore_rule_fingerprints_query(len(station_ids)),station_ids)
+        fingerprints = dict((row[0],tuple(row[1:])) for row in await cur.fetchall())
+
+        out,stale = _cached_ignore_rules(self._ignore_rules,station_ids,fingerprints)
+        if stale:
+            await cur.execute(_ignore_rules_query(len(stale)),stale)
+            _compile_ignore_rules(self._ignore_rules,stale,fingerprints,await cur.fetchall(),out)
+
+        return out
+
+    #
+    # BEGIN PUBLIC FUNCTIONS
+    #
+
+    async def create_station(self,station_name,web_address,ignore_artists=[],ignore_titles=[],youtube_playlist_id='',get_id=True,commit=True):
+        async with self._cursor() as cur:
+            await cur.execute(_STATION_INSERT,_station_row(station_name,web_address,ignore_artists,ignore_titles,youtube_playlist_id))
+            await cur.execute(_STATION_ID_SELECT,(station_name,))
+            station_id = (await cur.fetchone())[0]
+
+            rules = _station_rule_rows(station_id,ignore_artists,ignore_titles)
+            if rules:
+                await cur.executemany(_IGNORE_RULE_INSERT,rules)
+
+        if get_id:
+            return station_id
+
+    async def add_track_to_station_playlist(self,station_name,artist,album,track,date,youtube_link='',commit=True):
+        if artist == '' or track == '':
+            return None
+
+        youtube_link = make_short_link(youtube_link)
+        self._song_cache.invalidate(_song_key(artist,album,track))
+        try:
+            async with self._cursor() as cur:
+                return await self._add_track(cur,station_name,artist,album,track,date,youtube_link)
+        except (self._IntegrityError,MissingReference) as e:
+            if not self._is_missing_reference(e):
+                raise
+            # A cached ID was deleted out from under us
+            self._id_cache.clear()
+            async with self._cursor() as cur:
+                return await self._add_track(cur,station_name,artist,album,track,date,youtube_link)
+
+    async def add_tracks_to_station_playlist_batch(self,plays,batch_size=1000,commit=True):
+        added = 0
+        try:
+            async with self._cursor() as cur:
+                for chunk in _chunks(plays,batch_size):
+                    added += await self._add_playlist_batch(cur,chunk)
+        except (self._IntegrityError,MissingReference) as e:
+            # IDs cached in the rolled back transaction are gone
+            self._id_cache.clear()
+            if not self._is_missing_reference(e):
+                raise
+            # A cached ID was deleted out from under us. The whole batch
+            # was rolled back, so start it again.
+            added = 0
+            async with self._cursor() as cur:
+                for chunk in _chunks(plays,batch_size):
+                    added += await self._add_playlist_batch(cur,chunk)
+        except:
+            self._id_cache.clear()
+            raise
+        return added
+
+    async def get_latest_station_tracks(self,station_name,num_tracks=1):
+        async with self._cursor() as cur:
+            station_id = await self._get_station_id_from_name(cur,station_name)
+            await cur.execute(*_latest_tracks_query(station_id,num_tracks))
+            tracks = [_track_dict(t) for t in await cur.fetchall()]
+
+        if num_tracks == 1:
+            return tracks[0]
+        return tracks
+
+    async def iter_station_history(self,station_name,start=None,end=None,chunk_size=1000):
+        '''
+        Async generator version of PlaylistDatabase.iter_station_history.
+        It holds one pooled connection until it's finished or closed.
+        '''
+        async with self._cursor(self._SSCursor) as cur:
+            station_id = await self._get_station_id_from_name(cur,station_name)
+            await cur.execute(*_station_history_query(station_id,start,end))
+
+            # Closing an SSCursor reads off whatever is left
+            while True:
+                data = await cur.fetchmany(chunk_size)
+                if not data:
+                    break
+                for t in data:
+                    yield _track_dict(t)
+
+    async def get_station_data(self,station=None,stations_only=False):
+        async with self._cursor() as cur:
+            if stations_only:
+                if station is None:
+                    await cur.execute(_STATIONS_SELECT)
+                else:
+                    await cur.execute(_STATION_SELECT,(station,))
+                rows = [s + (None,None) for s in await cur.fetchall()]
+            else:
+                await cur.execute(*_stations_with_latest_query(station))
+                rows = await cur.fetchall()
+
+            ignore_rules = await self._get_ignore_rules(cur,set(s[0] for s in rows))
+
+        out_list = _station_dicts(rows,ignore_rules,stations_only)
+        if station is not None:
+            return out_list[0]
+        return out_list
+
+    async def look_up_song_youtube(self,artist,album,title,use_cache=True):
+        key = _song_key(artist,album,title)
+        cached = self._song_cache.get(key) if use_cache else None
+        if cached is None:
+            async with self._cursor() as cur:
+                await cur.execute(_SONG_LINK_SELECT,(title,album,artist))
+                url = await cur.fetchone()
+
+            if url is None:
+                cached = (None,None)
+                self._song_cache.put(key,cached,ttl=self._song_cache_miss_ttl)
+            else:
+                cached = tuple(url)
+                self._song_cache.put(key,cached)
+
+        if cached[0] is None:
+            raise LookupError
+        return cached[1]
+
+    async def lookup_station_by_playlist_id(self,playlist_id):
+        async with self._cursor() as cur:
+            await cur.execute(_STATION_BY_PLAYLIST_SELECT,(playlist_id,))
+            station = await cur.fetchone()
+
+        if station is None:
+            raise LookupError
+        return _playlist_station_dict(station)
+
+    async def _check_fulltext(self,cur,force=False):
+        '''
+        MySQLBackend.check_fulltext
+        '''
+        if not force and (self._fulltext or monotonic() - self._fulltext_checked < FULLTEXT_RECHECK_INTERVAL):
+            return
+        await cur.execute(*FULLTEXT_CHECK)
+        self._fulltext = (await cur.fetchone())[0] == len(FULLTEXT_INDEXES)
+        self._fulltext_checked = monotonic()
+
+    async def search_tracks(self,title='',album='',artist='',video_id='',limit=100,offset=0):
+        async with self._cursor() as cur:
+            await self._check_fulltext(cur)
+            query,params = mysql_search_query(_search_fields(title,album,artist),video_id,limit,offset,self._fulltext)
+            await cur.execute(query,params)
+            return list(await cur.fetchall())
+
+    async def lookup_tracks_by_video(self,video):
+        video_id = get_video_id(video)
+        if video_id is None:
+            return []
+
+        async with self._cursor() as cur:
+            await cur.execute(_TRACKS_BY_VIDEO_SELECT,(video_id,))
+            return list(await cur.fetchall())
+
+    async def get_video_ids(self,after_id=0,limit=1000):
+        async with self._cursor() as cur:
+            await cur.execute(_VIDEO_IDS_SELECT,(after_id,limit))
+            return list(await cur.fetchall())
+
+    async def get_track_stats(self,track_ids):
+        stats = {}
+        async with self._cursor() as cur:
+            pending = await self._rebuild_pending(cur,'track_stats')
+            for chunk in _chunks(set(track_ids),1000):
+                totals,by_station = _track_stats_queries(pending,len(chunk))
+                await cur.execute(totals,chunk)
+                totals = await cur.fetchall()
+                await cur.execute(by_station,chunk)
+                _collect_track_stats(stats,totals,await cur.fetchall())
+        return stats
+
+    async def top_tracks(self,start,end,station=None,limit=50):
+        async with self._cursor() as cur:
+            source,where,params = await self._daily_source(cur,'DailyTrackPlays',start,end,station)
+            await cur.execute(*_top_tracks_query(source,where,params,limit))
+            return [tuple(row) for row in await cur.fetchall()]
+
+    async def top_artists(self,start,end,station=None,limit=50):
+        async with self._cursor() as cur:
+            source,where,params = await self._daily_source(cur,'DailyArtistPlays',start,end,station)
+            await cur.execute(*_top_artists_query(source,where,params,limit))
+            return [tuple(row) for row in await cur.fetchall()]
+
+    async def station_trend(self,station,start,end,granularity='day'):
+        async with self._cursor() as cur:
+            return await self._trend(cur,'DailyStationPlays','',[],start,end,station,granularity)
+
+    async def track_trend(self,track_id,start,end,station=None,granularity='day'):
+        async with self._cursor() as cur:
+            return await self._trend(cur,'DailyTrackPlays','DailyTrackPlays.track_id = %s',[track_id],
+                                     start,end,station,granularity)
+
+    async def artist_trend(self,artist,start,end,station=None,granularity='day'):
+        async with self._cursor() as cur:
+            await cur.execute(_ARTIST_ID_SELECT,(artist,))
+            row = await cur.fetchone()
+            if row is None:
+                raise LookupError('Artist: ' + str(artist) + ' could not be found.')
+            return await self._trend(cur,'DailyArtistPlays','DailyArtistPlays.artist_id = %s',[row[0]],
+                                     start,end,station,granularity)
+
+    async def set_track_youtube_link(self,track_id,youtube_link,commit=True):
+        youtube_link = make_short_link(youtube_link)
+        async with self._cursor() as cur:
+            await cur.execute(_TRACK_LINK_UPDATE,_track_link_row(track_id,youtube_link))
+        self.invalidate_id_cache(track_id=track_id)
+
+    async def get_search_result(self,query,max_age,empty_max_age=None):
+        now = datetime.datetime.now()
+        async with self._cursor() as cur:
+            await cur.execute(_SEARCH_RESULT_SELECT,(query,_db_time(now - datetime.timedelta(seconds=max_age))))
+            row = await cur.fetchone()
+        return _search_result_ids(row,now,empty_max_age)
+
+    async def record_search_hits(self,hits,commit=True):
+        async with self._cursor() as cur:
+            for row in _search_hit_rows(hits):
+                await cur.execute(_SEARCH_HITS_UPDATE,row)
+
+    async def put_search_result(self,query,video_ids,commit=True):
+        now = _db_time(datetime.datetime.now())
+        async with self._cursor() as cur:
+            await cur.execute(_SEARCH_RESULT_UPSERT,(query,','.join(video_ids),now,now))
+
+    async def evict_search_results(self,max_age,max_entries=None,commit=True):
+        cutoff = _db_time(datetime.datetime.now() - datetime.timedelta(seconds=max_age))
+        async with self._cursor() as cur:
+            await cur.execute(_SEARCH_EXPIRED_DELETE,(cutoff,))
+            removed = cur.rowcount
+
+            if max_entries is not None:
+                await cur.execute(_SEARCH_LRU_CUTOFF_SELECT,(max_entries,))
+                row = await cur.fetchone()
+                if row is not None:
+                    await cur.execute(_SEARCH_LRU_DELETE,(row[0],))
+                    removed += cur.rowcount
+        return removed
+
+    async def add_station_ignore_rule(self,station_name,field,pattern,match_type=EXACT,commit=True):
+        check_rule(field,match_type,pattern)
+        async with self._cursor() as cur:
+            station_id = await self._get_station_id_from_name(cur,station_name)
+            await cur.execute(_IGNORE_RULE_INSERT,(station_id,field,match_type,pattern))
+        self._ignore_rules.pop(station_id,None)
+
+    async def remove_station_ignore_rule(self,station_name,field,pattern,match_type=EXACT,commit=True):
+        async with self._cursor() as cur:
+            station_id = await self._get_station_id_from_name(cur,station_name)
+            await cur.execute(_IGNORE_RULE_DELETE,(station_id,field,match_type,pattern))
+            removed = cur.rowcount > 0
+        self._ignore_rules.pop(station_id,None)
+        return removed
+
+    async def get_station_ignore_rules(self,station_name):
+        async with self._cursor() as cur:
+            station_id = await self._get_station_id_from_name(cur,station_name)
+            return (await self._get_ignore_rules(cur,[station_id]))[station_id]
+
+    def read_your_writes(self,seconds=None):
+        pass
+
+    @contextmanager
+    def primary_reads(self):
+        yield
+
+    # These only touch the cache
+    invalidate_id_cache = PlaylistDatabase.invalidate_id_cache
+    id_cache_stats = PlaylistDatabase.id_cache_stats
+    song_cache_stats = PlaylistDatabase.song_cache_stats
+
+    def pool_stats(self):
+        '''
+        Connections open and free in the aiomysql pool
+        '''
+        if self._pool is None:
+            return None
+        return {'size':self._pool.size,'free':self._pool.freesize,'max_size':self._pool.maxsize}
+
+    def stats(self):
+        '''
+        The caches and the connection pool. Queries aren't counted here.
+        '''
+        return {
+            'id_cache':self.id_cache_stats(),
+            'song_cache':self.song_cache_stats(),
+            'pool':self.pool_stats(),
+        }
+
+    def metrics(self):
+        '''
+        stats() in Prometheus' text format, for the frontend's /metrics
+        '''
+        out = _cache_metrics(self.id_cache_stats(),self.song_cache_stats())
+        pool = self.pool_stats()
+        if pool is not None:
+            for name,key in (('size','size'),('idle','free')):
+                metric = 'playlistdb_pool_' + name
+                out += '# TYPE %s gauge\n%s %d\n'%(metric,metric,pool[key])
+        return out
@@ -1,11 +1,750 @@
 #!/usr/bin/env python3
 
-import mysql.connector as mysql
 import datetime
 
 from math import floor
-from threading import RLock
+from time import monotonic
+from threading import local
+from functools import wraps
+from contextlib import contextmanager
 from configparser import ConfigParser
+from itertools import islice
+
+from cache import LRUCache
+from connection_pool import ConnectionPool
+from replicas import ReplicaSet
+from query_stats import QueryStats, InstrumentedCursor
+from backends import make_backend
+from youtube_links import get_video_id, make_short_link
+from ignore_rules import StationIgnoreRules, IgnoreList, check_rule, ARTIST, TITLE, EXACT
+
+def _chunks(iterable,size):
+    '''
+    Split an iterable into lists of at most size items
+    '''
+    iterator = iter(iterable)
+    chunk = list(islice(iterator,size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator,size))
+
+def _placeholders(count,width=1):
+    '''
+    Make the parameter list for an IN clause. A width of more than one
+    makes row constructors, e.g. (%s,%s),(%s,%s)
+    '''
+    if width == 1:
+        return ','.join(['%s']*count)
+    return ','.join(['(' + ','.join(['%s']*width) + ')']*count)
+
+class MissingReference(Exception):
+    '''
+    A station or track ID we had cached is gone. Playlist's foreign
+    keys raise an IntegrityError for this, see _check_references for
+    when they aren't there.
+    '''
+
+def _as_datetime(value):
+    '''
+    SQLite hands back MAX() of a DATETIME column as text
+    '''
+    if isinstance(value,str):
+        return datetime.datetime.fromisoformat(value)
+    return value
+
+def _song_key(artist,album,title):
+    '''
+    The song cache key. Name comparisons in MySQL ignore case and
+    trailing spaces, so the key does too.
+    '''
+    return (artist.lower().rstrip(' '),album.lower().rstrip(' '),title.lower().rstrip(' '))
+
+def _track_dict(t):
+    '''
+    A (track, artist, play time, youtube, album, filesystem) row as the
+    dictionary get_latest_station_tracks hands back
+    '''
+    temp = {}
+    temp['name'] = t[0]
+    temp['artist'] = t[1]
+    temp['time'] = t[2]
+    temp['youtube'] = t[3]
+    temp['album'] = t[4]
+    temp['filesystem'] = t[5]
+    return temp
+
+def _station_dicts(rows,ignore_rules,stations_only):
+    '''
+    Turn station rows (with the latest track and artist on the end) into
+    get_station_data's dictionaries. ignore_rules is station ID to
+    StationIgnoreRules.
+    '''
+    out_list = []
+    seen = set()
+    for s in rows:
+        id,name,web_address,ignore_artists,ignore_titles,youtube_playlist_id,active,lastsong,lastartist = s
+        
+        # Two plays at the exact same time would give us the
+        # station twice. The first one is the newest entry.
+        if id in seen:
+            continue
+        seen.add(id)
+        
+        channel_dict = {}
+
+        channel_dict['site'] = web_address
+        # These are still lists of the patterns, but 'in' runs
+        # the compiled rules
+        rules = ignore_rules[id]
+        channel_dict['ignore'] = rules
+        channel_dict['ignoreartists'] = IgnoreList(rules.artists)
+        channel_dict['ignoretitles'] = IgnoreList(rules.titles)
+        channel_dict['name'] = name
+        channel_dict['playlist'] = youtube_playlist_id
+
+        if (active == 1):
+            channel_dict['active'] = True
+        else:
+            channel_dict['active'] = False
+
+        if not stations_only:
+            # No plays yet
+            channel_dict['lastartist'] = lastartist if lastartist is not None else ''
+            channel_dict['lastsong'] = lastsong if lastsong is not None else ''
+        
+        out_list.append(channel_dict)
+    
+    return out_list
+
+def _stations_with_latest_query(station=None):
+    '''
+    The query (and its parameters) for every station row plus the name
+    and artist of its latest track. Stations that haven't played anything
+    get NULLs.
+    '''
+    
+    # Find each station's newest play_time first, then join back to
+    # get the track. The MAX is one (station_id, play_time) index seek
+    # per station, instead of sorting each station's history (or
+    # scanning the whole index on SQLite, which can't skip through it).
+    params = ()
+    station_filter = ''
+    if station is not None:
+        station_filter = 'WHERE Station.station_name = %s'
+        params = (station,)
+    
+    return ('''SELECT Station.id, Station.station_name, Station.web_address,
+    Station.ignore_artists, Station.ignore_titles, Station.youtube_playlist_id, Station.active,
+    Track.track_name, Artist.artist_name FROM Station
+    LEFT JOIN (SELECT Station.id AS station_id, (SELECT MAX(Playlist.play_time) FROM Playlist
+        WHERE Playlist.station_id = Station.id) AS play_time FROM Station
+        ''' + station_filter + ''') AS Latest ON Latest.station_id = Station.id
+    LEFT JOIN Playlist ON Playlist.station_id = Latest.station_id AND Playlist.play_time = Latest.play_time
+    LEFT JOIN Track ON Playlist.track_id = Track.id
+    LEFT JOIN Artist ON Track.artist_id = Artist.id
+    ''' + station_filter + '''
+    ORDER BY Station.id, Playlist.id DESC''',params*2)
+
+# The statements PlaylistDatabase and AsyncPlaylistDatabase both run to
+# add a play and look up a song
+_STATION_ID_SELECT = '''SELECT Station.id from Station where Station.station_name = %s'''
+_ARTIST_INSERT = '''
+INSERT IGNORE INTO Artist(artist_name)
+VALUES ( %s )'''
+_ARTIST_ID_SELECT = '''
+SELECT Artist.id FROM Artist WHERE
+Artist.artist_name=%s'''
+_ALBUM_INSERT = '''
+INSERT IGNORE INTO Album(album_name,artist_id)
+VALUES ( %s, %s )'''
+_ALBUM_ID_SELECT = '''
+SELECT Album.id FROM Album WHERE
+Album.album_name=%s AND Album.artist_id=%s'''
+# We're doing an upsert because maybe we're updating a track with a new
+# youtube or filesystem link. Takes _track_row's parameters.
+_TRACK_UPSERT = '''
+INSERT INTO Track (track_name,youtube_link,video_id,filesystem_link,album_id,artist_id)
+VALUES( %s, %s, %s, %s, %s, %s ) ON DUPLICATE KEY UPDATE
+youtube_link=VALUES(youtube_link),video_id=VALUES(video_id),filesystem_link=VALUES(filesystem_link)'''
+_TRACK_ID_SELECT = '''
+SELECT Track.id FROM Track WHERE
+Track.track_name=%s AND Track.album_id=%s AND Track.artist_id=%s'''
+# No 'INSERT OR REPLACE INTO' because this should be unique based on the play times
+_PLAYLIST_INSERT = '''
+INSERT INTO Playlist (track_id,station_id,play_time)
+VALUES (%s, %s, %s)'''
+_SONG_LINK_SELECT = '''SELECT Track.id, Track.youtube_link from Track JOIN Artist JOIN Album ON
+Track.artist_id = Artist.id and Track.album_id = Album.id WHERE Track.track_name = %s and Album.album_name = %s and Artist.artist_name = %s LIMIT 1'''
+
+def _track_row(name,album_id,artist_id,yt_link,fs_link):
+    return (name,yt_link,get_video_id(yt_link),fs_link,album_id,artist_id)
+
+def _ignore_rule_fingerprints_query(count):
+    '''
+    (station ID, fingerprint...) of the rules of count stations, see
+    _get_ignore_rules
+    '''
+    return ('''SELECT StationIgnoreRule.station_id, COUNT(*), MAX(StationIgnoreRule.id), SUM(StationIgnoreRule.id)
+    FROM StationIgnoreRule WHERE StationIgnoreRule.station_id IN (''' + _placeholders(count) + ''')
+    GROUP BY StationIgnoreRule.station_id''')
+
+def _ignore_rules_query(count):
+    '''
+    (station ID, field, match type, pattern) of every rule of count stations
+    '''
+    return ('''SELECT StationIgnoreRule.station_id, StationIgnoreRule.field,
+    StationIgnoreRule.match_type, StationIgnoreRule.pattern FROM StationIgnoreRule
+    WHERE StationIgnoreRule.station_id IN (''' + _placeholders(count) + ''')
+    ORDER BY StationIgnoreRule.id''')
+
+def _cached_ignore_rules(cache,station_ids,fingerprints):
+    '''
+    Split station_ids into the ones whose compiled rules in cache
+    (station ID -> (fingerprint, StationIgnoreRules)) still match their
+    fingerprint and the stale ones. Returns (station ID ->
+    StationIgnoreRules, stale station IDs).
+    '''
+    out = {}
+    stale = []
+    for station_id in station_ids:
+        fingerprint = fingerprints.get(station_id)
+        cached = cache.get(station_id)
+        if cached is not None and cached[0] == fingerprint:
+            out[station_id] = cached[1]
+        elif fingerprint is None:
+            # No rules at all
+            out[station_id] = StationIgnoreRules()
+            cache[station_id] = (None,out[station_id])
+        else:
+            stale.append(station_id)
+    return out,stale
+
+def _compile_ignore_rules(cache,stale,fingerprints,rows,out):
+    '''
+    Compile the stale stations' rules from _ignore_rules_query rows into
+    out and the cache
+    '''
+    rules = dict((station_id,[]) for station_id in stale)
+    for station_id,field,match_type,pattern in rows:
+        rules[station_id].append((field,match_type,pattern))
+    for station_id in stale:
+        out[station_id] = StationIgnoreRules(rules[station_id])
+        cache[station_id] = (fingerprints.get(station_id),out[station_id])
+
+# Add plays to TrackStats and TrackStationStats. Rows are (track ID,
+# [station ID,] plays, latest play time).
+_TRACK_STATS_UPSERT = '''INSERT INTO TrackStats(track_id,play_count,last_play) VALUES (%s, %s, %s)
+ON DUPLICATE KEY UPDATE play_count = play_count + VALUES(play_count), last_play = GREATEST(last_play,VALUES(last_play))'''
+_TRACK_STATION_STATS_UPSERT = '''INSERT INTO TrackStationStats(track_id,station_id,play_count,last_play) VALUES (%s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE play_count = play_count + VALUES(play_count), last_play = GREATEST(last_play,VALUES(last_play))'''
+
+def _track_stats_rows(entries):
+    '''
+    Sum (station ID, track ID, play time) playlist entries into rows for
+    _TRACK_STATS_UPSERT and _TRACK_STATION_STATS_UPSERT
+    '''
+    tracks = {}
+    stations = {}
+    for station_id,track_id,play_time in entries:
+        for counts,key in ((tracks,track_id),(stations,(track_id,station_id))):
+            count,latest = counts.get(key,(0,play_time))
+            counts[key] = (count+1,max(latest,play_time))
+    return ([(track_id,count,latest) for track_id,(count,latest) in tracks.items()],
+            [(track_id,station_id,count,latest) for (track_id,station_id),(count,latest) in stations.items()])
+
+def _track_stats_refresh(track_filter):
+    '''
+    The statements that work TrackStats and TrackStationStats out again
+    from the history for the tracks matching track_filter (a condition
+    on a track_id column, e.g. "track_id IN (%s,%s)"). Each one takes
+    the filter's parameters.
+    '''
+    return [
+        'DELETE FROM TrackStationStats WHERE ' + track_filter,
+        'DELETE FROM TrackStats WHERE ' + track_filter,
+        '''INSERT INTO TrackStats(track_id,play_count,last_play)
+        SELECT Playlist.track_id, COUNT(*), MAX(Playlist.play_time) FROM Playlist
+        WHERE Playlist.''' + track_filter + ''' GROUP BY Playlist.track_id''',
+        '''INSERT INTO TrackStationStats(track_id,station_id,play_count,last_play)
+        SELECT Playlist.track_id, Playlist.station_id, COUNT(*), MAX(Playlist.play_time) FROM Playlist
+        WHERE Playlist.''' + track_filter + ''' GROUP BY Playlist.track_id, Playlist.station_id''',
+    ]
+
+def refresh_track_stats(cur,track_ids):
+    '''
+    Run _track_stats_refresh for a list of track IDs on a cursor
+    '''
+    for chunk in _chunks(sorted(track_ids),1000):
+        for statement in _track_stats_refresh('track_id IN (' + _placeholders(len(chunk)) + ')'):
+            cur.execute(statement,chunk)
+
+# Add plays to the daily rollups. Rows are (station ID, day, [track or
+# artist ID,] plays).
+_DAILY_STATION_UPSERT = '''INSERT INTO DailyStationPlays(station_id,day,play_count) VALUES (%s, %s, %s)
+ON DUPLICATE KEY UPDATE play_count = play_count + VALUES(play_count)'''
+_DAILY_TRACK_UPSERT = '''INSERT INTO DailyTrackPlays(station_id,day,track_id,play_count) VALUES (%s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE play_count = play_count + VALUES(play_count)'''
+_DAILY_ARTIST_UPSERT = '''INSERT INTO DailyArtistPlays(station_id,day,artist_id,play_count) VALUES (%s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE play_count = play_count + VALUES(play_count)'''
+
+def _day(value):
+    '''
+    'YYYY-MM-DD' for a date, datetime, or play time string
+    '''
+    if isinstance(value,str):
+        return value[:10]
+    return value.strftime('%Y-%m-%d')
+
+def _daily_plays_rows(entries,artist_ids):
+    '''
+    Sum (station ID, track ID, play time) playlist entries into rows for
+    the three _DAILY_*_UPSERTs. artist_ids maps each track ID to its
+    artist's.
+    '''
+    counts = ({},{},{})
+    for station_id,track_id,play_time in entries:
+        day = _day(play_time)
+        for rollup,key in zip(counts,((station_id,day),(station_id,day,track_id),(station_id,day,artist_ids[track_id]))):
+            rollup[key] = rollup.get(key,0) + 1
+    return tuple([key + (count,) for key,count in rollup.items()] for rollup in counts)
+
+def _daily_plays_refresh():
+    '''
+    The statements that work the daily rollups of one station out again
+    from the history for a range of days. Each one takes (station ID,
+    first day, day after the last).
+    '''
+    return [
+        'DELETE FROM DailyStationPlays WHERE station_id = %s AND day >= %s AND day < %s',
+        'DELETE FROM DailyTrackPlays WHERE station_id = %s AND day >= %s AND day < %s',
+        'DELETE FROM DailyArtistPlays WHERE station_id = %s AND day >= %s AND day < %s',
+        '''INSERT INTO DailyStationPlays(station_id,day,play_count)
+        SELECT Playlist.station_id, DATE(Playlist.play_time), COUNT(*) FROM Playlist
+        WHERE Playlist.station_id = %s AND Playlist.play_time >= %s AND Playlist.play_time < %s
+        GROUP BY Playlist.station_id, DATE(Playlist.play_time)''',
+        '''INSERT INTO DailyTrackPlays(station_id,day,track_id,play_count)
+        SELECT Playlist.station_id, DATE(Playlist.play_time), Playlist.track_id, COUNT(*) FROM Playlist
+        WHERE Playlist.station_id = %s AND Playlist.play_time >= %s AND Playlist.play_time < %s
+        GROUP BY Playlist.station_id, DATE(Playlist.play_time), Playlist.track_id''',
+        '''INSERT INTO DailyArtistPlays(station_id,day,artist_id,play_count)
+        SELECT Playlist.station_id, DATE(Playlist.play_time), Track.artist_id, COUNT(*) FROM Playlist
+        JOIN Track ON Playlist.track_id = Track.id
+        WHERE Playlist.station_id = %s AND Playlist.play_time >= %s AND Playlist.play_time < %s
+        GROUP BY Playlist.station_id, DATE(Playlist.play_time), Track.artist_id''',
+    ]
+
+# The daily rollups worked out from the history, to read from until
+# daily_plays.py rebuild has filled them. Each is aliased to the table's
+# name so it can stand in for it. See _daily_source for {where}.
+_DAILY_FROM_HISTORY = {
+    'DailyStationPlays':'''(SELECT Playlist.station_id, DATE(Playlist.play_time) AS day, COUNT(*) AS play_count
+    FROM Playlist WHERE {where} GROUP BY Playlist.station_id, DATE(Playlist.play_time)) AS DailyStationPlays''',
+    'DailyTrackPlays':'''(SELECT Playlist.station_id, DATE(Playlist.play_time) AS day, Playlist.track_id, COUNT(*) AS play_count
+    FROM Playlist WHERE {where} GROUP BY Playlist.station_id, DATE(Playlist.play_time), Playlist.track_id) AS DailyTrackPlays''',
+    'DailyArtistPlays':'''(SELECT Playlist.station_id, DATE(Playlist.play_time) AS day, Track.artist_id, COUNT(*) AS play_count
+    FROM Playlist JOIN Track ON Playlist.track_id = Track.id WHERE {where}
+    GROUP BY Playlist.station_id, DATE(Playlist.play_time), Track.artist_id) AS DailyArtistPlays''',
+}
+
+def refresh_daily_plays(cur,station_days):
+    '''
+    Run _daily_plays_refresh on a cursor for each (station ID, day) in
+    station_days. Days can be dates or 'YYYY-MM-DD' strings.
+    '''
+    for station_id,day in sorted(set((station_id,_day(day)) for station_id,day in station_days)):
+        next_day = _day(datetime.datetime.strptime(day,'%Y-%m-%d') + datetime.timedelta(days=1))
+        for statement in _daily_plays_refresh():
+            cur.execute(statement,(station_id,day,next_day))
+
+# The rest of the statements behind the public functions, and what
+# turns their rows into return values. AsyncPlaylistDatabase runs the
+# same ones.
+
+_STATIONS_SELECT = '''SELECT * from Station'''
+_STATION_SELECT = '''SELECT * from Station where Station.station_name = %s'''
+_STATION_INSERT = '''
+INSERT IGNORE INTO Station(station_name,web_address,ignore_artists,ignore_titles,youtube_playlist_id,active)
+VALUES ( %s, %s, %s, %s, %s, %s )'''
+_STATION_BY_PLAYLIST_SELECT = '''SELECT * from Station where Station.youtube_playlist_id = %s'''
+_IGNORE_RULE_INSERT = '''
+INSERT IGNORE INTO StationIgnoreRule(station_id,field,match_type,pattern)
+VALUES ( %s, %s, %s, %s )'''
+_IGNORE_RULE_DELETE = '''
+DELETE FROM StationIgnoreRule WHERE StationIgnoreRule.station_id=%s AND
+StationIgnoreRule.field=%s AND StationIgnoreRule.match_type=%s AND
+StationIgnoreRule.pattern=%s'''
+
+def _station_row(station_name,web_address,ignore_artists,ignore_titles,youtube_playlist_id):
+    # The rules live in StationIgnoreRule. The old columns are
+    # still filled in so an older version can read them.
+    return (station_name,web_address,str(list(ignore_artists)),str(list(ignore_titles)),youtube_playlist_id,True)
+
+def _station_rule_rows(station_id,ignore_artists,ignore_titles):
+    '''
+    _IGNORE_RULE_INSERT rows for a new station's ignore lists
+    '''
+    rules = [(station_id,ARTIST,EXACT,a) for a in ignore_artists]
+    rules += [(station_id,TITLE,EXACT,t) for t in ignore_titles]
+    return rules
+
+def _playlist_station_dict(station):
+    '''
+    A Station row as lookup_station_by_playlist_id's dictionary
+    '''
+    id, name, addr, i_a, i_t, pl_id, active = station
+    station_dict = {}
+    station_dict['id'] = id
+    station_dict['name'] = name
+    station_dict['ignore_artists'] = i_a
+    station_dict['ignore_titles'] = i_t
+    station_dict['playlist_id'] = pl_id
+    station_dict['active'] = active
+    return station_dict
+
+# The bulk versions of the ID lookups, for the batch adds. Each takes the
+# keys flattened and returns (ID, key...) rows.
+def _station_ids_query(count):
+    return '''SELECT Station.id, Station.station_name from Station
+    WHERE Station.station_name IN (''' + _placeholders(count) + ')'
+
+def _artist_ids_query(count):
+    return '''
+    SELECT Artist.id, Artist.artist_name FROM Artist WHERE
+    Artist.artist_name IN (''' + _placeholders(count) + ')'
+
+def _album_ids_query(count):
+    return '''
+    SELECT Album.id, Album.album_name, Album.artist_id FROM Album WHERE
+    (Album.album_name,Album.artist_id) IN (''' + _placeholders(count,2) + ')'
+
+def _track_ids_query(count):
+    return '''
+    SELECT Track.id, Track.track_name, Track.album_id, Track.artist_id FROM Track WHERE
+    (Track.track_name,Track.album_id,Track.artist_id) IN (''' + _placeholders(count,3) + ')'
+
+_PLAYLIST_INSERT_IGNORE = '''
+INSERT IGNORE INTO Playlist (track_id,station_id,play_time)
+VALUES (%s, %s, %s)
+'''
+
+def _playlist_batch_rows(plays,song_cache):
+    '''
+    (station, artist, album, track, play time, youtube link) rows for the
+    plays of a batch that can be added, with the same rules as
+    add_track_to_station_playlist. Their songs are dropped from song_cache.
+    '''
+    rows = []
+    for play in plays:
+        station_name,artist,album,track,date = play[:5]
+        youtube_link = play[5] if len(play) > 5 else ''
+        
+        if artist == '' or track == '':
+            continue
+        youtube_link = make_short_link(youtube_link)
+        date = date.strftime('%Y-%m-%d %H:%M:%S.%f')
+        rows.append((station_name,artist,album,track,date,youtube_link))
+        song_cache.invalidate(_song_key(artist,album,track))
+    return rows
+
+def _playlist_batch_tracks(rows,artist_ids,album_ids):
+    '''
+    (track name, album ID, artist ID) -> youtube link for a batch's rows.
+    A later play of the same track wins the youtube link, just like
+    calling add_track_to_station_playlist once per play.
+    '''
+    tracks = {}
+    for station_name,artist,album,track,date,youtube_link in rows:
+        artist_id = artist_ids[artist]
+        tracks[(track,album_ids[(album,artist_id)],artist_id)] = youtube_link
+    return tracks
+
+def _playlist_batch_entries(rows,station_ids,artist_ids,album_ids,track_ids):
+    '''
+    The (station ID, track ID, play time) playlist entries of a batch's
+    rows, and a dictionary of their track IDs to artist IDs
+    '''
+    entries = []
+    track_artists = {}
+    for station_name,artist,album,track,date,youtube_link in rows:
+        artist_id = artist_ids[artist]
+        track_id = track_ids[(track,album_ids[(album,artist_id)],artist_id)]
+        entries.append((station_ids[station_name],track_id,date))
+        track_artists[track_id] = artist_id
+    return entries,track_artists
+
+def _references_query(entries):
+    '''
+    How many of the stations and tracks (station ID, track ID, play time)
+    entries use exist, and how many there should be
+    '''
+    station_ids = sorted(set(entry[0] for entry in entries))
+    track_ids = sorted(set(entry[1] for entry in entries))
+    query = ('SELECT (SELECT COUNT(*) FROM Station WHERE Station.id IN (' + _placeholders(len(station_ids)) + ')), '
+             '(SELECT COUNT(*) FROM Track WHERE Track.id IN (' + _placeholders(len(track_ids)) + '))')
+    return query,tuple(station_ids + track_ids),(len(station_ids),len(track_ids))
+
+def _latest_tracks_query(station_id,num_tracks):
+    return ('''SELECT Track.track_name, Artist.artist_name, Playlist.play_time, Track.youtube_link, Album.album_name, Track.filesystem_link FROM Playlist
+    JOIN Artist JOIN Track JOIN Album ON 
+    Playlist.track_id = Track.id and Track.artist_id = Artist.id and Track.album_id = Album.id WHERE Playlist.station_id = %s
+    ORDER BY Playlist.play_time DESC LIMIT %s''',(station_id,num_tracks))
+
+def _station_history_query(station_id,start,end):
+    '''
+    The query (and its parameters) for iter_station_history
+    '''
+    where = 'WHERE Playlist.station_id = %s'
+    params = [station_id]
+    if start is not None:
+        where += ' AND Playlist.play_time >= %s'
+        params.append(start.strftime('%Y-%m-%d %H:%M:%S'))
+    if end is not None:
+        where += ' AND Playlist.play_time < %s'
+        params.append(end.strftime('%Y-%m-%d %H:%M:%S'))
+    
+    return ('''SELECT Track.track_name, Artist.artist_name, Playlist.play_time, Track.youtube_link, Album.album_name, Track.filesystem_link FROM Playlist
+    JOIN Track ON Playlist.track_id = Track.id
+    JOIN Artist ON Track.artist_id = Artist.id
+    JOIN Album ON Track.album_id = Album.id
+    ''' + where + '''
+    ORDER BY Playlist.play_time''',params)
+
+def _search_fields(title,album,artist):
+    '''
+    The (column, search string)s search_tracks hands to search_query
+    '''
+    return [(column,value) for column,value in (('Track.track_name',title),('Album.album_name',album),
+                                                ('Artist.artist_name',artist)) if value.strip() != '']
+
+_TRACKS_BY_VIDEO_SELECT = '''SELECT Track.id, Track.track_name, Artist.artist_name, Album.album_name, Track.youtube_link
+from Track JOIN Artist JOIN Album ON Track.album_id=Album.id AND Track.artist_id=Artist.id
+WHERE Track.video_id = %s'''
+_VIDEO_IDS_SELECT = '''SELECT Track.id, Track.video_id FROM Track
+WHERE Track.id > %s AND Track.video_id IS NOT NULL
+ORDER BY Track.id LIMIT %s'''
+_TRACK_LINK_UPDATE = '''
+UPDATE Track
+SET youtube_link=%s, video_id=%s
+WHERE Track.id=%s
+'''
+
+# Seconds a pending rebuild is believed before asking again. Once it's
+# done it's never asked about again.
+REBUILD_CHECK_INTERVAL = 60
+
+_PENDING_REBUILD_SELECT = '''SELECT COUNT(*) FROM PendingRebuild WHERE PendingRebuild.name = %s'''
+_PENDING_REBUILD_DELETE = '''DELETE FROM PendingRebuild WHERE PendingRebuild.name = %s'''
+
+def _track_stats_queries(pending,count):
+    '''
+    get_track_stats' (totals, per station) queries for count track IDs,
+    from the history if the TrackStats rebuild is pending
+    '''
+    if pending:
+        totals = '''SELECT Playlist.track_id, COUNT(*), MAX(Playlist.play_time)
+        FROM Playlist WHERE Playlist.track_id IN (%s) GROUP BY Playlist.track_id'''
+        by_station = '''SELECT Playlist.track_id, Station.station_name, COUNT(*) AS play_count, MAX(Playlist.play_time)
+        FROM Playlist JOIN Station ON Playlist.station_id = Station.id
+        WHERE Playlist.track_id IN (%s) GROUP BY Playlist.track_id, Station.station_name
+        ORDER BY play_count DESC, Station.station_name'''
+    else:
+        totals = '''SELECT TrackStats.track_id, TrackStats.play_count, TrackStats.last_play
+        FROM TrackStats WHERE TrackStats.track_id IN (%s)'''
+        by_station = '''SELECT TrackStationStats.track_id, Station.station_name,
+        TrackStationStats.play_count, TrackStationStats.last_play
+        FROM TrackStationStats JOIN Station ON TrackStationStats.station_id = Station.id
+        WHERE TrackStationStats.track_id IN (%s)
+        ORDER BY TrackStationStats.play_count DESC, Station.station_name'''
+    return totals.replace('%s',_placeholders(count)),by_station.replace('%s',_placeholders(count))
+
+def _collect_track_stats(stats,totals,by_station):
+    '''
+    Add the rows of _track_stats_queries to get_track_stats' dictionary
+    '''
+    for track_id,play_count,last_play in totals:
+        stats[track_id] = {'play_count':play_count,'last_play':_as_datetime(last_play),'stations':[]}
+    for track_id,station_name,play_count,last_play in by_station:
+        if track_id in stats:
+            stats[track_id]['stations'].append((station_name,play_count,_as_datetime(last_play)))
+
+def _daily_where(table,start,end,station_id):
+    '''
+    WHERE clause and parameters picking a range of days (and maybe a
+    station) out of one of the daily rollups
+    '''
+    where = table + '.day >= %s AND ' + table + '.day < %s'
+    params = [_day(start),_day(end)]
+    if station_id is not None:
+        where = table + '.station_id = %s AND ' + where
+        params.insert(0,station_id)
+    return where,params
+
+def _daily_source(table,start,end,station_id,pending):
+    '''
+    What to read a range of days (and maybe a station) from one of the
+    daily rollups with: (FROM, WHERE, parameters of both). If the
+    rebuild is pending the FROM is worked out from the plays in that
+    range instead, which is slower but right.
+    '''
+    where,params = _daily_where(table,start,end,station_id)
+    if not pending:
+        return table,where,params
+    # Only group the plays that were asked for
+    history_where = 'Playlist.play_time >= %s AND Playlist.play_time < %s'
+    history_params = [_day(start),_day(end)]
+    if station_id is not None:
+        history_where = 'Playlist.station_id = %s AND ' + history_where
+        history_params.insert(0,station_id)
+    return _DAILY_FROM_HISTORY[table].format(where=history_where),where,history_params + params
+
+def _top_tracks_query(source,where,params,limit):
+    return ('''SELECT Track.id, Track.track_name, Artist.artist_name, Album.album_name, Top.plays
+    FROM (SELECT DailyTrackPlays.track_id, SUM(DailyTrackPlays.play_count) AS plays FROM ''' + source + '''
+    WHERE ''' + where + ''' GROUP BY DailyTrackPlays.track_id
+    ORDER BY plays DESC, DailyTrackPlays.track_id LIMIT %s) AS Top
+    JOIN Track ON Top.track_id = Track.id
+    JOIN Artist ON Track.artist_id = Artist.id
+    JOIN Album ON Track.album_id = Album.id
+    ORDER BY Top.plays DESC, Track.id''',params + [limit])
+
+def _top_artists_query(source,where,params,limit):
+    return ('''SELECT Artist.id, Artist.artist_name, Top.plays
+    FROM (SELECT DailyArtistPlays.artist_id, SUM(DailyArtistPlays.play_count) AS plays FROM ''' + source + '''
+    WHERE ''' + where + ''' GROUP BY DailyArtistPlays.artist_id
+    ORDER BY plays DESC, DailyArtistPlays.artist_id LIMIT %s) AS Top
+    JOIN Artist ON Top.artist_id = Artist.id
+    ORDER BY Top.plays DESC, Artist.id''',params + [limit])
+
+_TREND_PERIODS = {
+    'day':lambda d: d,
+    'week':lambda d: d - datetime.timedelta(days=d.weekday()),
+    'month':lambda d: d.replace(day=1),
+}
+
+def _trend_period(granularity):
+    if granularity not in _TREND_PERIODS:
+        raise ValueError('granularity must be day, week, or month')
+    return _TREND_PERIODS[granularity]
+
+def _trend_query(table,source,where):
+    return ('SELECT ' + table + '.day, SUM(' + table + '.play_count) FROM ' + source +
+            ' WHERE ' + where + ' GROUP BY ' + table + '.day')
+
+def _trend_counts(rows,start,end,period):
+    '''
+    Bucket _trend_query's (day, plays) rows into sorted (first day of the
+    period, plays) tuples. Every period gets a row, even if nothing was
+    played.
+    '''
+    first = datetime.datetime.strptime(_day(start),'%Y-%m-%d').date()
+    last = datetime.datetime.strptime(_day(end),'%Y-%m-%d').date()
+    counts = {}
+    day = first
+    while day < last:
+        counts[period(day)] = 0
+        day += datetime.timedelta(days=1)
+    for day,plays in rows:
+        # SQLite hands back a grouped DATE column as text
+        if isinstance(day,str):
+            day = datetime.datetime.strptime(day[:10],'%Y-%m-%d').date()
+        counts[period(day)] += int(plays)
+    return sorted(counts.items())
+
+def _track_link_row(track_id,youtube_link):
+    return (youtube_link,get_video_id(youtube_link),track_id)
+
+def _db_time(when):
+    return when.strftime('%Y-%m-%d %H:%M:%S')
+
+_SEARCH_RESULT_SELECT = '''SELECT SearchCache.video_ids, SearchCache.searched_at FROM SearchCache
+WHERE SearchCache.query = %s AND SearchCache.searched_at >= %s'''
+_SEARCH_HITS_UPDATE = '''UPDATE SearchCache SET last_used = GREATEST(last_used,%s), hits = hits + %s
+WHERE SearchCache.query = %s'''
+_SEARCH_RESULT_UPSERT = '''INSERT INTO SearchCache(query,video_ids,searched_at,last_used,hits)
+VALUES (%s, %s, %s, %s, 0) ON DUPLICATE KEY UPDATE
+video_ids=VALUES(video_ids),searched_at=VALUES(searched_at),last_used=VALUES(last_used),hits=0'''
+_SEARCH_EXPIRED_DELETE = '''DELETE FROM SearchCache WHERE SearchCache.searched_at < %s'''
+# The last_used of the newest entry that doesn't fit. Ties with it are
+# kept, so it can go a little over.
+_SEARCH_LRU_CUTOFF_SELECT = '''SELECT SearchCache.last_used FROM SearchCache
+ORDER BY SearchCache.last_used DESC LIMIT 1 OFFSET %s'''
+_SEARCH_LRU_DELETE = '''DELETE FROM SearchCache WHERE SearchCache.last_used < %s'''
+
+def _search_result_ids(row,now,empty_max_age):
+    '''
+    get_search_result's answer from a _SEARCH_RESULT_SELECT row
+    '''
+    if row is None:
+        return None
+
+    video_ids = row[0].split(',') if row[0] else []
+    if not video_ids and empty_max_age is not None:
+        searched_at = row[1]
+        if isinstance(searched_at,str):
+            searched_at = datetime.datetime.strptime(searched_at[:19],'%Y-%m-%d %H:%M:%S')
+        if now - searched_at > datetime.timedelta(seconds=empty_max_age):
+            return None
+    return video_ids
+
+def _search_hit_rows(hits):
+    return [(_db_time(last_used),count,query) for query,(count,last_used) in hits.items()]
+
+def _cache_metrics(id_stats,song_stats):
+    '''
+    The ID and song cache counters in Prometheus' text format
+    '''
+    out = ''
+    for name,kind in (('hits','counter'),('misses','counter'),('evictions','counter'),
+                      ('expirations','counter'),('size','gauge')):
+        metric = 'playlistdb_cache_' + name + ('_total' if kind == 'counter' else '')
+        out += '# TYPE ' + metric + ' ' + kind + '\n'
+        for cache,stats in (('id',id_stats),('song',song_stats)):
+            out += '%s{cache="%s"} %d\n'%(metric,cache,stats[name])
+    return out
+
+def _read_only(func):
+    '''
+    Run a public function that only reads on a replica, if there's one
+    in rotation and this thread isn't in the middle of a write. If the
+    replica fails it's taken out and the call is made on the primary.
+    '''
+    @wraps(func)
+    def wrapper(self,*args,**kwargs):
+        if self._replicas is None or getattr(self._local,'reading',False) or getattr(self._local,'writing',0):
+            return func(self,*args,**kwargs)
+        self._local.reading = True
+        try:
+            return func(self,*args,**kwargs)
+        except self._backend.Error:
+            replica = getattr(self._local,'replica',None)
+            if replica is None:
+                raise
+            print('Replica ' + replica[0] + ' failed, reading from the primary')
+            self._replicas.mark_down(replica[0])
+            self._close_replica()
+            self._local.reading = False
+            return func(self,*args,**kwargs)
+        finally:
+            self._local.reading = False
+    return wrapper
+
+def _writes(func):
+    '''
+    A public function that writes. Everything it reads comes from the
+    primary, and this thread's reads after it do too until the replicas
+    have had time to catch up (see read_your_writes).
+    '''
+    @wraps(func)
+    def wrapper(self,*args,**kwargs):
+        if self._replicas is None:
+            return func(self,*args,**kwargs)
+        self._local.writing = getattr(self._local,'writing',0) + 1
+        try:
+            return func(self,*args,**kwargs)
+        finally:
+            self._local.writing -= 1
+            self.read_your_writes()
+    return wrapper
 
 class PlaylistDatabase():
     '''
@@ -22,93 +761,68 @@ class PlaylistDatabase():
         Initialize the database. This consists of:
         * Dropping all relevant tables.
         * Creating new empty tables.
+        The backend knows how to do both.
         '''
         
         print('Dropping...')
-        try:
-            self._cur.execute('drop database PlaylistDB')
-        except mysql.errors.DatabaseError:
-            #print('No database exists.')
-            pass
-            
-        self._cur.execute('create database PlaylistDB')
-        self._cur.execute('use PlaylistDB')
-
-        
-        self._cur.execute('''CREATE TABLE IF NOT EXISTS Artist (
-            id  INTEGER NOT NULL AUTO_INCREMENT UNIQUE,
-            artist_name VARCHAR(256) UNIQUE NOT NULL,
-        
-            PRIMARY KEY (id),
-            KEY (artist_name)
-        )''')
-        
-        self._cur.execute('''CREATE TABLE IF NOT EXISTS Album (
-            id  INTEGER NOT NULL AUTO_INCREMENT UNIQUE,
-            album_name VARCHAR(256) NOT NULL,
-            artist_id  INTEGER NOT NULL,
-        
-            PRIMARY KEY (id),
-            FOREIGN KEY (artist_id) REFERENCES Artist(id) ON UPDATE CASCADE,
-            UNIQUE(album_name,artist_id)
-        )''')
-        
-        self._cur.execute('''CREATE TABLE IF NOT EXISTS Track (
-            id  INTEGER NOT NULL AUTO_INCREMENT UNIQUE,
-            track_name VARCHAR(256) NOT NULL,
-            youtube_link TEXT,
-            filesystem_link TEXT, 
-            album_id  INTEGER NOT NULL,
-            artist_id  INTEGER NOT NULL,
-        
-            PRIMARY KEY (id),
-            FOREIGN KEY (album_id) REFERENCES Album(id)  ON UPDATE CASCADE,
-            FOREIGN KEY (artist_id) REFERENCES Artist(id) ON UPDATE CASCADE ,
-            KEY (track_name),
-            UNIQUE(track_name,album_id,artist_id)            
-        )''')
-        
-        self._cur.execute('''CREATE TABLE IF NOT EXISTS Station (
-            id  INTEGER NOT NULL AUTO_INCREMENT UNIQUE,
-            station_name VARCHAR(256) NOT NULL UNIQUE,
-            web_address TEXT,
-            ignore_artists TEXT,
-            ignore_titles TEXT,
-            youtube_playlist_id TEXT,
-            active BOOL NOT NULL,
-        
-            PRIMARY KEY (id),
-            KEY (station_name)
-        )''')
-        
-        self._cur.execute('''CREATE TABLE IF NOT EXISTS Playlist (
-            id INTEGER NOT NULL AUTO_INCREMENT UNIQUE,
-            track_id INTEGER NOT NULL,
-            station_id INTEGER NOT NULL,
-            play_time DATETIME NOT NULL,
-        
-            PRIMARY KEY (id),
-            KEY (station_id),
-            FOREIGN KEY (track_id) REFERENCES Track(id) ON UPDATE CASCADE,
-            FOREIGN KEY (station_id) REFERENCES Station(id) ON UPDATE CASCADE,
-            UNIQUE(track_id,station_id,play_time)
-        )''')           
-        
+        self._id_cache.clear()
+        self._song_cache.clear()
+        self._ignore_rules.clear()
+        self._backend.create_schema(self._conn)
         
         if commit:
             self._conn.commit()
         
         
-    def _get_all_stations(self):
+    def _get_all_stations(self,station=None):
         
-        self._cur.execute('''SELECT * from Station''')
+        if station is None:
+            self._cur.execute(_STATIONS_SELECT)
+        else:
+            self._cur.execute(_STATION_SELECT,(station,))
         stations = self._cur.fetchall()
         
         return stations
     
+    def _get_all_stations_with_latest(self,station=None):
+        '''
+        Every station row plus the name and artist of its latest track,
+        in one query. Stations that haven't played anything get NULLs.
+        '''
+        
+        self._cur.execute(*_stations_with_latest_query(station))
+        
+        return self._cur.fetchall()
+    
+    def _get_ignore_rules(self,station_ids):
+        '''
+        Return a dictionary of station ID to StationIgnoreRules.
+        
+        Compiled rules are kept until the station's rules change. To notice
+        changes made by other processes (RemoveBadVideo.py) we compare a
+        cheap per-station fingerprint of the rule table every time.
+        '''
+        station_ids = list(station_ids)
+        if not station_ids:
+            return {}
+        
+        self._cur.execute(_ignore_rule_fingerprints_query(len(station_ids)),station_ids)
+        fingerprints = dict((row[0],tuple(row[1:])) for row in self._cur.fetchall())
+        
+        out,stale = _cached_ignore_rules(self._ignore_rules,station_ids,fingerprints)
+        if stale:
+            self._cur.execute(_ignore_rules_query(len(stale)),stale)
+            _compile_ignore_rules(self._ignore_rules,stale,fingerprints,self._cur.fetchall(),out)
+        
+        return out
+    
     def _get_station_id_from_name(self,name):
+        
+        station_id = self._id_cache.get(('station',name))
+        if station_id is not None:
+            return station_id
                
-        self._cur.execute('''SELECT Station.id from Station where Station.station_name = %s''',(name,))
+        self._cur.execute(_STATION_ID_SELECT,(name,))
         
         try:
             station_id = self._cur.fetchone()[0]
@@ -117,6 +831,7 @@ class PlaylistDatabase():
             raise LookupError('Station: ' + str(name) + ' could not be found.')
                 
         #print('station_id: ' + str(station_id))
+        self._id_cache.put(('station',name),station_id)
         return station_id
     
     def _make_artist(self,name,get_id=True,commit=True):
@@ -125,20 +840,22 @@ class PlaylistDatabase():
         For artists we only have a name.
         '''
         
-        self._cur.execute('''
-        INSERT IGNORE INTO Artist(artist_name)
-        VALUES ( %s )''', (name,)
-        )
+        # If we've seen it before it's already in the table
+        artist_id = self._id_cache.get(('artist',name))
+        if artist_id is not None:
+            return artist_id if get_id else None
+        
+        self._cur.execute(_ARTIST_INSERT,(name,))
         
         # If they're doing a bunch of makes they might not want
         # to commit after each one
         if commit:
             self._conn.commit()
         if get_id:
-            self._cur.execute('''
-            SELECT Artist.id FROM Artist WHERE
-            Artist.artist_name=%s''',(name,))
-            return self._cur.fetchone()[0]        
+            self._cur.execute(_ARTIST_ID_SELECT,(name,))
+            artist_id = self._cur.fetchone()[0]
+            self._id_cache.put(('artist',name),artist_id)
+            return artist_id
         
     
     def _make_album(self,artist_id,album,get_id=True,commit=True):
@@ -146,12 +863,11 @@ class PlaylistDatabase():
         Create an album in the table.
         '''
         
-        # Get the artist id
+        album_id = self._id_cache.get(('album',album,artist_id))
+        if album_id is not None:
+            return album_id if get_id else None
         
-        self._cur.execute('''
-        INSERT IGNORE INTO Album(album_name,artist_id)
-        VALUES ( %s, %s )''', (album,artist_id)
-        )
+        self._cur.execute(_ALBUM_INSERT,(album,artist_id))
         
         # If they're doing a bunch of makes they might not want
         # to commit after each one
@@ -159,11 +875,10 @@ class PlaylistDatabase():
             self._conn.commit()
         
         if get_id:
-            self._cur.execute('''
-            SELECT Album.id FROM Album WHERE
-            Album.album_name=%s AND Album.artist_id=%s
-            ''',(album,artist_id))
-            return self._cur.fetchone()[0]        
+            self._cur.execute(_ALBUM_ID_SELECT,(album,artist_id))
+            album_id = self._cur.fetchone()[0]
+            self._id_cache.put(('album',album,artist_id),album_id)
+            return album_id
         
         
     def _make_track(self,name,album_id,artist_id,yt_link='',fs_link='',get_id=True,commit=True):
@@ -172,14 +887,13 @@ class PlaylistDatabase():
         'Track' table. Optionally a youtube URL or filesystem location can also be specified.
         '''
         
-        # We're doing a 'OR REPLACE' because maybe we're updating a track with a 
-        # new youtube or filesystem link.
-        self._cur.execute('''
-        INSERT INTO Track (track_name,youtube_link,filesystem_link,album_id,artist_id)
-        VALUES( %s, %s, %s, %s, %s ) ON DUPLICATE KEY UPDATE
-        youtube_link=VALUES(youtube_link),filesystem_link=VALUES(filesystem_link)''',
-        (name,yt_link,fs_link,album_id,artist_id)
-        )
+        # Only skip the insert if the links haven't changed. Otherwise
+        # we still need to update them.
+        cached = self._id_cache.get(('track',name,album_id,artist_id))
+        if cached is not None and cached[1:] == (yt_link,fs_link):
+            return cached[0] if get_id else None
+        
+        self._cur.execute(_TRACK_UPSERT,_track_row(name,album_id,artist_id,yt_link,fs_link))
         
         # If they're doing a bunch of makes they might not want
         # to commit after each one
@@ -187,67 +901,318 @@ class PlaylistDatabase():
             self._conn.commit()
         
         if get_id:
-            self._cur.execute('''
-            SELECT Track.id FROM Track WHERE
-            Track.track_name=%s AND 
-            Track.youtube_link=%s AND 
-            Track.filesystem_link=%s AND
-            Track.album_id=%s AND
-            Track.artist_id=%s''',(name,yt_link,fs_link,album_id,artist_id))
-            return self._cur.fetchone()[0]        
+            self._cur.execute(_TRACK_ID_SELECT,(name,album_id,artist_id))
+            track_id = self._cur.fetchone()[0]
+            self._id_cache.put(('track',name,album_id,artist_id),(track_id,yt_link,fs_link))
+            return track_id
 
-    def _add_playlist_entry(self,station_id,track_id,play_time,commit=True):
+    def _add_playlist_entry(self,station_id,track_id,play_time,commit=True,artist_id=None):
         '''
         Given a station ID, track ID, and a play time (a string date)
-        create a new row in the corresponding playlist table
-        '''
-        # No 'INSERT OR REPLACE INTO' because this should be unique based on the play times
-        self._cur.execute('''
-        INSERT INTO Playlist (track_id,station_id,play_time)
-        VALUES (%s, %s, %s)
-        ''', (track_id,station_id,play_time)
-        )
+        create a new row in the corresponding playlist table. Pass the
+        track's artist_id if you have it to save looking it up.
+        '''
+        self._cur.execute(_PLAYLIST_INSERT,(track_id,station_id,play_time))
+        playlist_id = self._cur.lastrowid
+        
+        self._add_track_stats([(station_id,track_id,play_time)])
+        self._add_daily_plays([(station_id,track_id,play_time)],
+                              {track_id:artist_id} if artist_id is not None else None)
                 
         # If they're doing a bunch of makes they might not want
         # to commit after each one
         if commit:
             self._conn.commit()
         
-        return self._cur.lastrowid
+        return playlist_id
+    
+    def _add_track_stats(self,entries):
+        '''
+        Count (station ID, track ID, play time) entries that were just
+        added to the playlist in TrackStats and TrackStationStats.
+        Does not commit.
+        '''
+        tracks,stations = _track_stats_rows(entries)
+        self._cur.executemany(_TRACK_STATS_UPSERT,tracks)
+        self._cur.executemany(_TRACK_STATION_STATS_UPSERT,stations)
+    
+    def _track_artist_ids(self,track_ids):
+        '''
+        Dictionary of track ID to artist ID
+        '''
+        artist_ids = {}
+        for chunk in _chunks(set(track_ids),1000):
+            self._cur.execute('''SELECT Track.id, Track.artist_id FROM Track
+            WHERE Track.id IN (''' + _placeholders(len(chunk)) + ')',chunk)
+            artist_ids.update(self._cur.fetchall())
+        return artist_ids
+    
+    def _add_daily_plays(self,entries,artist_ids=None):
+        '''
+        Count (station ID, track ID, play time) entries that were just
+        added to the playlist in the daily rollups. artist_ids maps track
+        IDs to artist IDs, they're looked up if it's not given.
+        Does not commit.
+        '''
+        if artist_ids is None:
+            artist_ids = self._track_artist_ids(set(track_id for station_id,track_id,play_time in entries))
+        for statement,rows in zip((_DAILY_STATION_UPSERT,_DAILY_TRACK_UPSERT,_DAILY_ARTIST_UPSERT),
+                                  _daily_plays_rows(entries,artist_ids)):
+            self._cur.executemany(statement,rows)
+    
+    def _refresh_track_stats(self,track_ids):
+        '''
+        Work the stats of some tracks out again from the history.
+        Does not commit.
+        '''
+        refresh_track_stats(self._cur,track_ids)
+    
+    def _get_station_ids_from_names(self,names):
+        '''
+        Bulk version of _get_station_id_from_name. Returns a dictionary
+        of station name to station ID.
+        '''
+        station_ids = {}
+        missing = []
+        for name in names:
+            station_id = self._id_cache.get(('station',name))
+            if station_id is None:
+                missing.append(name)
+            else:
+                station_ids[name] = station_id
+        
+        if missing:
+            self._cur.execute(_station_ids_query(len(missing)),missing)
+            for station_id,name in self._cur.fetchall():
+                station_ids[name] = station_id
+                self._id_cache.put(('station',name),station_id)
+        
+        # Anything we didn't get back goes through the single lookup so
+        # a missing station raises the same LookupError
+        for name in missing:
+            if name not in station_ids:
+                station_ids[name] = self._get_station_id_from_name(name)
+        
+        return station_ids
+    
+    def _make_artists(self,names):
+        '''
+        Bulk version of _make_artist. Creates any missing artists with one
+        multi-row insert and returns a dictionary of artist name to artist ID.
+        Does not commit.
+        '''
+        artist_ids = {}
+        missing = []
+        for name in names:
+            artist_id = self._id_cache.get(('artist',name))
+            if artist_id is None:
+                missing.append(name)
+            else:
+                artist_ids[name] = artist_id
+        
+        if not missing:
+            return artist_ids
+        
+        self._cur.executemany(_ARTIST_INSERT,[(n,) for n in missing])
+        
+        self._cur.execute(_artist_ids_query(len(missing)),missing)
+        for artist_id,name in self._cur.fetchall():
+            artist_ids[name] = artist_id
+            self._id_cache.put(('artist',name),artist_id)
+        
+        # The column collation can match a name that we don't get back
+        # byte for byte (case, trailing spaces). Look those up one at a time.
+        for name in missing:
+            if name not in artist_ids:
+                artist_ids[name] = self._make_artist(name,commit=False)
+        
+        return artist_ids
+    
+    def _make_albums(self,albums):
+        '''
+        Bulk version of _make_album. Takes (album name, artist ID) pairs
+        and returns a dictionary of those pairs to album ID.
+        Does not commit.
+        '''
+        album_ids = {}
+        missing = []
+        for album,artist_id in albums:
+            album_id = self._id_cache.get(('album',album,artist_id))
+            if album_id is None:
+                missing.append((album,artist_id))
+            else:
+                album_ids[(album,artist_id)] = album_id
+        
+        if not missing:
+            return album_ids
+        
+        self._cur.executemany(_ALBUM_INSERT,missing)
+        
+        self._cur.execute(_album_ids_query(len(missing)),[v for a in missing for v in a])
+        for album_id,name,artist_id in self._cur.fetchall():
+            album_ids[(name,artist_id)] = album_id
+            self._id_cache.put(('album',name,artist_id),album_id)
+        
+        for album,artist_id in missing:
+            if (album,artist_id) not in album_ids:
+                album_ids[(album,artist_id)] = self._make_album(artist_id,album,commit=False)
+        
+        return album_ids
+    
+    def _make_tracks(self,tracks):
+        '''
+        Bulk version of _make_track. Takes a dictionary of
+        (track name, album ID, artist ID) to youtube link and returns a
+        dictionary of those keys to track ID. Existing tracks get their
+        youtube link updated, just like _make_track.
+        Does not commit.
+        '''
+        track_ids = {}
+        missing = []
+        for key,yt_link in tracks.items():
+            cached = self._id_cache.get(('track',)+key)
+            if cached is not None and cached[1:] == (yt_link,''):
+                track_ids[key] = cached[0]
+            else:
+                missing.append(key)
+        
+        if not missing:
+            return track_ids
+        
+        self._cur.executemany(_TRACK_UPSERT,[_track_row(key[0],key[1],key[2],tracks[key],'') for key in missing])
+        
+        self._cur.execute(_track_ids_query(len(missing)),[v for k in missing for v in k])
+        for track_id,name,album_id,artist_id in self._cur.fetchall():
+            key = (name,album_id,artist_id)
+            if key in tracks:
+                track_ids[key] = track_id
+                self._id_cache.put(('track',)+key,(track_id,tracks[key],''))
+        
+        for key in missing:
+            if key not in track_ids:
+                name,album_id,artist_id = key
+                track_ids[key] = self._make_track(name,album_id,artist_id,tracks[key],commit=False)
+        
+        return track_ids
+    
+    def _add_playlist_entries(self,entries,artist_ids=None):
+        '''
+        Bulk version of _add_playlist_entry. Takes (station ID, track ID, play time)
+        tuples. Entries that are already in the playlist are skipped.
+        Returns the number of rows added. Does not commit.
+        '''
+        self._cur.executemany(_PLAYLIST_INSERT_IGNORE,
+                              [(track_id,station_id,play_time) for station_id,track_id,play_time in entries])
+        added = self._cur.rowcount
+        
+        if added == len(entries):
+            self._add_track_stats(entries)
+            self._add_daily_plays(entries,artist_ids)
+        else:
+            # Some were already there and we can't tell which, so count
+            # these tracks' and days' plays again
+            self._refresh_track_stats(set(track_id for station_id,track_id,play_time in entries))
+            refresh_daily_plays(self._cur,[(station_id,play_time) for station_id,track_id,play_time in entries])
+        
+        return added
+    
+    def _check_references(self,entries):
+        '''
+        Raise MissingReference if a station or track that (station ID,
+        track ID, play time) entries use doesn't exist. Only needed
+        when Playlist has no foreign keys to do it (a partitioned
+        Playlist, see retention.enable_partitioning), since the IDs
+        may have come from the ID cache.
+        '''
+        if self._backend.playlist_foreign_keys:
+            return
+        query,params,expected = _references_query(entries)
+        self._cur.execute(query,params)
+        if tuple(self._cur.fetchone()) != expected:
+            raise MissingReference('A cached station or track ID no longer exists')
+    
+    def _is_missing_reference(self,e):
+        return isinstance(e,MissingReference) or self._backend.is_missing_reference(e)
+    
+    def _add_playlist_batch(self,plays):
+        '''
+        Add one chunk of plays for add_tracks_to_station_playlist_batch
+        '''
+        
+        rows = _playlist_batch_rows(plays,self._song_cache)
+        if not rows:
+            return 0
+        
+        station_ids = self._get_station_ids_from_names(set(r[0] for r in rows))
+        artist_ids = self._make_artists(set(r[1] for r in rows))
+        album_ids = self._make_albums(set((r[2],artist_ids[r[1]]) for r in rows))
+        track_ids = self._make_tracks(_playlist_batch_tracks(rows,artist_ids,album_ids))
+        
+        entries,track_artists = _playlist_batch_entries(rows,station_ids,artist_ids,album_ids,track_ids)
+        self._check_references(entries)
+        return self._add_playlist_entries(entries,track_artists)
+    
+    def _add_track(self,station_name,artist,album,track,date,youtube_link,commit):
+        '''
+        The body of add_track_to_station_playlist
+        '''
+        # Now that we have the data...
+        
+        # Loop up the station's ID
+        station_id = self._get_station_id_from_name(station_name)
+        #print('playlist_id is :'+ playlist_id)
+        
+        # Make (or don't) the artist
+        artist_id = self._make_artist(artist,commit=commit)
+        
+        # Make (or don't) the album
+        album_id = self._make_album(artist_id,album,commit=commit)
+        
+        # Make (or don't) a track
+        track_id = self._make_track(track,album_id,artist_id,youtube_link,commit=commit)
+        
+        # Make a date. It's stored as a string because 
+        # sqlite doesn't have a date data type. That's OK though
+        # because sqlite can search based on this string's structure.    
+        #date_ms = int(floor(date.microsecond/1000))
+        date = date.strftime('%Y-%m-%d %H:%M:%S.%f')
+        
+        self._check_references([(station_id,track_id,date)])
+        
+        # Now that we have the data we can make an entry
+        return self._add_playlist_entry(station_id,track_id,date,commit=commit,artist_id=artist_id)
     
     #
     # BEGIN PUBLIC FUNCTIONS
     #
     
+    @_writes
     def create_station(self,station_name,web_address,ignore_artists=[],ignore_titles=[],youtube_playlist_id='',get_id=True,commit=True):
         '''
         Create a station and associated playlist
         '''
         
-        with self._lock:
-            # Create a new playlist to use for this station
-            #playlist_name = self._make_playlist(station_name)
-            
-            # v2 will use a different format for this... Probably another table?
-            ignore_artists = str(ignore_artists)
-            ignore_titles = str(ignore_titles)
-            #print(playlist_name)
-            self._cur.execute('''
-            INSERT IGNORE INTO Station(station_name,web_address,ignore_artists,ignore_titles,youtube_playlist_id,active)
-            VALUES ( %s, %s, %s, %s, %s, %s )''', (station_name,web_address,ignore_artists,ignore_titles,youtube_playlist_id,'true')
-            )
-            
-            if commit:
-                self._conn.commit()
-            
-            if get_id:
-                self._cur.execute('''
-                SELECT Station.id FROM Station WHERE
-                station_name=%s''',(station_name,))              
-            
-                return self._cur.fetchone()[0]        
+        # Create a new playlist to use for this station
+        #playlist_name = self._make_playlist(station_name)
+        
+        #print(playlist_name)
+        self._cur.execute(_STATION_INSERT,_station_row(station_name,web_address,ignore_artists,ignore_titles,youtube_playlist_id))
+        
+        self._cur.execute(_STATION_ID_SELECT,(station_name,))
+        station_id = self._cur.fetchone()[0]
+        
+        rules = _station_rule_rows(station_id,ignore_artists,ignore_titles)
+        if rules:
+            self._cur.executemany(_IGNORE_RULE_INSERT,rules)
+        
+        if commit:
+            self._conn.commit()
+        
+        if get_id:
+            return station_id
 
        
+    @_writes
     def add_track_to_station_playlist(self,station_name,artist,album,track,date,youtube_link='',commit = True):
         '''
         This public function takes a station common name
@@ -256,206 +1221,976 @@ class PlaylistDatabase():
         track (if necessary), and adds the track to the playlist
         '''
         
-        with self._lock:
-            # This might happen. But upstream from here we should really be 
-            # catching stuff like this
-            if artist == '' or track == '':
-                #print('Skipped')
-                return None
-            
-            # Make a short link
-            youtube_link = youtube_link.replace('https://www.youtube.com/watch?v=','https://youtu.be/')                               
-                        
-            # Now that we have the data...
-            
-            # Loop up the station's ID
-            station_id = self._get_station_id_from_name(station_name)
-            #print('playlist_id is :'+ playlist_id)
-            
-            # Make (or don't) the artist
-            artist_id = self._make_artist(artist,commit=commit)
-            
-            # Make (or don't) the album
-            album_id = self._make_album(artist_id,album,commit=commit)
-            
-            # Make (or don't) a track
-            track_id = self._make_track(track,album_id,artist_id,youtube_link,commit=commit)
-            
-            # Make a date. It's stored as a string because 
-            # sqlite doesn't have a date data type. That's OK though
-            # because sqlite can search based on this string's structure.    
-            #date_ms = int(floor(date.microsecond/1000))
-            date = date.strftime('%Y-%m-%d %H:%M:%S.%f')
-            
-            # Now that we have the data we can make an entry
-            return self._add_playlist_entry(station_id,track_id,date,commit=commit)
+        # This might happen. But upstream from here we should really be 
+        # catching stuff like this
+        if artist == '' or track == '':
+            #print('Skipped')
+            return None
+        
+        # Make a short link
+        youtube_link = make_short_link(youtube_link)
+        
+        # It might be a new song, or a new link for an old one
+        self._song_cache.invalidate(_song_key(artist,album,track))
+        
+        try:
+            try:
+                return self._add_track(station_name,artist,album,track,date,youtube_link,commit)
+            except (self._backend.IntegrityError,MissingReference) as e:
+                if not self._is_missing_reference(e):
+                    raise
+                # Something outside of this process deleted a row we had an
+                # ID cached for. Forget everything and look it up again.
+                self._id_cache.clear()
+                return self._add_track(station_name,artist,album,track,date,youtube_link,commit)
+        except:
+            # A failed insert (usually a play we already have) leaves the
+            # transaction open, holding locks other threads' writes need
+            if commit:
+                self._conn.rollback()
+            raise
+
+    @_writes
+    def add_tracks_to_station_playlist_batch(self,plays,batch_size=1000,commit=True):
+        '''
+        Batched version of add_track_to_station_playlist for backfills.
+        plays is an iterable of (station_name,artist,album,track,date,youtube_link)
+        tuples, the same arguments add_track_to_station_playlist takes
+        (youtube_link may be left off).
+        
+        Artists, albums, and tracks are created with multi-row statements
+        and their IDs are fetched back in bulk, batch_size plays at a time.
+        Everything is written in one transaction. Plays that are already in
+        a playlist are skipped instead of raising.
+        
+        Returns the number of playlist rows added.
+        '''
+        
+        added = 0
+        try:
+            for chunk in _chunks(plays,batch_size):
+                try:
+                    added += self._add_playlist_batch(chunk)
+                except (self._backend.IntegrityError,MissingReference) as e:
+                    if not self._is_missing_reference(e):
+                        raise
+                    # A cached ID was deleted out from under us
+                    self._id_cache.clear()
+                    added += self._add_playlist_batch(chunk)
+        except:
+            if commit:
+                self._conn.rollback()
+                # Anything we cached in this transaction is gone now
+                self._id_cache.clear()
+            raise
+        
+        if commit:
+            self._conn.commit()
+        
+        return added
 
     
+    @_read_only
     def get_latest_station_tracks(self,station_name,num_tracks=1):
         '''
         Get a number of tracks from a station. Order from newest
         to oldest.
         '''
-        with self._lock:
-            station_id = self._get_station_id_from_name(station_name)
-            
-            self._cur.execute('''SELECT Track.track_name, Artist.artist_name, Playlist.play_time, Track.youtube_link, Album.album_name, Track.filesystem_link FROM Playlist
-            JOIN Artist JOIN Track JOIN Album ON 
-            Playlist.track_id = Track.id and Track.artist_id = Artist.id and Track.album_id = Album.id WHERE Playlist.station_id = %s
-            ORDER BY Playlist.play_time DESC LIMIT %s''',(station_id,num_tracks))
-            data = self._cur.fetchall()
+        station_id = self._get_station_id_from_name(station_name)
+        
+        self._cur.execute(*_latest_tracks_query(station_id,num_tracks))
+        tracks = [_track_dict(t) for t in self._cur.fetchall()]
             
-            # The data we will send back
-            tracks = []
-            for t in data:
-                temp = {}
-                temp['name'] = t[0]
-                temp['artist'] = t[1]
-                temp['time'] = t[2]               
-                temp['youtube'] = t[3]
-                temp['album'] = t[4]
-                temp['filesystem'] = t[5]
-                tracks.append(temp)
-                
-            if num_tracks == 1:
-                return tracks[0]
-            else:
-                return tracks
+        if num_tracks == 1:
+            return tracks[0]
+        else:
+            return tracks
     
     
+        
+    def iter_station_history(self,station_name,start=None,end=None,chunk_size=1000):
+        '''
+        Yield a station's plays, oldest first, as dictionaries with the same
+        keys get_latest_station_tracks uses. start and end are datetimes
+        (start is inclusive, end is not); leave them off for everything.
+        
+        Rows are streamed from the server chunk_size at a time with an
+        unbuffered cursor, so memory use doesn't grow with the number of
+        plays. This thread's connection is busy until the generator is
+        finished or closed, so don't run other queries on it meanwhile.
+        '''
+        station_id = self._get_station_id_from_name(station_name)
+        
+        cur = self._new_cursor(self._conn,streaming=True)
+        try:
+            cur.execute(*_station_history_query(station_id,start,end))
             
-    def get_station_data(self,station=None):
+            while True:
+                data = cur.fetchmany(chunk_size)
+                if not data:
+                    break
+                for t in data:
+                    yield _track_dict(t)
+        finally:
+            # An unbuffered cursor has to be drained before the
+            # connection can be used again. Do it a chunk at a time
+            # in case we were stopped early.
+            try:
+                while cur.fetchmany(chunk_size):
+                    pass
+            except self._backend.Error:
+                pass
+            cur.close()
+    
+    @_read_only
+    def get_station_data(self,station=None,stations_only=False):
         '''
-        Return a list of dictionaries of the station data
+        Return a list of dictionaries of the station data.
+        
+        Each station's last artist and song come back from the same
+        query. If you don't need them pass stations_only=True and the
+        'lastartist'/'lastsong' keys are left out.
         '''
         
-        with self._lock:
-            out_list = []
-            for s in self._get_all_stations():
-                id,name,web_address,ignore_artists,ignore_titles,youtube_playlist_id,active = s
-                
-                if station is not None:
-                    if name != station:
-                        continue
-                
-                channel_dict = {}
-    
-                channel_dict['site'] = web_address
-                exec("channel_dict['ignoreartists'] = "+ ignore_artists)
-                exec("channel_dict['ignoretitles'] = "+ ignore_titles)
-                channel_dict['name'] = name
-                channel_dict['playlist'] = youtube_playlist_id
-
-                if (active == 1):
-                    channel_dict['active'] = True
-                else:
-                    channel_dict['active'] = False
- 
-                try:
-                    track_data = self.get_latest_station_tracks(name)
-                    channel_dict['lastartist'] = track_data['artist']
-                    channel_dict['lastsong'] = track_data['name']
-                except IndexError:
-                    channel_dict['lastartist'] = ''
-                    channel_dict['lastsong'] = ''
-                    
-                
-                out_list.append(channel_dict)
+        if stations_only:
+            rows = [s + (None,None) for s in self._get_all_stations(station)]
+        else:
+            rows = self._get_all_stations_with_latest(station)
+        
+        ignore_rules = self._get_ignore_rules(set(s[0] for s in rows))
+        
+        out_list = _station_dicts(rows,ignore_rules,stations_only)
 
         if station is not None:
             return out_list[0]
         else:
             return out_list
     
-    def look_up_song_youtube(self,artist,album,title):
+    @_read_only
+    def look_up_song_youtube(self,artist,album,title,use_cache=True):
         '''
         Given the artist, album, and title,
         Look up the song's youtube URL
+        
+        Answers (and songs we don't have, for a shorter time) are cached.
+        Links changed through this object drop their entries straight away,
+        changes made by other processes (like /replace in the frontend)
+        show up once the entry expires. Before acting on a cached link,
+        e.g. deciding its video is gone and replacing it, look again with
+        use_cache=False, which reads the database and refreshes the entry.
         '''
         
-        with self._lock:
-            self._cur.execute('''SELECT Track.youtube_link from Track JOIN Artist JOIN Album ON
-            Track.artist_id = Artist.id and Track.album_id = Album.id WHERE Track.track_name = %s and Album.album_name = %s and Artist.artist_name = %s LIMIT 1''',
-            (title,album,artist))
-            
-            url = self._cur.fetchone()
-            
-            # LookupError seems better
-            if url == None:
+        key = _song_key(artist,album,title)
+        cached = self._song_cache.get(key) if use_cache else None
+        if cached is not None:
+            if cached[0] is None:
                 raise LookupError
-            else:
-                return url[0]
+            return cached[1]
+        
+        self._cur.execute(_SONG_LINK_SELECT,(title,album,artist))
+        
+        url = self._cur.fetchone()
+        
+        # LookupError seems better
+        if url == None:
+            self._song_cache.put(key,(None,None),ttl=self._song_cache_miss_ttl)
+            raise LookupError
+        else:
+            # (track ID, link) so a track's entry can be found by ID
+            self._song_cache.put(key,tuple(url))
+            return url[1]
 
+    @_read_only
     def lookup_station_by_playlist_id(self,playlist_id):
-        with self._lock:
-            self._cur.execute('''SELECT * from Station where Station.youtube_playlist_id = %s''',(playlist_id,))
-            station = self._cur.fetchone()
+        self._cur.execute(_STATION_BY_PLAYLIST_SELECT,(playlist_id,))
+        station = self._cur.fetchone()
 
-            if station == None:
-                raise LookupError
-            else:
-                id, name, addr, i_a, i_t, pl_id, active = station
-                station_dict = {}
-                station_dict['id'] = id
-                station_dict['name'] = name
-                station_dict['ignore_artists'] = i_a
-                station_dict['ignore_titles'] = i_t
-                station_dict['playlist_id'] = pl_id
-                station_dict['active'] = active
+        if station == None:
+            raise LookupError
+        else:
+            return _playlist_station_dict(station)
 
-                return station_dict
+    @_read_only
+    def search_tracks(self,title='',album='',artist='',video_id='',limit=100,offset=0):
+        '''
+        The frontend's /search. Tracks whose title, album, and artist
+        have the words given, best matches first, and whose video ID
+        starts with video_id. Uses the backend's full-text index (see
+        search_query in backends.py). Returns up to limit (track id,
+        track name, artist name, album name, youtube link) tuples.
+        '''
+        self._backend.check_fulltext(self._cur)
+        query,params = self._backend.search_query(_search_fields(title,album,artist),video_id,limit,offset)
+        self._cur.execute(query,params)
+        return self._cur.fetchall()
 
-    def __init__(self,user='root',password='password',host='127.0.0.1',initialize=False,config_file=None,connect=True):
+    @_read_only
+    def lookup_tracks_by_video(self,video):
+        '''
+        Find every track that uses a youtube video. video can be a link
+        or a bare ID. Returns (track id, track name, artist name,
+        album name, youtube link) tuples.
+        '''
+        video_id = get_video_id(video)
+        if video_id is None:
+            return []
+        
+        self._cur.execute(_TRACKS_BY_VIDEO_SELECT,(video_id,))
+        return self._cur.fetchall()
+
+    @_read_only
+    def get_video_ids(self,after_id=0,limit=1000):
+        '''
+        (track id, video ID) for up to limit tracks with a video, in
+        track id order starting after after_id. Pass the last track id
+        back in to get the next chunk.
+        '''
+        self._cur.execute(_VIDEO_IDS_SELECT,(after_id,limit))
+        return self._cur.fetchall()
+
+    @_read_only
+    def get_track_stats(self,track_ids):
+        '''
+        Play statistics for some tracks, from TrackStats and
+        TrackStationStats. Returns a dictionary of track ID to
+        {'play_count':..., 'last_play':..., 'stations':[(station name,
+        play count, last play), ...]} with the station that played it
+        most first. Tracks that have never been played are left out.
+
+        Until track_stats.py rebuild has filled the tables they're worked
+        out from the history instead.
+        '''
+        pending = self._rebuild_pending('track_stats')
+        stats = {}
+        for chunk in _chunks(set(track_ids),1000):
+            totals,by_station = _track_stats_queries(pending,len(chunk))
+            self._cur.execute(totals,chunk)
+            totals = self._cur.fetchall()
+            self._cur.execute(by_station,chunk)
+            _collect_track_stats(stats,totals,self._cur.fetchall())
+        return stats
+
+    def _rebuild_pending(self,name):
+        '''
+        True if a summary table hasn't been filled from the history yet
+        (see migrations.mark_rebuild_pending)
+        '''
+        if name in self._rebuilt:
+            return False
+        checked = self._pending_checked.get(name)
+        if checked is not None and monotonic() - checked < REBUILD_CHECK_INTERVAL:
+            return True
+        try:
+            self._cur.execute(_PENDING_REBUILD_SELECT,(name,))
+            pending = self._cur.fetchone()[0] > 0
+        except self._backend.Error:
+            # Migrated before there was a PendingRebuild table, back when
+            # the migrations filled the tables themselves
+            pending = False
+        if pending:
+            self._pending_checked[name] = monotonic()
+        else:
+            # It never goes back to pending
+            self._rebuilt.add(name)
+        return pending
+
+    def _rebuild_done(self,name):
+        self._cur.execute(_PENDING_REBUILD_DELETE,(name,))
+        self._conn.commit()
+        self._rebuilt.add(name)
+
+    def _track_id_ranges(self,chunk_size):
+        '''
+        [low, high) track ID ranges covering the whole Track table
+        '''
+        self._cur.execute('''SELECT MIN(Track.id), MAX(Track.id) FROM Track''')
+        first,last = self._cur.fetchone()
+        if first is None:
+            return []
+        return [(low,low+chunk_size) for low in range(first,last+1,chunk_size)]
+
+    @_writes
+    def rebuild_track_stats(self,chunk_size=10000,verbose=True):
+        '''
+        Work TrackStats and TrackStationStats out again from the whole
+        history, chunk_size track IDs at a time with a commit after each
+        chunk. Returns the number of tracks that have been played.
+        '''
+        pending = self._rebuild_pending('track_stats')
+        played = 0
+        for low,high in self._track_id_ranges(chunk_size):
+            for ii,statement in enumerate(_track_stats_refresh('track_id >= %s AND track_id < %s')):
+                self._cur.execute(statement,(low,high))
+                if ii == 2:
+                    played += self._cur.rowcount
+            self._conn.commit()
+            if verbose:
+                print('Up to track %d: %d played tracks'%(high-1,played))
+        if pending:
+            self._rebuild_done('track_stats')
+        return played
+
+    @_writes
+    def check_track_stats(self,chunk_size=10000,fix=False):
+        '''
+        Compare TrackStats and TrackStationStats with the history. Returns
+        a list of problems, empty if they agree. With fix the tracks that
+        are wrong are worked out again.
+        '''
+        def fetch(query,low,high):
+            self._cur.execute(query,(low,high))
+            return dict((tuple(row[:-2]),(row[-2],_as_datetime(row[-1]))) for row in self._cur.fetchall())
+
+        problems = []
+        for low,high in self._track_id_ranges(chunk_size):
+            wrong = set()
+            for table,columns in (('TrackStats','track_id'),('TrackStationStats','track_id, station_id')):
+                stored = fetch('SELECT ' + columns + ', play_count, last_play FROM ' + table +
+                               ' WHERE track_id >= %s AND track_id < %s',low,high)
+                actual = fetch('SELECT ' + columns + ''', COUNT(*), MAX(play_time) FROM Playlist
+                WHERE track_id >= %s AND track_id < %s GROUP BY ''' + columns,low,high)
+                for key in set(stored) | set(actual):
+                    if stored.get(key) != actual.get(key):
+                        problems.append('%s %s: stored %s, history says %s'%(table,key,stored.get(key),actual.get(key)))
+                        wrong.add(key[0])
+
+            if fix and wrong:
+                self._refresh_track_stats(wrong)
+                self._conn.commit()
+        return problems
+
+    @_writes
+    def rebuild_daily_plays(self,start=None,end=None,station=None,chunk_days=31,verbose=True):
+        '''
+        Work the daily rollups out again from the history for the days
+        from start up to (not including) end, one station and chunk_days
+        days at a time with a commit after each. Days whose plays were
+        purged by retention.py come back empty, so keep the range to
+        history that's still there.
+
+        Without start and end it's the whole history, and once that's
+        been done for every station the rollups are read from instead of
+        the history (see migrations.mark_rebuild_pending). Returns the
+        number of station days with plays.
+        '''
+        whole_history = start is None and end is None and station is None
+        pending = whole_history and self._rebuild_pending('daily_plays')
+
+        if start is None or end is None:
+            self._cur.execute('''SELECT MIN(Playlist.play_time), MAX(Playlist.play_time) FROM Playlist''')
+            first,last = self._cur.fetchone()
+            if first is None:
+                if pending:
+                    self._rebuild_done('daily_plays')
+                return 0
+            if start is None:
+                start = first
+            if end is None:
+                end = datetime.datetime.strptime(_day(last),'%Y-%m-%d') + datetime.timedelta(days=1)
+        start = datetime.datetime.strptime(_day(start),'%Y-%m-%d')
+        end = datetime.datetime.strptime(_day(end),'%Y-%m-%d')
+
+        if station is None:
+            self._cur.execute('''SELECT Station.id FROM Station ORDER BY Station.id''')
+            station_ids = [row[0] for row in self._cur.fetchall()]
+        else:
+            station_ids = [self._get_station_id_from_name(station)]
+
+        days = 0
+        for station_id in station_ids:
+            low = start
+            while low < end:
+                high = min(end,low + datetime.timedelta(days=chunk_days))
+                for ii,statement in enumerate(_daily_plays_refresh()):
+                    self._cur.execute(statement,(station_id,_day(low),_day(high)))
+                    if ii == 3:
+                        days += self._cur.rowcount
+                self._conn.commit()
+                low = high
+            if verbose:
+                print('Station %d: %d station days with plays so far'%(station_id,days))
+        if pending:
+            self._rebuild_done('daily_plays')
+        return days
+
+    def _daily_source(self,table,start,end,station):
+        '''
+        The module's _daily_source, for a station by name, from the
+        history while daily_plays.py rebuild is pending
+        '''
+        station_id = self._get_station_id_from_name(station) if station is not None else None
+        return _daily_source(table,start,end,station_id,self._rebuild_pending('daily_plays'))
+
+    @_read_only
+    def top_tracks(self,start,end,station=None,limit=50):
+        '''
+        The most played tracks from start up to (not including) end, on
+        one station or all of them. Returns (track ID, title, artist,
+        album, plays) tuples, most played first.
+        '''
+        source,where,params = self._daily_source('DailyTrackPlays',start,end,station)
+        self._cur.execute(*_top_tracks_query(source,where,params,limit))
+        return [tuple(row) for row in self._cur.fetchall()]
+
+    @_read_only
+    def top_artists(self,start,end,station=None,limit=50):
+        '''
+        Like top_tracks, for artists. Returns (artist ID, artist, plays)
+        tuples.
+        '''
+        source,where,params = self._daily_source('DailyArtistPlays',start,end,station)
+        self._cur.execute(*_top_artists_query(source,where,params,limit))
+        return [tuple(row) for row in self._cur.fetchall()]
+
+    def _trend(self,table,key_filter,key_params,start,end,station,granularity):
+        '''
+        The body of the *_trend functions. Sums play_count per day of
+        the rows of table matching key_filter and buckets them.
+        '''
+        period = _trend_period(granularity)
+
+        source,where,params = self._daily_source(table,start,end,station)
+        if key_filter:
+            where += ' AND ' + key_filter
+            params += key_params
+        self._cur.execute(_trend_query(table,source,where),params)
+        return _trend_counts(self._cur.fetchall(),start,end,period)
+
+    @_read_only
+    def station_trend(self,station,start,end,granularity='day'):
+        '''
+        Plays on a station per day, week (starting Monday), or month from
+        start up to (not including) end. Returns (first day of the
+        period, plays) tuples in order, including periods with no plays.
+        '''
+        return self._trend('DailyStationPlays','',[],start,end,station,granularity)
+
+    @_read_only
+    def track_trend(self,track_id,start,end,station=None,granularity='day'):
+        '''
+        Like station_trend, for one track on one station or all of them
+        '''
+        return self._trend('DailyTrackPlays','DailyTrackPlays.track_id = %s',[track_id],start,end,station,granularity)
+
+    @_read_only
+    def artist_trend(self,artist,start,end,station=None,granularity='day'):
+        '''
+        Like track_trend, for an artist by name
+        '''
+        self._cur.execute(_ARTIST_ID_SELECT,(artist,))
+        row = self._cur.fetchone()
+        if row is None:
+            raise LookupError('Artist: ' + str(artist) + ' could not be found.')
+        return self._trend('DailyArtistPlays','DailyArtistPlays.artist_id = %s',[row[0]],start,end,station,granularity)
+
+    @_writes
+    def set_track_youtube_link(self,track_id,youtube_link,commit=True):
+        '''
+        Point a track at a different youtube video
+        '''
+        youtube_link = make_short_link(youtube_link)
+        
+        self._cur.execute(_TRACK_LINK_UPDATE,_track_link_row(track_id,youtube_link))
+        
+        self.invalidate_id_cache(track_id=track_id)
+        if commit:
+            self._conn.commit()
+
+    @_read_only
+    def get_search_result(self,query,max_age,empty_max_age=None):
+        '''
+        The video IDs a youtube search for query (already normalized, see
+        search_cache.py) found, if it was searched for in the last max_age
+        seconds. Searches that found nothing only count for empty_max_age.
+        None if we don't have one. Hits aren't counted here, the caller
+        saves them up for record_search_hits.
+        '''
+        now = datetime.datetime.now()
+        self._cur.execute(_SEARCH_RESULT_SELECT,(query,_db_time(now - datetime.timedelta(seconds=max_age))))
+        return _search_result_ids(self._cur.fetchone(),now,empty_max_age)
+
+    @_writes
+    def record_search_hits(self,hits,commit=True):
+        '''
+        Count cache hits. hits is query -> (hits, datetime of the last one).
+        '''
+        for row in _search_hit_rows(hits):
+            self._cur.execute(_SEARCH_HITS_UPDATE,row)
+        if commit:
+            self._conn.commit()
+
+    @_writes
+    def put_search_result(self,query,video_ids,commit=True):
+        '''
+        Remember what a youtube search found (replacing anything older)
+        '''
+        now = _db_time(datetime.datetime.now())
+        self._cur.execute(_SEARCH_RESULT_UPSERT,(query,','.join(video_ids),now,now))
+        if commit:
+            self._conn.commit()
+
+    @_writes
+    def evict_search_results(self,max_age,max_entries=None,commit=True):
+        '''
+        Forget searches older than max_age seconds, then the least
+        recently used ones past max_entries. Returns how many went.
+        '''
+        cutoff = _db_time(datetime.datetime.now() - datetime.timedelta(seconds=max_age))
+        self._cur.execute(_SEARCH_EXPIRED_DELETE,(cutoff,))
+        removed = self._cur.rowcount
+
+        if max_entries is not None:
+            self._cur.execute(_SEARCH_LRU_CUTOFF_SELECT,(max_entries,))
+            row = self._cur.fetchone()
+            if row is not None:
+                self._cur.execute(_SEARCH_LRU_DELETE,(row[0],))
+                removed += self._cur.rowcount
+
+        if commit:
+            self._conn.commit()
+        return removed
+
+    @_writes
+    def add_station_ignore_rule(self,station_name,field,pattern,match_type=EXACT,commit=True):
+        '''
+        Ignore an artist or title on a station. field is 'artist' or
+        'title' and match_type is 'exact', 'casefold', or 'regex'.
+        Raises ValueError for a bad rule.
+        '''
+        check_rule(field,match_type,pattern)
+        
+        station_id = self._get_station_id_from_name(station_name)
+        self._cur.execute(_IGNORE_RULE_INSERT,(station_id,field,match_type,pattern))
+        
+        self._ignore_rules.pop(station_id,None)
+        if commit:
+            self._conn.commit()
+
+    @_writes
+    def remove_station_ignore_rule(self,station_name,field,pattern,match_type=EXACT,commit=True):
+        '''
+        Stop ignoring an artist or title on a station.
+        Returns True if there was a rule to remove.
+        '''
+        station_id = self._get_station_id_from_name(station_name)
+        self._cur.execute(_IGNORE_RULE_DELETE,(station_id,field,match_type,pattern))
+        removed = self._cur.rowcount > 0
+        
+        self._ignore_rules.pop(station_id,None)
+        if commit:
+            self._conn.commit()
+        
+        return removed
+
+    @_read_only
+    def get_station_ignore_rules(self,station_name):
+        '''
+        Return the compiled StationIgnoreRules for a station
+        '''
+        station_id = self._get_station_id_from_name(station_name)
+        return self._get_ignore_rules([station_id])[station_id]
+
+    def invalidate_id_cache(self,artist_id=None,album_id=None,track_id=None,station_id=None):
+        '''
+        Forget cached IDs after rows are changed or deleted by something
+        other than the _make_* functions (RemoveBadVideo.py, ReplaceVideoUrl.py,
+        the frontend's /replace). Forgetting an artist or album also forgets
+        everything under it. With no arguments the whole cache is cleared.
+        The song cache entries for those tracks go too.
+        '''
+        if artist_id is None and album_id is None and track_id is None and station_id is None:
+            self._id_cache.clear()
+            self._song_cache.clear()
+            return
+        
+        artist_id = None if artist_id is None else int(artist_id)
+        album_id = None if album_id is None else int(album_id)
+        track_id = None if track_id is None else int(track_id)
+        station_id = None if station_id is None else int(station_id)
+        
+        def stale(key,value):
+            kind = key[0]
+            if kind == 'artist':
+                return value == artist_id
+            elif kind == 'album':
+                return value == album_id or key[2] == artist_id
+            elif kind == 'track':
+                return value[0] == track_id or key[2] == album_id or key[3] == artist_id
+            elif kind == 'station':
+                return value == station_id
+            return False
+        
+        self._id_cache.invalidate_where(stale)
+        
+        # Song cache entries only know their track ID
+        if artist_id is not None or album_id is not None:
+            self._song_cache.clear()
+        elif track_id is not None:
+            self._song_cache.invalidate_where(lambda key,value: value[0] == track_id)
+
+    def id_cache_stats(self):
+        '''
+        Hit/miss counters for the artist/album/track/station ID cache
+        '''
+        return self._id_cache.stats()
+
+    def song_cache_stats(self):
+        '''
+        Hit/miss/eviction counters for the look_up_song_youtube cache
+        '''
+        return self._song_cache.stats()
+
+    def stats(self):
+        '''
+        Everything we count: per-statement query stats (see query_stats.py),
+        the caches, and the connection pool
+        '''
+        return {
+            'queries':self._query_stats.stats() if self._query_stats is not None else {},
+            'id_cache':self.id_cache_stats(),
+            'song_cache':self.song_cache_stats(),
+            'pool':self.pool_stats(),
+            'replicas':self.replica_stats(),
+        }
+
+    def metrics(self):
+        '''
+        stats() in Prometheus' text format, for the frontend's /metrics
+        '''
+        out = ''
+        if self._query_stats is not None:
+            out = self._query_stats.prometheus()
+        
+        out += _cache_metrics(self.id_cache_stats(),self.song_cache_stats())
+        
+        pool = self.pool_stats()
+        if pool is not None:
+            for name,kind in (('size','gauge'),('open','gauge'),('idle','gauge'),
+                              ('connects','counter'),('checkouts','counter'),('reconnects','counter')):
+                metric = 'playlistdb_pool_' + name + ('_total' if kind == 'counter' else '')
+                out += '# TYPE %s %s\n%s %d\n'%(metric,kind,metric,pool[name])
+        
+        replicas = self.replica_stats()
+        if replicas is not None:
+            for metric,key in (('playlistdb_replica_lag_seconds','lag'),('playlistdb_replica_in_rotation','in_rotation')):
+                out += '# TYPE ' + metric + ' gauge\n'
+                for host,state in replicas['replicas'].items():
+                    # -1 when it isn't replicating or can't be reached
+                    value = state[key] if state[key] is not None else -1
+                    out += '%s{host="%s"} %d\n'%(metric,host,value)
+            for name in ('picks','removals'):
+                metric = 'playlistdb_replica_' + name + '_total'
+                out += '# TYPE %s counter\n%s %d\n'%(metric,metric,replicas[name])
+        return out
+
+    def __init__(self,user='root',password='password',host='127.0.0.1',initialize=False,config_file=None,connect=True,database='PlaylistDB',id_cache_size=10000,
+                 pool_size=0,pool_max_lifetime=3600,pool_timeout=30,backend='mysql',path='PlaylistDB.sqlite',
+                 song_cache_size=10000,song_cache_ttl=600,song_cache_miss_ttl=60,
+                 query_stats=True,slow_query_ms=500,replicas=(),replica_max_lag=10,replica_check_interval=5):
+        
+        self._user = user
+        self._password = password
+        self._host = host
+        self._database = database
+        
+        # Every thread gets its own connection and cursor (see _conn)
+        self._local = local()
+        self._connect_on_use = False
+        # Summary tables known to be filled, and when the others were
+        # last seen pending, see _rebuild_pending
+        self._rebuilt = set()
+        self._pending_checked = {}
+        self._pool = None
         
         # Config contains the config file, an INI format
         config = ConfigParser()
         if config_file is not None:
             config.read(config_file)            
             # Use the values here instead of the available kwargs
-            self._user = config['database']['user']
-            self._password = config['database']['password']
-            self._host = config['database']['host']
+            self._user = config['database'].get('user',user)
+            self._password = config['database'].get('password',password)
+            self._host = config['database'].get('host',host)
+            self._database = config['database'].get('database',database)
+            backend = config['database'].get('backend',backend)
+            path = config['database'].get('path',path)
+            id_cache_size = config['database'].getint('id_cache_size',id_cache_size)
+            pool_size = config['database'].getint('pool_size',pool_size)
+            pool_max_lifetime = config['database'].getint('pool_max_lifetime',pool_max_lifetime)
+            pool_timeout = config['database'].getint('pool_timeout',pool_timeout)
+            song_cache_size = config['database'].getint('song_cache_size',song_cache_size)
+            song_cache_ttl = config['database'].getint('song_cache_ttl',song_cache_ttl)
+            song_cache_miss_ttl = config['database'].getint('song_cache_miss_ttl',song_cache_miss_ttl)
+            query_stats = config['database'].getboolean('query_stats',query_stats)
+            slow_query_ms = config['database'].getint('slow_query_ms',slow_query_ms)
+            replicas = [r.strip() for r in config['database'].get('replicas','').split(',') if r.strip()] or replicas
+            replica_max_lag = config['database'].getint('replica_max_lag',replica_max_lag)
+            replica_check_interval = config['database'].getint('replica_check_interval',replica_check_interval)
+        
+        # Name -> ID lookups for artists, albums, tracks, and stations.
+        # Stations repeat songs all day so most lookups hit.
+        self._id_cache = LRUCache(id_cache_size)
+        
+        # (artist, album, title) -> (track ID, youtube link), or (None, None)
+        # for songs we don't have. main.py asks for every new song it sees.
+        self._song_cache = LRUCache(song_cache_size,ttl=song_cache_ttl)
+        self._song_cache_miss_ttl = song_cache_miss_ttl
+        
+        # Counts and times every statement run through our cursors.
+        # A slow_query_ms of 0 turns the slow query log off.
+        self._query_stats = None
+        if query_stats:
+            self._query_stats = QueryStats(slow_query_ms/1000 if slow_query_ms > 0 else None)
         
 
-        self._conn = mysql.connect(user=self._user,password=self._password,host=self._host)
+        # MySQL or SQLite. Everything else here is written against the
+        # backend, in MySQL flavoured SQL that it translates if it has to.
+        self._backend = make_backend(backend,user=self._user,password=self._password,
+                                     host=self._host,database=self._database,path=path)
         
-        self._cur = self._conn.cursor()
+        # Read only functions go to these if there are any, see _read_only
+        self._replicas = None
+        if replicas:
+            if self._backend.name != 'mysql':
+                raise ValueError('Replicas need the MySQL backend')
+            self._replicas = ReplicaSet(replicas,lambda host: self._connect(host=host,autocommit=True),
+                                        self._backend.replication_lag,replica_max_lag,replica_check_interval)
+            # Long enough for any replica still in rotation to have caught up
+            self._read_your_writes = replica_max_lag + replica_check_interval
+        
+        self._conn,exists = self._backend.connect_initial()
+        
+        self._cur = self._new_cursor(self._conn)
         
         # Check if the DB exists
-        try:
-            self._cur.execute('USE PlaylistDB;')
-        except mysql.errors.ProgrammingError:
+        if not exists:
             print('The database does not exist. Initializing')
             initialize = True
     
-        # Lock on our public-facing functions
-        self._lock = RLock()
+        # Compiled ignore rules, by station ID
+        self._ignore_rules = {}
         
         if initialize:
             self._init_database_schema()
+        else:
+            self._backend.migrate(self._conn)
+        
+        # "with" blocks borrow from here instead of dialing MySQL every time.
+        # A pool_size of 0 keeps the old connect/close behaviour.
+        if pool_size > 0:
+            self._pool = ConnectionPool(self._connect,size=pool_size,
+                                        max_lifetime=pool_max_lifetime,
+                                        validate=self._validate_connection,
+                                        timeout=pool_timeout)
         
         if not connect:
             # Then close the connection because they will use "with" statements
             self._cur = None
             self._conn.close()
             self._conn = None
+        else:
+            # This thread keeps the connection we just made. Any other
+            # thread that calls us outside of a "with" gets its own.
+            self._connect_on_use = True
 
         #main()
 
+    #
+    # Connections and cursors belong to a thread. Nothing is shared
+    # between threads except the caches, which have their own locks,
+    # so threads never wait on each other here and a thread's writes
+    # are in its own transaction.
+    #
+
+    @property
+    def _conn(self):
+        if self._on_replica():
+            replica = self._replica()
+            if replica is not None:
+                return replica[1]
+        conn = getattr(self._local,'conn',None)
+        if conn is None and self._connect_on_use:
+            conn = self._local.conn = self._connect()
+            self._local.cur = self._new_cursor(conn)
+        return conn
+
+    @_conn.setter
+    def _conn(self,conn):
+        self._local.conn = conn
+
+    @property
+    def _cur(self):
+        if self._on_replica():
+            replica = self._replica()
+            if replica is not None:
+                return replica[2]
+        if getattr(self._local,'cur',None) is None:
+            # Opens this thread's connection if it needs one
+            self._conn
+        return getattr(self._local,'cur',None)
+
+    @_cur.setter
+    def _cur(self,cur):
+        self._local.cur = cur
+
+    #
+    # Replicas. A thread inside a _read_only function uses its own
+    # connection to a replica, picked round robin from the ones that
+    # aren't lagging. It's autocommit so every read sees the latest
+    # data the replica has. Writes, and reads soon after them, stay
+    # on the primary.
+    #
+
+    def _on_replica(self):
+        return (getattr(self._local,'reading',False) and not getattr(self._local,'primary',0)
+                and monotonic() >= getattr(self._local,'primary_until',0))
+
+    def _replica(self):
+        '''
+        (host, connection, cursor) for this thread's replica, or None if
+        none are in rotation
+        '''
+        replica = getattr(self._local,'replica',None)
+        if replica is not None and not self._replicas.usable(replica[0]):
+            self._close_replica()
+            replica = None
+        if replica is None:
+            host = self._replicas.pick()
+            if host is None:
+                return None
+            try:
+                conn = self._connect(host=host,autocommit=True)
+            except self._backend.Error:
+                self._replicas.mark_down(host)
+                return None
+            replica = self._local.replica = (host,conn,self._new_cursor(conn))
+        return replica
+
+    def _close_replica(self):
+        replica = getattr(self._local,'replica',None)
+        self._local.replica = None
+        if replica is not None:
+            try:
+                replica[1].close()
+            except self._backend.Error:
+                pass
+
+    def read_your_writes(self,seconds=None):
+        '''
+        Send this thread's reads to the primary for the next seconds, by
+        default long enough for any replica in rotation to have caught
+        up. Writes made through the public functions already do this.
+        Other threads keep reading from the replicas; a thread that needs
+        to see what another one wrote should use primary_reads().
+        '''
+        if self._replicas is None:
+            return
+        if seconds is None:
+            seconds = self._read_your_writes
+        self._local.primary_until = max(getattr(self._local,'primary_until',0),monotonic() + seconds)
+
+    @contextmanager
+    def primary_reads(self):
+        '''
+        Reads on this thread in the with block go to the primary
+        '''
+        self._local.primary = getattr(self._local,'primary',0) + 1
+        try:
+            yield
+        finally:
+            self._local.primary -= 1
+
+    def replica_stats(self):
+        '''
+        Lag and rotation of each replica, or None if there aren't any
+        '''
+        if self._replicas is None:
+            return None
+        stats = self._replicas.stats()
+        # For the calling thread
+        stats['primary_reads_for'] = max(0,getattr(self._local,'primary_until',0) - monotonic())
+        return stats
+
+    def _new_cursor(self,conn,streaming=False):
+        '''
+        A cursor on conn, instrumented if query stats are on
+        '''
+        if streaming:
+            cur = self._backend.streaming_cursor(conn)
+        else:
+            cur = conn.cursor()
+        if self._query_stats is not None:
+            cur = InstrumentedCursor(cur,self._query_stats)
+        return cur
+
+    def _connect(self,**kwargs):
+        '''
+        Open a new connection with our database already selected.
+        Any kwargs are passed on to the backend's driver.
+        '''
+        return self._backend.connect(**kwargs)
+
+    def _validate_connection(self,conn):
+        '''
+        Raises if the server has gone away (idle timeout, restart...)
+        '''
+        self._backend.validate(conn)
+
+    def pool_stats(self):
+        '''
+        Connection pool counters, or None if pooling is off
+        '''
+        if self._pool is None:
+            return None
+        return self._pool.stats()
+
+    def close(self):
+        '''
+        Close any pooled connections, and this thread's replica
+        connection
+        '''
+        if self._pool is not None:
+            self._pool.close()
+        if self._replicas is not None:
+            self._close_replica()
+            self._replicas.close()
 
     def __enter__(self):
-        self._conn = mysql.connect(user=self._user,password=self._password,host=self._host)
-        self._cur = self._conn.cursor()
-        self._cur.execute('USE PlaylistDB;')
+        # Put aside whatever this thread was using, for nested blocks
+        # and for the connection __init__ made
+        if not hasattr(self._local,'outer'):
+            self._local.outer = []
+        self._local.outer.append((getattr(self._local,'conn',None),getattr(self._local,'cur',None)))
+        
+        if self._pool is not None:
+            self._conn = self._pool.get()
+        else:
+            self._conn = self._connect()
+        self._cur = self._new_cursor(self._conn)
         
         return self._cur
 
     def __exit__(self,exc_type,exc_value,exc_traceback):
 
-        self._cur = None
-        self._conn.commit()
-        self._conn.close()
-        self._conn = None
+        conn = self._local.conn
+        self._conn,self._cur = self._local.outer.pop()
+        
+        # Without a connection of its own, a thread only reads from a
+        # replica inside the outermost block
+        if self._replicas is not None and not self._local.outer and not self._connect_on_use:
+            self._close_replica()
+        
+        if self._pool is None:
+            conn.commit()
+            conn.close()
+            return
+        
+        try:
+            conn.commit()
+        except self._backend.Error:
+            # Don't hand a dead connection to the next borrower
+            self._pool.put(conn,broken=True)
+            raise
+        self._pool.put(conn)
 
 
 if __name__ == '__main__':
@@ -1,17 +1,12 @@
 #!/usr/bin/env python3
 
 from PlaylistDatabase import PlaylistDatabase
+from youtube_links import get_youtube_id
 
 db = PlaylistDatabase(config_file='PlaylistDatabaseConfig.ini')
 
-video = input('Enter the video ID: ')
-if video.startswith('https://youtu.be/'):
-    pass
-elif video.startswith('https://www.youtube.com/watch?v='):
-    video.replace('https://www.youtube.com/watch?v=','https://youtu.be/')
-else:
-    video = 'https://youtu.be/'+video
-db._cur.execute('''SELECT Track.id, Track.track_name, Artist.artist_name, Album.album_name, Track.artist_id, Track.album_id, Track.youtube_link from Track JOIN Artist JOIN Album WHERE Track.youtube_link=%s AND Track.album_id=Album.id AND Track.artist_id=Artist.id''',(video,))
+video = get_youtube_id(input('Enter the video ID: '))
+db._cur.execute('''SELECT Track.id, Track.track_name, Artist.artist_name, Album.album_name, Track.artist_id, Track.album_id, Track.youtube_link from Track JOIN Artist JOIN Album WHERE Track.video_id=%s AND Track.album_id=Album.id AND Track.artist_id=Artist.id''',(video,))
 
 track = db._cur.fetchall()
 
@@ -38,35 +33,16 @@ yesorno = input('Do you want to delete this track and add it to the ignore lists
 
 if yesorno.lower()=='yes':
 
-    db._cur.execute('''SELECT Playlist.*,Station.* FROM Playlist JOIN Station WHERE Playlist.track_id=%s AND Playlist.station_id=Station.id''',(track_id,))
-    
-    stations = db._cur.fetchall()
+    db._cur.execute('''SELECT DISTINCT Station.station_name FROM Playlist JOIN Station WHERE Playlist.track_id=%s AND Playlist.station_id=Station.id''',(track_id,))
     
-    unique_station = {}
+    station_names = [s[0] for s in db._cur.fetchall()]
     
-    for s in stations:
-        playlist_entry_id, track_id, pl_station_id,playtime,station_id,station_name,station_url,ignore_artists,ignore_titles,playlist_url = s
-            
-        unique_station[station_id] = (station_name,station_url,ignore_artists,ignore_titles,playlist_url)
-        
-    print(unique_station)
+    print(station_names)
     
-    for id in unique_station:
-        exec('ignore_artists = ' + unique_station[id][2])
-        exec('ignore_titles = ' + unique_station[id][3])
-        if artist_name not in ignore_artists:
-            ignore_artists.append(artist_name)
-        if track_name not in ignore_titles:
-            ignore_titles.append(track_name)
-        unique_station[id] = unique_station[id][0],unique_station[id][1],str(ignore_artists),str(ignore_titles),unique_station[id][4]
-        db._cur.execute('''
-        UPDATE Station
-        SET ignore_artists=%s, ignore_titles=%s
-        WHERE Station.id=%s
-        ''',(str(ignore_artists),str(ignore_titles), id))
-        db._conn.commit()
-            
-    print(unique_station)
+    for station_name in station_names:
+        db.add_station_ignore_rule(station_name,'artist',artist_name,commit=False)
+        db.add_station_ignore_rule(station_name,'title',track_name,commit=False)
+    db._conn.commit()
     
     
     # Get all tracks with the matching artist id and album id
@@ -89,18 +65,13 @@ if yesorno.lower()=='yes':
     db._cur.execute('''DELETE FROM Artist WHERE Artist.id=%s''',(artist_id,))
     
     db._conn.commit()
+    db.invalidate_id_cache(artist_id=artist_id)
     #Tracks = db._cur.fetchall()
 else:
     yesorno = input('Do you want to update the youtube URL for this track? (yes/no): ')
     if yesorno.lower() == 'yes':
         url = input('Enter the new youtube url: ')
-        url = url.replace('https://www.youtube.com/watch?v=','https://youtu.be/')                        
-
-        db._cur.execute('''
-        UPDATE Track
-        SET youtube_link=%s
-        WHERE Track.id=%s
-        ''',(url,track_id))
-        db._conn.commit()
+
+        db.set_track_youtube_link(track_id,url)
     else:
         print('Not modifying database.')
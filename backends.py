@@ -0,0 +1,672 @@
+#!/usr/bin/env python3
+
+#
+# Storage backends for PlaylistDatabase.
+#
+# PlaylistDatabase writes its SQL in the MySQL dialect (%s parameters,
+# INSERT IGNORE, ON DUPLICATE KEY UPDATE). A backend knows how to connect,
+# how to create the schema, and how to turn those statements into
+# something its database understands.
+#
+# MySQLBackend - the original mysql.connector backend
+# SQLiteBackend - an embedded database file in WAL mode. No server and
+#                 no network round trips, for small nodes.
+#
+
+import re
+import sqlite3
+import datetime
+from time import monotonic
+from functools import lru_cache
+
+import migrations
+
+#
+# Track search. Each backend builds the frontend's search with its own
+# full-text index, these are the parts they share.
+#
+
+_SEARCH_WORD = re.compile(r'\w+')
+
+_SEARCH_SELECT = '''SELECT Track.id, Track.track_name, Artist.artist_name, Album.album_name, Track.youtube_link '''
+_SEARCH_JOINS = '''JOIN Artist ON Track.artist_id=Artist.id JOIN Album ON Track.album_id=Album.id '''
+
+def like_escape(s):
+    # '!' escapes the same way on MySQL and SQLite, '\\' doesn't
+    return s.replace('!','!!').replace('_','!_').replace('%','!%')
+
+def _search_words(value,indexable):
+    '''
+    Split what was typed in a search box into the words the full-text
+    index can find and the ones it can't (too short, stopwords...)
+    '''
+    indexed,other = [],[]
+    for word in _SEARCH_WORD.findall(value):
+        (indexed if indexable(word) else other).append(word)
+    if not indexed and not other:
+        # Only punctuation, look for it as it is
+        other.append(value)
+    return indexed,other
+
+def _search_filters(unindexed,video_id):
+    '''
+    Substring matches for the (column, word)s the index can't find,
+    and the video ID prefix. Returns (conditions, params).
+    '''
+    conditions = [column + " LIKE %s ESCAPE '!'" for column,word in unindexed]
+    params = ['%' + like_escape(word) + '%' for column,word in unindexed]
+    if video_id != '':
+        conditions.append("Track.video_id LIKE %s ESCAPE '!'")
+        params.append(like_escape(video_id) + '%')
+    return conditions,params
+
+def _where(conditions):
+    return 'WHERE ' + ' AND '.join(conditions) + ' ' if conditions else ''
+
+# The FULLTEXT indexes migration 4 adds
+FULLTEXT_INDEXES = (('Track','track_name_ft'),('Album','album_name_ft'),('Artist','artist_name_ft'))
+
+# How many of FULLTEXT_INDEXES are there, on MySQL
+FULLTEXT_CHECK = ('''SELECT COUNT(DISTINCT STATISTICS.TABLE_NAME, STATISTICS.INDEX_NAME) FROM information_schema.STATISTICS
+WHERE STATISTICS.TABLE_SCHEMA = DATABASE() AND (STATISTICS.TABLE_NAME, STATISTICS.INDEX_NAME) IN ('''
+                  + ','.join(['(%s,%s)']*len(FULLTEXT_INDEXES)) + ')',
+                  tuple(v for index in FULLTEXT_INDEXES for v in index))
+
+# How many foreign keys Playlist has on MySQL. A partitioned Playlist
+# has none, see retention.enable_partitioning.
+PLAYLIST_FOREIGN_KEY_CHECK = '''SELECT COUNT(*) FROM information_schema.REFERENTIAL_CONSTRAINTS
+WHERE CONSTRAINT_SCHEMA = DATABASE() AND TABLE_NAME = 'Playlist' '''
+
+# Seconds between FULLTEXT_CHECKs while the indexes are missing, so
+# search picks them up once migration 4 is run without a restart
+FULLTEXT_RECHECK_INTERVAL = 300
+
+# What InnoDB's FULLTEXT indexes leave out by default
+# (innodb_ft_min_token_size and the built in stopword list)
+FULLTEXT_MIN_WORD = 3
+FULLTEXT_STOPWORDS = frozenset(('a','about','an','are','as','at','be','by','com','de','en','for',
+                                'from','how','i','in','is','it','la','of','on','or','that','the',
+                                'this','to','was','what','when','where','who','will','with','und','www'))
+
+def mysql_search_query(fields,video_id,limit,offset,fulltext=True):
+    '''
+    The statement and parameters for PlaylistDatabase.search_tracks on
+    MySQL. fields is a list of (column, search string). Every word has
+    to start a word in its column, using the FULLTEXT indexes, and the
+    best matches come first. Words the index doesn't have fall back to a
+    substring match, and so does everything if fulltext is False (the
+    indexes aren't there).
+    '''
+    def indexable(word):
+        return fulltext and len(word) >= FULLTEXT_MIN_WORD and word.lower() not in FULLTEXT_STOPWORDS
+
+    matches,match_params,unindexed = [],[],[]
+    for column,value in fields:
+        indexed,other = _search_words(value,indexable)
+        if indexed:
+            matches.append('MATCH(' + column + ') AGAINST (%s IN BOOLEAN MODE)')
+            match_params.append(' '.join('+' + word + '*' for word in indexed))
+        unindexed += [(column,word) for word in other]
+
+    conditions,params = _search_filters(unindexed,video_id)
+    order = 'Track.id'
+    if matches:
+        # The same MATCH in the WHERE and ORDER BY is only run once
+        order = '(' + ' + '.join(matches) + ') DESC, Track.id'
+
+    query = (_SEARCH_SELECT + 'FROM Track ' + _SEARCH_JOINS + _where(matches + conditions) +
+             'ORDER BY ' + order + ' LIMIT %s OFFSET %s')
+    return query,tuple(match_params + params + match_params + [limit,offset])
+
+class MySQLBackend():
+
+    name = 'mysql'
+
+    def __init__(self,user='root',password='password',host='127.0.0.1',database='PlaylistDB',**kwargs):
+        # Only imported if it's used, so a SQLite node doesn't need it
+        import mysql.connector as mysql
+        from mysql.connector import errorcode
+
+        self._mysql = mysql
+        self._errorcode = errorcode
+        self.user = user
+        self.password = password
+        self.host = host
+        self.database = database
+
+        self.Error = mysql.errors.Error
+        self.IntegrityError = mysql.errors.IntegrityError
+
+        # Whether the FULLTEXT indexes are there and when that was
+        # checked, see check_fulltext
+        self.fulltext = True
+        self._fulltext_checked = None
+        # Whether Playlist's foreign keys are there, see migrate
+        self.playlist_foreign_keys = True
+
+    def connect(self,**kwargs):
+        '''
+        Open a new connection with our database already selected.
+        Any kwargs are passed on to mysql.connect, and host= picks a
+        server other than the primary (a replica).
+        '''
+        params = {'user':self.user,'password':self.password,'host':self.host,'database':self.database}
+        params.update(kwargs)
+        return self._mysql.connect(**params)
+
+    def connect_initial(self):
+        '''
+        Connect for PlaylistDatabase.__init__. Returns the connection
+        and whether the database exists yet.
+        '''
+        conn = self._mysql.connect(user=self.user,password=self.password,host=self.host)
+        cur = conn.cursor()
+        try:
+            cur.execute('USE ' + self.database + ';')
+        except self._mysql.errors.ProgrammingError:
+            return conn,False
+        return conn,True
+
+    def validate(self,conn):
+        '''
+        Raises if the server has gone away (idle timeout, restart...)
+        '''
+        conn.ping(reconnect=False)
+
+    def streaming_cursor(self,conn):
+        '''
+        A cursor that reads rows off the socket as they're fetched
+        instead of all at once
+        '''
+        return conn.cursor(buffered=False)
+
+    def replication_lag(self,conn):
+        '''
+        Seconds conn's server is behind its source, or None if it isn't
+        replicating (or the replication threads have stopped)
+        '''
+        cur = conn.cursor()
+        try:
+            cur.execute('SHOW REPLICA STATUS')
+        except self._mysql.errors.ProgrammingError:
+            # Before MySQL 8.0.22
+            cur.execute('SHOW SLAVE STATUS')
+        rows = cur.fetchall()
+        columns = [d[0] for d in cur.description] if cur.description else []
+        cur.close()
+        if not rows:
+            return None
+        # One row per replication channel, the default one is enough here
+        status = dict(zip(columns,rows[0]))
+        lag = status.get('Seconds_Behind_Source',status.get('Seconds_Behind_Master'))
+        return int(lag) if lag is not None else None
+
+    def is_missing_reference(self,e):
+        '''
+        True if an IntegrityError is a foreign key pointing at a row
+        that doesn't exist
+        '''
+        return e.errno == self._errorcode.ER_NO_REFERENCED_ROW_2
+
+    def migrate(self,conn):
+        applied = migrations.migrate_if_allowed(conn)
+        # The FULLTEXT migration is only run by hand, search with
+        # substring matches until it has been
+        cur = conn.cursor()
+        self.check_fulltext(cur,force=True)
+        cur.execute(PLAYLIST_FOREIGN_KEY_CHECK)
+        self.playlist_foreign_keys = cur.fetchone()[0] > 0
+        cur.close()
+        return applied
+
+    def check_fulltext(self,cur,force=False):
+        '''
+        Look for the FULLTEXT indexes again if they were missing more
+        than FULLTEXT_RECHECK_INTERVAL seconds ago (or if force).
+        Called before every search, it's free once they're there.
+        '''
+        if not force and (self.fulltext or monotonic() - self._fulltext_checked < FULLTEXT_RECHECK_INTERVAL):
+            return
+        cur.execute(*FULLTEXT_CHECK)
+        self.fulltext = cur.fetchone()[0] == len(FULLTEXT_INDEXES)
+        self._fulltext_checked = monotonic()
+
+    def search_query(self,fields,video_id,limit,offset):
+        '''
+        See mysql_search_query. Call check_fulltext first.
+        '''
+        return mysql_search_query(fields,video_id,limit,offset,self.fulltext)
+
+    def create_schema(self,conn):
+        '''
+        !!! ALL EXISTING DATA IS LOST WHEN USING THIS FUNCTION !!!
+        '''
+        cur = conn.cursor()
+        try:
+            cur.execute('drop database ' + self.database)
+        except self._mysql.errors.DatabaseError:
+            #print('No database exists.')
+            pass
+
+        cur.execute('create database ' + self.database)
+        cur.execute('use ' + self.database)
+
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS Artist (
+            id  INTEGER NOT NULL AUTO_INCREMENT UNIQUE,
+            artist_name VARCHAR(256) UNIQUE NOT NULL,
+
+            PRIMARY KEY (id),
+            KEY (artist_name)
+        )''')
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS Album (
+            id  INTEGER NOT NULL AUTO_INCREMENT UNIQUE,
+            album_name VARCHAR(256) NOT NULL,
+            artist_id  INTEGER NOT NULL,
+
+            PRIMARY KEY (id),
+            FOREIGN KEY (artist_id) REFERENCES Artist(id) ON UPDATE CASCADE,
+            UNIQUE(album_name,artist_id)
+        )''')
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS Track (
+            id  INTEGER NOT NULL AUTO_INCREMENT UNIQUE,
+            track_name VARCHAR(256) NOT NULL,
+            youtube_link TEXT,
+            filesystem_link TEXT,
+            album_id  INTEGER NOT NULL,
+            artist_id  INTEGER NOT NULL,
+
+            PRIMARY KEY (id),
+            FOREIGN KEY (album_id) REFERENCES Album(id)  ON UPDATE CASCADE,
+            FOREIGN KEY (artist_id) REFERENCES Artist(id) ON UPDATE CASCADE ,
+            KEY (track_name),
+            UNIQUE(track_name,album_id,artist_id)
+        )''')
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS Station (
+            id  INTEGER NOT NULL AUTO_INCREMENT UNIQUE,
+            station_name VARCHAR(256) NOT NULL UNIQUE,
+            web_address TEXT,
+            ignore_artists TEXT,
+            ignore_titles TEXT,
+            youtube_playlist_id TEXT,
+            active BOOL NOT NULL,
+
+            PRIMARY KEY (id),
+            KEY (station_name)
+        )''')
+
+        cur.execute('''CREATE TABLE IF NOT EXISTS Playlist (
+            id INTEGER NOT NULL AUTO_INCREMENT UNIQUE,
+            track_id INTEGER NOT NULL,
+            station_id INTEGER NOT NULL,
+            play_time DATETIME NOT NULL,
+
+            PRIMARY KEY (id),
+            KEY (station_id),
+            FOREIGN KEY (track_id) REFERENCES Track(id) ON UPDATE CASCADE,
+            FOREIGN KEY (station_id) REFERENCES Station(id) ON UPDATE CASCADE,
+            UNIQUE(track_id,station_id,play_time)
+        )''')
+
+        # Everything added since the original schema. The tables are
+        # empty so the manual migrations are quick.
+        migrations.migrate(conn,verbose=False,manual=True)
+        self.fulltext = True
+        self.playlist_foreign_keys = True
+
+#
+# SQLite
+#
+
+# MySQL statement -> SQLite statement rewrites. These only cover what
+# PlaylistDatabase and the frontend actually use.
+_ON_DUPLICATE = re.compile(r'ON\s+DUPLICATE\s+KEY\s+UPDATE',re.IGNORECASE)
+_VALUES_FUNC = re.compile(r'VALUES\s*\(\s*(\w+)\s*\)',re.IGNORECASE)
+_INSERT_IGNORE = re.compile(r'INSERT\s+IGNORE\s+INTO',re.IGNORECASE)
+_GREATEST = re.compile(r'\bGREATEST\s*\(',re.IGNORECASE)
+
+@lru_cache(maxsize=1024)
+def translate(query):
+    '''
+    Rewrite a MySQL dialect statement for SQLite
+    '''
+    query = _INSERT_IGNORE.sub('INSERT OR IGNORE INTO',query)
+    # SQLite's max() with more than one argument is GREATEST
+    query = _GREATEST.sub('MAX(',query)
+
+    parts = _ON_DUPLICATE.split(query,maxsplit=1)
+    if len(parts) == 2:
+        # VALUES(col) only means "the new value" after ON DUPLICATE KEY UPDATE
+        query = parts[0] + 'ON CONFLICT DO UPDATE SET' + _VALUES_FUNC.sub(r'excluded.\1',parts[1])
+
+    return query.replace('%s','?')
+
+def _convert_datetime(value):
+    return datetime.datetime.fromisoformat(value.decode())
+
+class SQLiteCursor():
+    '''
+    A sqlite3 cursor that takes MySQL dialect statements
+    '''
+
+    def __init__(self,cursor):
+        self._cursor = cursor
+
+    def execute(self,query,params=()):
+        return self._cursor.execute(translate(query),params)
+
+    def executemany(self,query,seq_of_params):
+        return self._cursor.executemany(translate(query),seq_of_params)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self,name):
+        return getattr(self._cursor,name)
+
+class SQLiteConnection():
+    '''
+    Just enough of a mysql.connector connection for PlaylistDatabase
+    '''
+
+    def __init__(self,conn):
+        self._conn = conn
+
+    def cursor(self,**kwargs):
+        return SQLiteCursor(self._conn.cursor())
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        self._conn.close()
+
+class SQLiteBackend():
+
+    name = 'sqlite'
+
+    Error = sqlite3.Error
+    IntegrityError = sqlite3.IntegrityError
+
+    # Playlist is never partitioned here
+    playlist_foreign_keys = True
+
+    def __init__(self,path='PlaylistDB.sqlite',busy_timeout=30,**kwargs):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        sqlite3.register_converter('DATETIME',_convert_datetime)
+
+    def connect(self,**kwargs):
+        conn = sqlite3.connect(self.path,timeout=self.busy_timeout,
+                               detect_types=sqlite3.PARSE_DECLTYPES,
+                               check_same_thread=False)
+        # WAL lets readers carry on while we write, and NORMAL sync is
+        # safe in WAL mode (a power cut can only lose the last commits)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA foreign_keys=ON')
+        return SQLiteConnection(conn)
+
+    def connect_initial(self):
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute('''SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='Station' ''')
+        return conn,cur.fetchone()[0] > 0
+
+    def validate(self,conn):
+        # Nothing to go stale
+        pass
+
+    def streaming_cursor(self,conn):
+        # sqlite3 cursors already step through results as they're fetched
+        return conn.cursor()
+
+    def is_missing_reference(self,e):
+        return 'FOREIGN KEY' in str(e)
+
+    def check_fulltext(self,cur,force=False):
+        # TrackSearch is part of the schema
+        pass
+
+    def search_query(self,fields,video_id,limit,offset):
+        '''
+        MySQLBackend.search_query on the TrackSearch FTS5 table. Its
+        trigram tokenizer finds any substring of three or more
+        characters, so words don't have to be whole. Ranked by bm25.
+        '''
+        phrases,unindexed = [],[]
+        for column,value in fields:
+            indexed,other = _search_words(value,lambda word: len(word) >= 3)
+            # Words are only \w characters, so they never need quoting
+            phrases += [column.split('.')[1] + ' : "' + word + '"' for word in indexed]
+            unindexed += [(column,word) for word in other]
+
+        conditions,params = _search_filters(unindexed,video_id)
+        if not phrases:
+            query = (_SEARCH_SELECT + 'FROM Track ' + _SEARCH_JOINS + _where(conditions) +
+                     'ORDER BY Track.id LIMIT %s OFFSET %s')
+            return query,tuple(params + [limit,offset])
+
+        query = (_SEARCH_SELECT + 'FROM TrackSearch JOIN Track ON Track.id=TrackSearch.rowid ' + _SEARCH_JOINS +
+                 _where(['TrackSearch MATCH %s'] + conditions) +
+                 'ORDER BY TrackSearch.rank, Track.id LIMIT %s OFFSET %s')
+        return query,tuple([' AND '.join(phrases)] + params + [limit,offset])
+
+    def migrate(self,conn):
+        '''
+        The schema is created at the latest version, so there's nothing
+        to do until a migration needs a SQLite version.
+        '''
+        cur = conn.cursor()
+        cur.execute('''SELECT MAX(SchemaVersion.version) FROM SchemaVersion''')
+        version = cur.fetchone()[0] or 0
+        pending = [v for v in SQLITE_MIGRATIONS if v > version]
+        for v in sorted(pending):
+            print('Applying schema migration ' + str(v))
+            SQLITE_MIGRATIONS[v](cur)
+            cur.execute('''INSERT INTO SchemaVersion(version,name,applied) VALUES (%s, %s, %s)''',
+                        (v,'sqlite',datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            conn.commit()
+        return pending
+
+    def create_schema(self,conn):
+        '''
+        !!! ALL EXISTING DATA IS LOST WHEN USING THIS FUNCTION !!!
+
+        Creates the schema as of the latest migration. Names compare
+        case-insensitively, like they do with MySQL's default collation.
+        '''
+        cur = conn.cursor()
+        cur.execute('PRAGMA foreign_keys=OFF')
+        for table in ('PendingRebuild','SearchCache','DailyArtistPlays','DailyTrackPlays','DailyStationPlays','TrackSearch','TrackStationStats','TrackStats','StationIgnoreRule','Playlist','Track','Album','Station','Artist','SchemaVersion'):
+            cur.execute('DROP TABLE IF EXISTS ' + table)
+        cur.execute('PRAGMA foreign_keys=ON')
+
+        cur.execute('''CREATE TABLE Artist (
+            id  INTEGER NOT NULL,
+            artist_name VARCHAR(256) COLLATE NOCASE UNIQUE NOT NULL,
+
+            PRIMARY KEY (id)
+        )''')
+
+        cur.execute('''CREATE TABLE Album (
+            id  INTEGER NOT NULL,
+            album_name VARCHAR(256) COLLATE NOCASE NOT NULL,
+            artist_id  INTEGER NOT NULL,
+
+            PRIMARY KEY (id),
+            FOREIGN KEY (artist_id) REFERENCES Artist(id) ON UPDATE CASCADE,
+            UNIQUE(album_name,artist_id)
+        )''')
+
+        cur.execute('''CREATE TABLE Track (
+            id  INTEGER NOT NULL,
+            track_name VARCHAR(256) COLLATE NOCASE NOT NULL,
+            youtube_link TEXT,
+            filesystem_link TEXT,
+            album_id  INTEGER NOT NULL,
+            artist_id  INTEGER NOT NULL,
+            video_id CHAR(11),
+
+            PRIMARY KEY (id),
+            FOREIGN KEY (album_id) REFERENCES Album(id) ON UPDATE CASCADE,
+            FOREIGN KEY (artist_id) REFERENCES Artist(id) ON UPDATE CASCADE,
+            UNIQUE(track_name,album_id,artist_id)
+        )''')
+        cur.execute('CREATE INDEX Track_track_name ON Track(track_name)')
+        cur.execute('CREATE INDEX Track_video_id ON Track(video_id)')
+
+        cur.execute('''CREATE TABLE Station (
+            id  INTEGER NOT NULL,
+            station_name VARCHAR(256) COLLATE NOCASE NOT NULL UNIQUE,
+            web_address TEXT,
+            ignore_artists TEXT,
+            ignore_titles TEXT,
+            youtube_playlist_id TEXT,
+            active BOOL NOT NULL,
+
+            PRIMARY KEY (id)
+        )''')
+
+        cur.execute('''CREATE TABLE Playlist (
+            id INTEGER NOT NULL,
+            track_id INTEGER NOT NULL,
+            station_id INTEGER NOT NULL,
+            play_time DATETIME NOT NULL,
+
+            PRIMARY KEY (id),
+            FOREIGN KEY (track_id) REFERENCES Track(id) ON UPDATE CASCADE,
+            FOREIGN KEY (station_id) REFERENCES Station(id) ON UPDATE CASCADE,
+            UNIQUE(track_id,station_id,play_time)
+        )''')
+        cur.execute('CREATE INDEX Playlist_station_play_time ON Playlist(station_id,play_time)')
+
+        cur.execute('''CREATE TABLE StationIgnoreRule (
+            id  INTEGER NOT NULL,
+            station_id INTEGER NOT NULL,
+            field VARCHAR(16) NOT NULL,
+            match_type VARCHAR(16) NOT NULL,
+            pattern VARCHAR(256) NOT NULL,
+
+            PRIMARY KEY (id),
+            FOREIGN KEY (station_id) REFERENCES Station(id) ON UPDATE CASCADE,
+            UNIQUE(station_id,field,match_type,pattern)
+        )''')
+
+        _sqlite_track_search(cur)
+        migrations._track_stats(cur)
+        _sqlite_daily_plays(cur)
+        _sqlite_search_cache(cur)
+
+        migrations.create_version_table(cur)
+        now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        cur.executemany('''INSERT INTO SchemaVersion(version,name,applied) VALUES (%s, %s, %s)''',
+                        [(version,name,now) for version,name,func in migrations.MIGRATIONS])
+        conn.commit()
+
+def _sqlite_track_search(cur):
+    '''
+    The full-text index for search_query: an FTS5 table with a row per
+    track, kept up to date by triggers on Track, Album, and Artist.
+    '''
+    cur.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS TrackSearch
+        USING fts5(track_name, album_name, artist_name, tokenize='trigram')''')
+
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS Track_search_insert AFTER INSERT ON Track BEGIN
+        INSERT INTO TrackSearch(rowid,track_name,album_name,artist_name) VALUES (new.id, new.track_name,
+            (SELECT Album.album_name FROM Album WHERE Album.id = new.album_id),
+            (SELECT Artist.artist_name FROM Artist WHERE Artist.id = new.artist_id));
+    END''')
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS Track_search_update AFTER UPDATE OF track_name, album_id, artist_id ON Track BEGIN
+        UPDATE TrackSearch SET track_name = new.track_name,
+            album_name = (SELECT Album.album_name FROM Album WHERE Album.id = new.album_id),
+            artist_name = (SELECT Artist.artist_name FROM Artist WHERE Artist.id = new.artist_id)
+        WHERE rowid = new.id;
+    END''')
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS Track_search_delete AFTER DELETE ON Track BEGIN
+        DELETE FROM TrackSearch WHERE rowid = old.id;
+    END''')
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS Album_search_update AFTER UPDATE OF album_name ON Album BEGIN
+        UPDATE TrackSearch SET album_name = new.album_name
+        WHERE rowid IN (SELECT Track.id FROM Track WHERE Track.album_id = new.id);
+    END''')
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS Artist_search_update AFTER UPDATE OF artist_name ON Artist BEGIN
+        UPDATE TrackSearch SET artist_name = new.artist_name
+        WHERE rowid IN (SELECT Track.id FROM Track WHERE Track.artist_id = new.id);
+    END''')
+
+    # Tracks from before the index
+    cur.execute('''DELETE FROM TrackSearch''')
+    cur.execute('''INSERT INTO TrackSearch(rowid,track_name,album_name,artist_name)
+        SELECT Track.id, Track.track_name, Album.album_name, Artist.artist_name
+        FROM Track JOIN Album ON Track.album_id=Album.id JOIN Artist ON Track.artist_id=Artist.id''')
+
+def _sqlite_daily_plays(cur):
+    '''
+    migrations._daily_plays, with the secondary indexes made separately
+    '''
+    cur.execute('''CREATE TABLE IF NOT EXISTS DailyStationPlays (
+        station_id INTEGER NOT NULL,
+        day DATE NOT NULL,
+        play_count INTEGER NOT NULL,
+
+        PRIMARY KEY (station_id,day),
+        FOREIGN KEY (station_id) REFERENCES Station(id) ON UPDATE CASCADE ON DELETE CASCADE
+    )''')
+    for table,column,reference in (('DailyTrackPlays','track_id','Track'),('DailyArtistPlays','artist_id','Artist')):
+        cur.execute('''CREATE TABLE IF NOT EXISTS ''' + table + ''' (
+            station_id INTEGER NOT NULL,
+            day DATE NOT NULL,
+            ''' + column + ''' INTEGER NOT NULL,
+            play_count INTEGER NOT NULL,
+
+            PRIMARY KEY (station_id,day,''' + column + '''),
+            FOREIGN KEY (station_id) REFERENCES Station(id) ON UPDATE CASCADE ON DELETE CASCADE,
+            FOREIGN KEY (''' + column + ''') REFERENCES ''' + reference + '''(id) ON UPDATE CASCADE ON DELETE CASCADE
+        )''')
+        cur.execute('CREATE INDEX IF NOT EXISTS ' + table + '_' + column + '_day ON ' + table + '(' + column + ',day)')
+        cur.execute('CREATE INDEX IF NOT EXISTS ' + table + '_day ON ' + table + '(day,' + column + ',play_count)')
+
+    migrations.mark_rebuild_pending(cur,'daily_plays','python3 daily_plays.py rebuild')
+
+def _sqlite_search_cache(cur):
+    '''
+    migrations._search_cache, with the secondary indexes made separately
+    '''
+    cur.execute('''CREATE TABLE IF NOT EXISTS SearchCache (
+        query VARCHAR(255) NOT NULL,
+        video_ids VARCHAR(600) NOT NULL,
+        searched_at DATETIME NOT NULL,
+        last_used DATETIME NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0,
+
+        PRIMARY KEY (query)
+    )''')
+    cur.execute('CREATE INDEX IF NOT EXISTS SearchCache_searched_at ON SearchCache(searched_at)')
+    cur.execute('CREATE INDEX IF NOT EXISTS SearchCache_last_used ON SearchCache(last_used)')
+
+# Migrations added after the SQLite backend, by version. Every MySQL
+# migration added to migrations.MIGRATIONS from here on needs one.
+SQLITE_MIGRATIONS = {
+    4:_sqlite_track_search,
+    # Plain SQL that works the same on both
+    5:migrations._track_stats,
+    6:_sqlite_daily_plays,
+    7:_sqlite_search_cache,
+}
+
+BACKENDS = {
+    'mysql':MySQLBackend,
+    'sqlite':SQLiteBackend,
+}
+
+def make_backend(name,**kwargs):
+    if name not in BACKENDS:
+        raise ValueError('Unknown database backend ' + repr(name) + ', use one of ' + str(sorted(BACKENDS)))
+    return BACKENDS[name](**kwargs)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+#
+# Fill in Track.video_id for tracks added before the column existed.
+#
+# Works through the Track table in id order, a chunk at a time, with a
+# commit after every chunk. It only looks at rows where video_id is
+# still NULL so it can be stopped and started again at any point.
+#
+#   python3 backfill_video_ids.py --config PlaylistDatabaseConfig.ini
+#
+
+import argparse
+from time import sleep, perf_counter
+
+from PlaylistDatabase import PlaylistDatabase
+from youtube_links import get_video_id
+
+def backfill(db,chunk_size=1000,pause=0.0,verbose=True):
+    '''
+    Parse the video ID out of every track's youtube_link.
+    Returns (rows looked at, rows updated).
+    '''
+    last_id = 0
+    seen = 0
+    updated = 0
+    t0 = perf_counter()
+
+    while True:
+        db._cur.execute('''SELECT Track.id, Track.youtube_link FROM Track
+        WHERE Track.id > %s AND Track.video_id IS NULL
+        ORDER BY Track.id LIMIT %s''',(last_id,chunk_size))
+        rows = db._cur.fetchall()
+        if not rows:
+            break
+
+        last_id = rows[-1][0]
+        seen += len(rows)
+
+        # Links we can't parse stay NULL
+        ids = [(track_id,get_video_id(link)) for track_id,link in rows]
+        ids = [(track_id,video_id) for track_id,video_id in ids if video_id is not None]
+
+        if ids:
+            # One UPDATE for the whole chunk
+            db._cur.execute('''UPDATE Track SET video_id = CASE Track.id ''' +
+                ' '.join(['WHEN %s THEN %s']*len(ids)) +
+                ''' END WHERE Track.id IN (''' + ','.join(['%s']*len(ids)) + ')',
+                [v for pair in ids for v in pair] + [track_id for track_id,video_id in ids])
+            updated += len(ids)
+        db._conn.commit()
+
+        if verbose:
+            print('Up to track %d: %d looked at, %d updated (%.0f rows/s)'%(last_id,seen,updated,seen/(perf_counter()-t0)))
+
+        # Give the poller a chance at the table
+        if pause:
+            sleep(pause)
+
+    return seen,updated
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fill in Track.video_id from Track.youtube_link')
+    parser.add_argument('--config',help='Config file with the [database] credentials',default='PlaylistDatabaseConfig.ini')
+    parser.add_argument('--chunk-size',type=int,default=1000)
+    parser.add_argument('--pause',type=float,default=0.0,help='Seconds to wait between chunks')
+    args = parser.parse_args()
+
+    db = PlaylistDatabase(config_file=args.config)
+    seen,updated = backfill(db,args.chunk_size,args.pause)
+    print('Done. %d tracks looked at, %d updated.'%(seen,updated))
@@ -0,0 +1,1301 @@
+#!/usr/bin/env python3
+
+#
+# Benchmarks for the playlist database.
+#
+# These run against a scratch database (PlaylistDB_bench by default,
+# or PlaylistDB_bench.sqlite with --backend sqlite) which is dropped and
+# re-created every run. Never point this at the database your poller uses.
+#
+# Example:
+#   python3 benchmark.py --config PlaylistDatabaseConfig.ini ingest --plays 5000
+#   python3 benchmark.py --backend sqlite ingest --plays 5000
+#   python3 benchmark.py --backend sqlite suite --scale small --output before.json
+#   python3 benchmark.py compare before.json after.json
+#
+
+import os
+import sys
+import json
+import random
+import asyncio
+import threading
+import argparse
+import datetime
+import platform
+import subprocess
+import tracemalloc
+from time import perf_counter, sleep
+from bisect import bisect
+from configparser import ConfigParser
+
+from PlaylistDatabase import PlaylistDatabase, _chunks
+from workload import Workload, SCALES
+import retention
+
+
+def make_database(args,backend=None,**kwargs):
+    '''
+    Connect to (and wipe) the scratch database. Any kwargs go
+    to PlaylistDatabase.
+    '''
+    kwargs.update({'database':args.database,'initialize':True,
+                   'backend':backend or args.backend,'path':args.path})
+    if args.config is not None:
+        config = ConfigParser()
+        config.read(args.config)
+        kwargs['user'] = config['database']['user']
+        kwargs['password'] = config['database']['password']
+        kwargs['host'] = config['database']['host']
+
+    return PlaylistDatabase(**kwargs)
+
+def make_stations(db,num_stations):
+    names = []
+    for ii in range(num_stations):
+        name = 'BenchStation'+str(ii)
+        db.create_station(name,name+'.Site',[],[],name+'.Playlist')
+        names.append(name)
+    return names
+
+def make_plays(station_names,num_plays,num_tracks,start=None):
+    '''
+    Make some synthetic plays. Tracks repeat so the artist/album/track
+    lookups see both new and existing rows.
+    '''
+    if start is None:
+        start = datetime.datetime(2017,1,1)
+
+    plays = []
+    for ii in range(num_plays):
+        t = ii % num_tracks
+        plays.append((
+            station_names[ii % len(station_names)],
+            'BenchArtist'+str(t % 500),
+            'BenchAlbum'+str(t % 2000),
+            'BenchTrack'+str(t),
+            start + datetime.timedelta(seconds=ii),
+            'https://youtu.be/'+str(t).zfill(11),
+        ))
+    return plays
+
+def report(name,count,seconds):
+    print('%-24s %8d rows %8.3f s %10.1f rows/s'%(name,count,seconds,count/seconds))
+
+class CountingCursor():
+    '''
+    Wraps a cursor and counts the statements run through it
+    '''
+    def __init__(self,cursor):
+        self._cursor = cursor
+        self.count = 0
+
+    def execute(self,*args,**kwargs):
+        self.count += 1
+        return self._cursor.execute(*args,**kwargs)
+
+    def executemany(self,*args,**kwargs):
+        self.count += 1
+        return self._cursor.executemany(*args,**kwargs)
+
+    def __getattr__(self,name):
+        return getattr(self._cursor,name)
+
+def count_queries(db,func,*args,**kwargs):
+    '''
+    Run func and return (seconds, number of statements, result)
+    '''
+    cursor = db._cur
+    db._cur = CountingCursor(cursor)
+    try:
+        t0 = perf_counter()
+        result = func(*args,**kwargs)
+        seconds = perf_counter()-t0
+        count = db._cur.count
+    finally:
+        db._cur = cursor
+    return seconds,count,result
+
+def legacy_get_station_data(db):
+    '''
+    How get_station_data used to work: read the stations, then one
+    latest-track lookup (two queries) per station.
+    '''
+    out = []
+    for s in db._get_all_stations():
+        try:
+            out.append(db.get_latest_station_tracks(s[1]))
+        except IndexError:
+            out.append(None)
+    return out
+
+def legacy_search_tracks(db,title='',album='',artist=''):
+    '''
+    How the frontend's search used to work: a LIKE '%...%' on every
+    name, which has to scan the whole catalog
+    '''
+    db._cur.execute('''SELECT Track.id, Track.track_name, Artist.artist_name, Album.album_name, Track.youtube_link from Track JOIN Artist JOIN Album WHERE Track.track_name LIKE %s AND Album.album_name LIKE %s AND Artist.artist_name LIKE %s AND Track.album_id=Album.id AND Track.artist_id=Artist.id''',
+                    ('%'+title+'%','%'+album+'%','%'+artist+'%'))
+    return db._cur.fetchall()
+
+def bench_stations(args):
+    db = make_database(args)
+
+    made = 0
+    for num_stations in args.counts:
+        # Grow the station list up to this size. Each station gets some history.
+        new_stations = []
+        for ii in range(made,num_stations):
+            name = 'BenchStation'+str(ii)
+            db.create_station(name,name+'.Site',[],[],name+'.Playlist')
+            new_stations.append(name)
+        made = num_stations
+        if new_stations:
+            db.add_tracks_to_station_playlist_batch(make_plays(new_stations,len(new_stations)*args.plays,args.tracks))
+
+        # Don't let the ID cache hide the station lookups
+        db.invalidate_id_cache()
+        seconds,count,result = count_queries(db,legacy_get_station_data,db)
+        print('%6d stations  N+1:        %6d queries %8.1f ms'%(num_stations,count,seconds*1000))
+        seconds,count,result = count_queries(db,db.get_station_data)
+        print('%6d stations  one query:  %6d queries %8.1f ms'%(num_stations,count,seconds*1000))
+        seconds,count,result = count_queries(db,db.get_station_data,stations_only=True)
+        print('%6d stations  stations only: %3d queries %8.1f ms'%(num_stations,count,seconds*1000))
+
+def peak_memory(func,*args,**kwargs):
+    '''
+    Run func and return (seconds, peak bytes allocated by Python, result)
+    '''
+    tracemalloc.start()
+    try:
+        t0 = perf_counter()
+        result = func(*args,**kwargs)
+        seconds = perf_counter()-t0
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds,peak,result
+
+def bench_export(args):
+    from export_history import write_csv
+
+    db = make_database(args)
+    station = make_stations(db,1)
+
+    made = 0
+    start = datetime.datetime(2017,1,1)
+    for num_plays in args.counts:
+        db.add_tracks_to_station_playlist_batch(
+            make_plays(station,num_plays-made,args.tracks,start=start+datetime.timedelta(seconds=made)))
+        made = num_plays
+
+        with open(os.devnull,'w') as out:
+            seconds,peak,count = peak_memory(lambda: write_csv(db.iter_station_history(station[0]),out))
+        print('%9d plays  streaming: %8.3f s  peak %8.1f KiB'%(count,seconds,peak/1024))
+
+        seconds,peak,tracks = peak_memory(db.get_latest_station_tracks,station[0],num_plays)
+        print('%9d plays  fetchall:  %8.3f s  peak %8.1f KiB'%(len(tracks),seconds,peak/1024))
+
+def bench_ingest(args):
+    db = make_database(args)
+    stations = make_stations(db,args.stations)
+
+    # Per-row path. Commit once at the end so we only measure round trips.
+    plays = make_plays(stations,args.plays,args.tracks)
+    t0 = perf_counter()
+    for p in plays:
+        db.add_track_to_station_playlist(*p,commit=False)
+    db._conn.commit()
+    report('add_track (per row)',len(plays),perf_counter()-t0)
+
+    # Batched path. Use later play times so none of these are duplicates.
+    plays = make_plays(stations,args.plays,args.tracks,start=datetime.datetime(2018,1,1))
+    t0 = perf_counter()
+    added = db.add_tracks_to_station_playlist_batch(plays,batch_size=args.batch_size)
+    report('add_tracks (batch)',added,perf_counter()-t0)
+
+def bench_backends(args):
+    '''
+    The same ingest and read workload on each backend
+    '''
+    plays_per_station = args.plays // args.stations
+    for backend in args.backends:
+        db = make_database(args,backend)
+        stations = make_stations(db,args.stations)
+        print(backend)
+
+        plays = make_plays(stations,args.plays,args.tracks)
+        t0 = perf_counter()
+        for p in plays[:args.single]:
+            db.add_track_to_station_playlist(*p)
+        report('  add_track (per row)',args.single,perf_counter()-t0)
+
+        t0 = perf_counter()
+        added = db.add_tracks_to_station_playlist_batch(plays[args.single:])
+        report('  add_tracks (batch)',added,perf_counter()-t0)
+
+        t0 = perf_counter()
+        for ii in range(args.queries):
+            db.get_latest_station_tracks(stations[ii % len(stations)],10)
+        report('  latest tracks',args.queries,perf_counter()-t0)
+
+        t0 = perf_counter()
+        for ii in range(args.queries):
+            t = ii % args.tracks
+            db.look_up_song_youtube('BenchArtist'+str(t % 500),'BenchAlbum'+str(t % 2000),'BenchTrack'+str(t))
+        report('  youtube lookups',args.queries,perf_counter()-t0)
+
+        t0 = perf_counter()
+        for ii in range(args.queries // 10):
+            db.get_station_data()
+        report('  get_station_data',args.queries // 10,perf_counter()-t0)
+
+        t0 = perf_counter()
+        count = sum(1 for row in db.iter_station_history(stations[0]))
+        report('  history (%d/station)'%(plays_per_station,),count,perf_counter()-t0)
+        db.close()
+
+def _poll_plays(stations,cycle,tracks):
+    '''
+    One new play per station for a simulated poll cycle
+    '''
+    start = datetime.datetime(2017,1,1) + datetime.timedelta(hours=cycle)
+    return make_plays(stations,len(stations),tracks,start=start+datetime.timedelta(minutes=cycle))
+
+def serial_cycle(db,plays,latency):
+    '''
+    main.py's loop: one station after another under PlaylistDatabase's lock
+    '''
+    stations = db.get_station_data()
+    for channel_dict,play in zip(stations,plays):
+        sleep(latency) # the scrape
+        try:
+            db.look_up_song_youtube(play[1],play[2],play[3])
+        except LookupError:
+            pass
+        db.add_track_to_station_playlist(*play)
+
+async def async_cycle(db,plays,latency,concurrency):
+    '''
+    main_async.py's loop: every station at once
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def update(play):
+        async with semaphore:
+            await asyncio.sleep(latency)
+            try:
+                await db.look_up_song_youtube(play[1],play[2],play[3])
+            except LookupError:
+                pass
+            await db.add_track_to_station_playlist(*play)
+
+    await db.get_station_data()
+    await asyncio.gather(*[update(p) for p in plays])
+
+def bench_async(args):
+    from AsyncPlaylistDatabase import AsyncPlaylistDatabase
+
+    db = make_database(args,'mysql')
+    adb = AsyncPlaylistDatabase(user=db._user,password=db._password,host=db._host,
+                                database=args.database,pool_size=args.concurrency)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(adb.connect())
+
+    made = 0
+    cycle = 0
+    for num_stations in args.counts:
+        stations = ['BenchStation'+str(ii) for ii in range(num_stations)]
+        for name in stations[made:]:
+            db.create_station(name,name+'.Site',[],[],name+'.Playlist')
+        made = num_stations
+
+        times = []
+        for ii in range(args.cycles):
+            cycle += 1
+            t0 = perf_counter()
+            serial_cycle(db,_poll_plays(stations,cycle,args.tracks),args.latency)
+            times.append(perf_counter()-t0)
+        serial = sum(times)/len(times)
+
+        times = []
+        for ii in range(args.cycles):
+            cycle += 1
+            t0 = perf_counter()
+            loop.run_until_complete(async_cycle(adb,_poll_plays(stations,cycle,args.tracks),args.latency,args.concurrency))
+            times.append(perf_counter()-t0)
+        concurrent = sum(times)/len(times)
+
+        print('%6d stations  serial: %8.3f s/cycle  async: %8.3f s/cycle  (%.1fx)'%(
+              num_stations,serial,concurrent,serial/concurrent))
+
+    loop.run_until_complete(adb.close())
+
+def bench_poller(args):
+    '''
+    main.py's poll cycle on StationPoller, one worker (the old serial
+    loop) vs more. Scrapes take --latency seconds give or take half, and
+    --hung stations never answer within --station-timeout.
+    '''
+    from station_pool import StationPoller, format_cycle
+
+    workers = sorted(set(args.workers))
+    db = make_database(args,pool_size=max(workers)+1,connect=False)
+    stations = ['PollStation%04d'%(ii,) for ii in range(args.stations)]
+    with db:
+        for name in stations:
+            db.create_station(name,name+'.Site',[],[],name+'.Playlist')
+    hung = set(stations[:args.hung])
+    start = datetime.datetime(2017,1,1)
+    plays = {'count':0}
+    lock = threading.Lock()
+
+    def update(channel_dict):
+        name = channel_dict['name']
+        with lock:
+            plays['count'] += 1
+            k = plays['count']
+        # The scrape
+        sleep(args.station_timeout*3 if name in hung else args.latency*(0.5 + (k*7919 % 100)/100))
+        with db:
+            try:
+                db.look_up_song_youtube(name+'.Artist',name+'.Album','Track'+str(k % 50))
+            except LookupError:
+                pass
+            db.add_track_to_station_playlist(name,name+'.Artist',name+'.Album','Track'+str(k % 50),
+                                             start+datetime.timedelta(seconds=k),'https://youtu.be/'+str(k % 50).zfill(11))
+        return True
+
+    with db:
+        channel_dicts = [c for c in db.get_station_data() if c['name'] in set(stations)]
+    for count in workers:
+        poller = StationPoller(update,count,args.station_timeout)
+        for cycle in range(args.cycles):
+            stats = poller.poll(channel_dicts)
+            print('%3d workers  '%(count,) + format_cycle(stats))
+        poller.close()
+    db.close()
+
+# Seconds a song (or talk segment) lasts, by kind of station
+STATION_KINDS = {'fast':(150,240),'slow':(240,420),'talk':(900,3600)}
+
+class _SimulatedStation():
+    '''
+    When each song on a made up station started, and what polling it
+    at a given time finds
+    '''
+
+    def __init__(self,rng,kind,end):
+        self.starts = []
+        t = -rng.uniform(0,300)
+        while t < end:
+            self.starts.append(t)
+            t += rng.uniform(*STATION_KINDS[kind])
+        self.last = None
+
+    def poll(self,now,counts):
+        '''
+        True if there's a song we haven't seen. Counts songs found,
+        songs that came and went between polls, and detection latency.
+        '''
+        counts['polls'] += 1
+        current = bisect(self.starts,now)-1
+        if self.last is not None and current <= self.last:
+            return False
+        if self.last is not None:
+            counts['missed'] += current - self.last - 1
+            counts['latency'].append(now - self.starts[current])
+        counts['found'] += 1
+        self.last = current
+        return True
+
+def bench_scheduler(args):
+    '''
+    Simulated stations polled on the old fixed 100-140 s cycle vs the
+    adaptive StationScheduler. Scrapes are instant and there's no
+    database, this is only about when polls happen.
+    '''
+    from station_schedule import StationScheduler
+
+    rng = random.Random(args.seed)
+    kinds = [kind for kind,count in (('fast',args.fast),('slow',args.slow),('talk',args.talk)) for ii in range(count)]
+    warmup = args.warmup_hours*3600
+    end = warmup + args.hours*3600
+    stations = [_SimulatedStation(rng,kind,end) for kind in kinds]
+
+    def fixed(start,stop,counts,history=None):
+        now = start
+        while now < stop:
+            for ii,station in enumerate(stations):
+                if station.poll(now,counts) and history is not None:
+                    history[ii].append(now)
+            now += rng.randint(100,140)
+
+    def new_counts():
+        return {'polls':0,'found':0,'missed':0,'latency':[]}
+
+    # What Playlist would have in it from polling the old way
+    history = [[] for s in stations]
+    fixed(0,warmup,new_counts(),history)
+    saved = [s.last for s in stations]
+
+    results = {}
+    counts = results['fixed 100-140 s'] = new_counts()
+    fixed(warmup,end,counts)
+
+    for s,last in zip(stations,saved):
+        s.last = last
+    counts = results['adaptive'] = new_counts()
+    scheduler = StationScheduler(args.min_interval,args.max_interval,seed=args.seed)
+    for ii,times in enumerate(history):
+        scheduler.learn(ii,times[-50:],now=warmup)
+    scheduler.set_stations(range(len(stations)),now=warmup)
+    now = warmup
+    while True:
+        now = scheduler.next_due()
+        if now is None or now >= end:
+            break
+        for ii in scheduler.due(now):
+            scheduler.record(ii,stations[ii].poll(now,counts),now)
+
+    print('%d fast, %d slow, %d talk stations, %d hours after %d hours of history'%(
+          args.fast,args.slow,args.talk,args.hours,args.warmup_hours))
+    for name,counts in results.items():
+        latency = sorted(counts['latency'])
+        print('%-16s %8d scrapes  %6d songs found  %5d missed  latency mean %6.1f s  p90 %6.1f s'%(
+              name,counts['polls'],counts['found'],counts['missed'],
+              sum(latency)/max(len(latency),1),latency[int(len(latency)*0.9)] if latency else 0.0))
+
+    for kind in STATION_KINDS:
+        status = [s for s in scheduler.status(now)['stations'] if kinds[s['name']] == kind]
+        if status:
+            print('%-5s learned song length %4d s (%d..%d s)'%(kind,status[0]['song_length'],*status[0]['song_length_range']))
+
+def bench_video_checks(args):
+    '''
+    API calls spent checking known songs' videos, one videos.list per
+    play (the old grabinfo) vs VideoChecker. The youtube client is a stub
+    that takes --api-latency seconds per call. Plays are --workers at a
+    time, picked from a --tracks catalog by Zipf popularity, and
+    --gone of the videos have been taken down.
+    '''
+    from video_check import VideoChecker
+    from concurrent.futures import ThreadPoolExecutor
+
+    rng = random.Random(args.seed)
+    catalog = ['%011d'%(ii,) for ii in range(args.tracks)]
+    gone = set(rng.sample(catalog,int(args.tracks*args.gone)))
+    weights = [1/(rank+1)**args.zipf for rank in range(args.tracks)]
+    calls = {'count':0,'ids':0}
+    lock = threading.Lock()
+
+    def valid_videos(video_ids):
+        with lock:
+            calls['count'] += 1
+            calls['ids'] += len(video_ids)
+        sleep(args.api_latency)
+        return set(v for v in video_ids if v not in gone)
+
+    def get_video_ids(after_id,limit):
+        return [(ii+1,catalog[ii]) for ii in range(after_id,min(after_id+limit,len(catalog)))]
+
+    cycles = [rng.choices(catalog,weights,k=args.stations) for cycle in range(args.cycles)]
+
+    def run(name,check,sweep=None):
+        calls['count'] = calls['ids'] = 0
+        if sweep is not None:
+            sweep()
+            print('%-14s sweep of %d videos: %d calls'%(name,len(catalog),calls['count']))
+            calls['count'] = calls['ids'] = 0
+        wrong = 0
+        t0 = perf_counter()
+        with ThreadPoolExecutor(args.workers) as executor:
+            for plays in cycles:
+                answers = list(executor.map(check,plays))
+                wrong += sum(1 for v,valid in zip(plays,answers) if valid == (v in gone))
+        wall = perf_counter()-t0
+        print('%-14s %6d calls (%6.1f per cycle, %4.1f videos per call) %5.1f s of checks per cycle, %d wrong'%(
+              name,calls['count'],calls['count']/args.cycles,calls['ids']/max(calls['count'],1),wall/args.cycles,wrong))
+
+    print('%d stations, %d cycles, %d videos (%d gone), %d workers, %.2f s per call'%(
+          args.stations,args.cycles,args.tracks,len(gone),args.workers,args.api_latency))
+    run('per play',lambda v: v in valid_videos([v]))
+    checker = VideoChecker(valid_videos)
+    run('cached',checker.is_valid)
+    checker = VideoChecker(valid_videos)
+    run('swept',checker.is_valid,lambda: checker.sweep(get_video_ids,pause=0,verbose=False))
+
+def bench_search_cache(args):
+    '''
+    search.list calls made by grabinfo's lookup, with and without
+    SearchCache. Songs are picked by Zipf popularity and the station's
+    site spells the album (and sometimes the title) --variants different
+    ways, so the exact database match misses now and then. The youtube
+    search is a stub.
+    '''
+    from search_cache import SearchCache, normalize_query, SEARCH_COST
+
+    rng = random.Random(args.seed)
+    weights = [1/(rank+1)**args.zipf for rank in range(args.songs)]
+    plays = []
+    for song in rng.choices(range(args.songs),weights,k=args.plays):
+        variant = rng.randrange(args.variants)
+        album = 'Album%d'%(song//10,) + ('',' (Deluxe)',' [Remastered]',' - Single')[variant % 4]
+        title = 'Song %d'%(song,) + ('','','.',"!")[variant % 4]
+        plays.append(('Artist%d'%(song % 500,),album,title))
+
+    calls = {'count':0}
+    def search(query,max_results):
+        calls['count'] += 1
+        return ['%011d'%(hash(normalize_query(query)) % 10**11,)]
+
+    print('%d plays of %d songs, %d spellings each'%(args.plays,args.songs,args.variants))
+    for name in ('no cache','cached'):
+        db = make_database(args)
+        db.create_station('SearchStation','SearchStation.Site',[],[],'SearchStation.Playlist')
+        searcher = SearchCache(search,db) if name == 'cached' else None
+        calls['count'] = 0
+        start = datetime.datetime(2017,1,1)
+        t0 = perf_counter()
+        for ii,(artist,album,title) in enumerate(plays):
+            try:
+                url = db.look_up_song_youtube(artist,album,title)
+            except LookupError:
+                if searcher is None:
+                    videos = search(artist+' '+title,5)
+                else:
+                    videos = searcher.youtube_search(artist+' '+title,5)
+                url = 'https://youtu.be/'+videos[0]
+            db.add_track_to_station_playlist('SearchStation',artist,album,title,start+datetime.timedelta(seconds=ii),url)
+        wall = perf_counter()-t0
+        line = '%-9s %6d search.list calls (%8d quota units), %.1f s'%(name,calls['count'],calls['count']*SEARCH_COST,wall)
+        if searcher is not None:
+            stats = searcher.stats()
+            line += ', cache hit rate %.1f%%, %d quota units saved'%(100*stats['hit_rate'],stats['quota_saved'])
+        print(line)
+        db.close()
+
+class _QuotaError(Exception):
+    # What is_quota_error looks for in youtube's HttpError
+    content = b'quotaExceeded'
+
+def bench_quota(args):
+    '''
+    Two simulated days of main.py's youtube calls on a virtual clock,
+    with demand --demand times the daily quota, going straight to
+    youtube (which fails everything once the quota is gone) vs through
+    QuotaBudget. A quarter of the stations have --priority times the
+    weight of the rest.
+    '''
+    import calendar
+    from quota import QuotaBudget, QuotaDeferred, COSTS, HIGH, NORMAL
+
+    rng = random.Random(args.seed)
+    stations = ['QuotaStation%03d'%(ii,) for ii in range(args.stations)]
+    important = set(stations[:args.stations//4])
+    # Units a new song costs on average: a video check if we know it,
+    # a search if we don't, and the playlist insert
+    per_song = args.known*COSTS['videos.list'] + (1-args.known)*COSTS['search.list'] + COSTS['playlistItems.insert']
+    songs_per_minute = args.demand*args.daily_units/per_song/1440
+    start = calendar.timegm(datetime.datetime(2017,1,2,8).timetuple())
+    minutes = 2*1440
+    # (minute, station, known song) for everything the stations play
+    songs = []
+    for minute in range(minutes):
+        count = int(songs_per_minute) + (rng.random() < songs_per_minute % 1)
+        songs.extend((minute,rng.choice(stations),rng.random() < args.known) for ii in range(count))
+
+    print('%d stations, %d units a day, %d songs a day (%.1fx the quota)'%(
+          args.stations,args.daily_units,len(songs)//2,args.demand))
+    for name in ('no budget','budget'):
+        # What youtube thinks we've spent, by quota day
+        youtube = {'day':None,'spent':0}
+        counts = {'added':0,'added_important':0,'skipped':0,'failed':0,'late':0,'out_at':None}
+        clock = {'now':start}
+
+        def api(now,units):
+            day = (now - start)//86400
+            if day != youtube['day']:
+                youtube['day'],youtube['spent'] = day,0
+            if youtube['spent'] + units > args.daily_units:
+                if counts['out_at'] is None:
+                    counts['out_at'] = (now - start)/3600
+                raise _QuotaError()
+            youtube['spent'] += units
+
+        budget = QuotaBudget(args.daily_units,priorities=dict((s,args.priority) for s in important),now=start) if name == 'budget' else None
+        if budget is not None:
+            budget.set_stations(stations)
+
+        def call(endpoint,station,value,now):
+            if budget is None:
+                return api(now,COSTS[endpoint])
+            budget.call(endpoint,station,value,api,now,COSTS[endpoint],now=now)
+
+        def insert(station,now,played):
+            call('playlistItems.insert',station,NORMAL,now)
+            counts['added'] += 1
+            counts['added_important'] += station in important
+            counts['late'] += now - played > 3600
+
+        def deferred_insert(station,played):
+            insert(station,clock['now'],played)
+
+        for minute,station,known in songs:
+            now = clock['now'] = start + minute*60
+            if budget is not None:
+                budget.run_deferred(20,now)
+            try:
+                call('videos.list' if known else 'search.list',None if known else station,HIGH if known else NORMAL,now)
+            except _QuotaError:
+                counts['failed'] += 1
+                continue
+            except QuotaDeferred:
+                counts['skipped'] += 1
+                continue
+            try:
+                insert(station,now,now)
+            except _QuotaError:
+                counts['failed'] += 1
+            except QuotaDeferred:
+                budget.defer('playlistItems.insert',station,NORMAL,deferred_insert,station,now)
+
+        line = '%-10s %5d added (%4d from priority stations, %4d over an hour late), %5d skipped, %5d failed on youtube'%(
+               name,counts['added'],counts['added_important'],counts['late'],counts['skipped'],counts['failed'])
+        if counts['out_at'] is not None:
+            line += ', first ran out %.1f h into the day'%(counts['out_at'] % 24,)
+        print(line)
+
+def _station_plays(station,count,start):
+    '''
+    Plays only this station has, so an answer meant for another
+    thread's station is easy to spot
+    '''
+    return [(station,station+'.Artist'+str(k % 20),station+'.Album',station+'.Track'+str(k % 50),
+             start+datetime.timedelta(seconds=k),'https://youtu.be/'+str(k % 50).zfill(11)) for k in range(count)]
+
+def stress_thread(db,station,ops,write_every,serialize,blocks,start,results):
+    '''
+    One thread's share of bench_threads. Counts operations, writes, and
+    answers that belong to some other station.
+    '''
+    done = writes = wrong = errors = 0
+    for ii in range(ops):
+        try:
+            with serialize, (db if blocks else _NoLock()):
+                if write_every and ii % write_every == 0:
+                    db.add_track_to_station_playlist(*_station_plays(station,1,start+datetime.timedelta(seconds=ii))[0])
+                    writes += 1
+                elif ii % 2:
+                    tracks = db.get_latest_station_tracks(station,10)
+                    wrong += sum(1 for t in tracks if not t['artist'].startswith(station+'.'))
+                else:
+                    k = ii % 50
+                    url = db.look_up_song_youtube(station+'.Artist'+str(k % 20),station+'.Album',station+'.Track'+str(k))
+                    wrong += url != 'https://youtu.be/'+str(k).zfill(11)
+        except Exception:
+            errors += 1
+        done += 1
+    results.append((done,writes,wrong,errors))
+
+class _NoLock():
+    def __enter__(self):
+        pass
+    def __exit__(self,*args):
+        pass
+
+def bench_threads(args):
+    '''
+    Many threads reading and writing through one PlaylistDatabase, each
+    on its own station. "one lock" runs every call under a process-wide
+    lock, the way PlaylistDatabase used to; "per thread" is how it is now.
+    With --with-blocks every call is in its own "with db:" like the
+    frontend's request threads.
+    '''
+    # The song cache would answer most lookups without touching the database
+    db = make_database(args,song_cache_size=0)
+    stations = make_stations(db,max(args.counts))
+    for station in stations:
+        db.add_tracks_to_station_playlist_batch(_station_plays(station,200,datetime.datetime(2017,1,1)))
+
+    run = 0
+    for num_threads in args.counts:
+        for mode,serialize in (('one lock',threading.Lock()),('per thread',_NoLock())):
+            before = {}
+            for station in stations[:num_threads]:
+                before[station] = len(db.get_latest_station_tracks(station,10**9))
+
+            results = []
+            # New play times every run so the writes aren't duplicates
+            run += 1
+            start = datetime.datetime(2019,1,1) + datetime.timedelta(days=run)
+            threads = [threading.Thread(target=stress_thread,args=(db,station,args.ops,args.write_every,serialize,args.with_blocks,start,results))
+                       for station in stations[:num_threads]]
+            t0 = perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            seconds = perf_counter()-t0
+
+            done = sum(r[0] for r in results)
+            writes = sum(r[1] for r in results)
+            wrong = sum(r[2] for r in results)
+            errors = sum(r[3] for r in results)
+            # Every write has to have landed on its own station
+            lost = sum(before[station] for station in before) + writes - sum(
+                len(db.get_latest_station_tracks(station,10**9)) for station in before)
+            print('%3d threads  %-10s %9.0f ops/s  %5d writes  %d wrong answers  %d errors  %d lost writes'%(
+                  num_threads,mode,done/seconds,writes,wrong,errors,lost))
+
+def bench_query_stats(args):
+    '''
+    What the query instrumentation costs on cheap, cached-index queries
+    '''
+    for query_stats in (False,True):
+        db = make_database(args,song_cache_size=0,query_stats=query_stats)
+        stations = make_stations(db,10)
+        db.add_tracks_to_station_playlist_batch(make_plays(stations,2000,200))
+
+        t0 = perf_counter()
+        for ii in range(args.queries):
+            t = ii % 200
+            db.look_up_song_youtube('BenchArtist'+str(t % 500),'BenchAlbum'+str(t % 2000),'BenchTrack'+str(t))
+            db.get_latest_station_tracks(stations[ii % 10],5)
+        seconds = perf_counter()-t0
+        print('query stats %-3s  %8.1f us/call'%('on' if query_stats else 'off',seconds/(2*args.queries)*1e6))
+        db.close()
+
+
+def percentiles(samples):
+    '''
+    Summary of a list of latencies in seconds, reported in milliseconds
+    '''
+    samples = sorted(samples)
+    def pick(p):
+        return samples[min(int(p*len(samples)),len(samples)-1)]*1000
+    return {
+        'count':len(samples),
+        'mean_ms':sum(samples)/len(samples)*1000,
+        'p50_ms':pick(0.50),
+        'p95_ms':pick(0.95),
+        'p99_ms':pick(0.99),
+        'max_ms':samples[-1]*1000,
+    }
+
+def timed(func,calls):
+    '''
+    Run func(ii) for ii in range(calls) and time every call
+    '''
+    samples = []
+    for ii in range(calls):
+        t0 = perf_counter()
+        func(ii)
+        samples.append(perf_counter()-t0)
+    return percentiles(samples)
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git','rev-parse','HEAD'],stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def bench_suite(args):
+    '''
+    Build a synthetic workload in the scratch database and time the
+    queries the poller and the frontend make. Results can be saved with
+    --output and checked against an older run with "compare".
+    '''
+    if args.scale is not None:
+        load = Workload.scale(args.scale,zipf_s=args.zipf,seed=args.seed)
+    else:
+        load = Workload(args.stations,args.tracks,args.days,args.plays_per_day,zipf_s=args.zipf,seed=args.seed)
+
+    # No song cache, we want to time the queries behind it
+    db = make_database(args,song_cache_size=0)
+    results = {}
+    print('Workload: %s'%(load.params(),))
+
+    t0 = perf_counter()
+    stations = load.station_names()
+    for name in stations:
+        db.create_station(name,name+'.Site',[],[],name+'.Playlist')
+    results['create_station'] = {'count':len(stations),'seconds':perf_counter()-t0}
+
+    # The history, the way a backfill would load it
+    t0 = perf_counter()
+    added = db.add_tracks_to_station_playlist_batch(load.plays(),batch_size=args.batch_size)
+    seconds = perf_counter()-t0
+    results['ingest_batch'] = {'count':added,'seconds':seconds,'rows_per_second':added/seconds}
+    report('ingest (batch)',added,seconds)
+
+    # Then some polls' worth one row at a time, after the history
+    after = load.start + datetime.timedelta(days=load.days)
+    tracks = load.popular_tracks(args.queries)
+    def add_one(ii):
+        artist,album,title,link = tracks[ii]
+        db.add_track_to_station_playlist(stations[ii % len(stations)],artist,album,title,
+                                         after+datetime.timedelta(seconds=ii),link)
+    results['ingest_single'] = timed(add_one,args.queries)
+
+    results['get_station_data'] = timed(lambda ii: db.get_station_data(),args.station_data_calls)
+    results['get_latest_station_tracks_1'] = timed(
+        lambda ii: db.get_latest_station_tracks(stations[ii % len(stations)],1),args.queries)
+    results['get_latest_station_tracks_10'] = timed(
+        lambda ii: db.get_latest_station_tracks(stations[ii % len(stations)],10),args.queries)
+
+    # Songs picked by popularity, like the poller sees them
+    # (the rarest ones may never have been played, so some miss)
+    lookups = load.popular_tracks(args.queries,seed_offset=1)
+    found = []
+    def look_up(ii):
+        artist,album,title,link = lookups[ii]
+        try:
+            db.look_up_song_youtube(artist,album,title)
+            found.append(ii)
+        except LookupError:
+            pass
+    results['look_up_song_youtube'] = timed(look_up,args.queries)
+    results['look_up_song_youtube']['hit_rate'] = len(found)/args.queries
+
+    def look_up_missing(ii):
+        try:
+            db.look_up_song_youtube('Missing Artist','Missing Album','Missing %d'%(ii,))
+        except LookupError:
+            pass
+    results['look_up_song_youtube_miss'] = timed(look_up_missing,args.queries)
+
+    # The frontend's search box: a title, an artist, or a video ID prefix
+    searches = load.popular_tracks(args.searches,seed_offset=2)
+    results['search_title'] = timed(lambda ii: db.search_tracks(title=searches[ii][2]),args.searches)
+    results['search_artist'] = timed(lambda ii: db.search_tracks(artist=searches[ii][0]),args.searches)
+    results['search_video_id'] = timed(
+        lambda ii: db.search_tracks(video_id=searches[ii][3].rsplit('/',1)[-1][:8]),args.searches)
+
+    results['history_export'] = timed(
+        lambda ii: sum(1 for row in db.iter_station_history(stations[ii % len(stations)])),min(10,len(stations)))
+    db.close()
+
+    for name,r in results.items():
+        if 'p50_ms' in r:
+            print('%-30s %6d calls  p50 %8.3f ms  p95 %8.3f ms  p99 %8.3f ms'%(
+                  name,r['count'],r['p50_ms'],r['p95_ms'],r['p99_ms']))
+
+    if args.output is not None:
+        out = {
+            'meta':{
+                'commit':git_commit(),
+                'backend':args.backend,
+                'time':datetime.datetime.utcnow().isoformat(),
+                'python':platform.python_version(),
+                'platform':platform.platform(),
+                'workload':load.params(),
+                'queries':args.queries,
+                'searches':args.searches,
+            },
+            'results':results,
+        }
+        with open(args.output,'w') as f:
+            json.dump(out,f,indent=2,sort_keys=True)
+        print('Wrote ' + args.output)
+
+def bench_search(args):
+    '''
+    The frontend search, LIKE vs the full-text index, as the catalog grows
+    '''
+    for count in args.counts:
+        db = make_database(args)
+        load = Workload(stations=1,tracks=count,seed=args.seed)
+        db.create_station('Station 00000','Site',[],[],'Playlist')
+        # One play of every track so the whole catalog exists
+        db.add_tracks_to_station_playlist_batch(
+            ('Station 00000',) + load.track(rank)[:3] + (load.start+datetime.timedelta(seconds=rank),load.track(rank)[3])
+            for rank in range(count))
+
+        # A whole title, the start of a title, and an artist
+        searches = load.popular_tracks(args.searches)
+        for label,name,length in (('title','title',None),('partial','title',5),('artist','artist',None)):
+            field = {'artist':0,'title':2}[name]
+            terms = [{name:s[field][:length]} for s in searches]
+            like = timed(lambda ii: legacy_search_tracks(db,**terms[ii]),args.searches)
+            indexed = timed(lambda ii: db.search_tracks(**terms[ii]),args.searches)
+            print('%8d tracks  %-7s  LIKE p50 %8.3f ms  indexed p50 %8.3f ms  %6.1fx'%(
+                  count,label,like['p50_ms'],indexed['p50_ms'],like['p50_ms']/indexed['p50_ms']))
+        db.close()
+
+def legacy_track_stats(db,track_ids):
+    '''
+    What track pages would have to do without TrackStats: aggregate
+    each track's whole history
+    '''
+    stats = {}
+    for track_id in track_ids:
+        db._cur.execute('''SELECT COUNT(*), MAX(Playlist.play_time) FROM Playlist WHERE Playlist.track_id = %s''',(track_id,))
+        stats[track_id] = db._cur.fetchone()
+        db._cur.execute('''SELECT Station.station_name, COUNT(*), MAX(Playlist.play_time) FROM Playlist
+        JOIN Station ON Playlist.station_id = Station.id WHERE Playlist.track_id = %s
+        GROUP BY Station.station_name''',(track_id,))
+        db._cur.fetchall()
+    return stats
+
+def bench_track_stats(args):
+    '''
+    Track page statistics, aggregating the history vs reading TrackStats.
+    Popular tracks have the longest histories, so they're what hurts.
+    '''
+    load = Workload(args.stations,args.tracks,args.days,args.plays_per_day,seed=args.seed)
+    db = make_database(args)
+    for name in load.station_names():
+        db.create_station(name,name+'.Site',[],[],name+'.Playlist')
+    t0 = perf_counter()
+    added = db.add_tracks_to_station_playlist_batch(load.plays())
+    report('ingest with stats',added,perf_counter()-t0)
+
+    # Pages of tracks picked by popularity, like search results for hits
+    track_ids = []
+    for artist,album,title,link in load.popular_tracks(args.pages*args.page_size):
+        db._cur.execute('''SELECT Track.id FROM Track WHERE Track.track_name = %s''',(title,))
+        track_ids += [row[0] for row in db._cur.fetchall()]
+    pages = list(_chunks(track_ids,args.page_size))
+
+    history = timed(lambda ii: legacy_track_stats(db,pages[ii]),args.pages)
+    stats = timed(lambda ii: db.get_track_stats(pages[ii]),args.pages)
+    print('%d tracks a page  GROUP BY p50 %8.3f ms  TrackStats p50 %8.3f ms  %6.1fx'%(
+          args.page_size,history['p50_ms'],stats['p50_ms'],history['p50_ms']/stats['p50_ms']))
+
+    t0 = perf_counter()
+    problems = db.check_track_stats()
+    print('check_track_stats: %d problems in %.2f s'%(len(problems),perf_counter()-t0))
+    db.close()
+
+def legacy_top_tracks(db,start,end,station=None,limit=50):
+    '''
+    top_tracks without the rollups: GROUP BY the raw history
+    '''
+    where = 'Playlist.play_time >= %s AND Playlist.play_time < %s'
+    params = [start.strftime('%Y-%m-%d'),end.strftime('%Y-%m-%d')]
+    if station is not None:
+        where = 'Station.station_name = %s AND ' + where
+        params.insert(0,station)
+    db._cur.execute('''SELECT Track.id, Track.track_name, Artist.artist_name, Album.album_name, COUNT(*) AS plays
+    FROM Playlist JOIN Station ON Playlist.station_id = Station.id
+    JOIN Track ON Playlist.track_id = Track.id
+    JOIN Artist ON Track.artist_id = Artist.id
+    JOIN Album ON Track.album_id = Album.id
+    WHERE ''' + where + '''
+    GROUP BY Track.id, Track.track_name, Artist.artist_name, Album.album_name
+    ORDER BY plays DESC, Track.id LIMIT %s''',params + [limit])
+    return db._cur.fetchall()
+
+def legacy_top_artists(db,start,end,limit=50):
+    db._cur.execute('''SELECT Artist.id, Artist.artist_name, COUNT(*) AS plays
+    FROM Playlist JOIN Track ON Playlist.track_id = Track.id
+    JOIN Artist ON Track.artist_id = Artist.id
+    WHERE Playlist.play_time >= %s AND Playlist.play_time < %s
+    GROUP BY Artist.id, Artist.artist_name
+    ORDER BY plays DESC, Artist.id LIMIT %s''',(start.strftime('%Y-%m-%d'),end.strftime('%Y-%m-%d'),limit))
+    return db._cur.fetchall()
+
+def legacy_station_trend(db,station,start,end):
+    db._cur.execute('''SELECT DATE(Playlist.play_time), COUNT(*) FROM Playlist
+    JOIN Station ON Playlist.station_id = Station.id
+    WHERE Station.station_name = %s AND Playlist.play_time >= %s AND Playlist.play_time < %s
+    GROUP BY DATE(Playlist.play_time)''',(station,start.strftime('%Y-%m-%d'),end.strftime('%Y-%m-%d')))
+    return db._cur.fetchall()
+
+def bench_rollups(args):
+    '''
+    Top-N and trend questions over a range of days, GROUP BY the raw
+    history vs the daily rollups
+    '''
+    load = Workload(args.stations,args.tracks,args.days,args.plays_per_day,seed=args.seed)
+    db = make_database(args)
+    for name in load.station_names():
+        db.create_station(name,name+'.Site',[],[],name+'.Playlist')
+    t0 = perf_counter()
+    added = db.add_tracks_to_station_playlist_batch(load.plays())
+    report('ingest with rollups',added,perf_counter()-t0)
+
+    end = load.start + datetime.timedelta(days=args.days)
+    start = end - datetime.timedelta(days=min(args.range_days,args.days))
+    stations = load.station_names()
+    station = lambda ii: stations[ii % len(stations)]
+
+    cases = [
+        ('top 50 tracks on a station',
+         lambda ii: legacy_top_tracks(db,start,end,station(ii)),
+         lambda ii: db.top_tracks(start,end,station(ii))),
+        ('top 50 tracks everywhere',
+         lambda ii: legacy_top_tracks(db,start,end),
+         lambda ii: db.top_tracks(start,end)),
+        ('top 50 artists everywhere',
+         lambda ii: legacy_top_artists(db,start,end),
+         lambda ii: db.top_artists(start,end)),
+        ('station trend by day',
+         lambda ii: legacy_station_trend(db,station(ii),start,end),
+         lambda ii: db.station_trend(station(ii),start,end)),
+    ]
+    print('%d days of %d plays'%((end-start).days,added))
+    for name,legacy,rollup in cases:
+        history = timed(legacy,args.queries)
+        rollups = timed(rollup,args.queries)
+        print('%-28s GROUP BY p50 %9.3f ms  rollups p50 %8.3f ms  %7.1fx'%(
+              name,history['p50_ms'],rollups['p50_ms'],history['p50_ms']/rollups['p50_ms']))
+
+    t0 = perf_counter()
+    db.rebuild_daily_plays(start,end,verbose=False)
+    print('rebuild_daily_plays for the range: %.2f s'%(perf_counter()-t0,))
+    db.close()
+
+def _writer(db,station,start,stop,samples):
+    '''
+    Add a play at a time until stop is set, timing each one
+    '''
+    ii = 0
+    while not stop.is_set():
+        t0 = perf_counter()
+        db.add_track_to_station_playlist(station,'Writer Artist','Writer Album','Writer %d'%(ii,),
+                                         start+datetime.timedelta(seconds=ii),'')
+        samples.append(perf_counter()-t0)
+        ii += 1
+
+def bench_retention(args):
+    '''
+    Purging old history with one DELETE vs in batches, and what each
+    does to a poller adding plays at the same time
+    '''
+    load = Workload(args.stations,args.tracks,args.days,args.plays_per_day,seed=args.seed)
+    cutoff = load.start + datetime.timedelta(days=args.days*args.purge_percent//100)
+
+    for mode in ('single','batches'):
+        db = make_database(args)
+        for name in load.station_names():
+            db.create_station(name,name+'.Site',[],[],name+'.Playlist')
+        db.add_tracks_to_station_playlist_batch(load.plays())
+
+        samples = []
+        stop = threading.Event()
+        writer = threading.Thread(target=_writer,args=(db,load.station_names()[0],
+                                  load.start+datetime.timedelta(days=args.days),stop,samples))
+        writer.start()
+        sleep(0.2)
+
+        t0 = perf_counter()
+        if mode == 'single':
+            db._cur.execute('''DELETE FROM Playlist WHERE Playlist.play_time < %s''',(cutoff.strftime('%Y-%m-%d %H:%M:%S'),))
+            removed = db._cur.rowcount
+            db.rebuild_track_stats(verbose=False)
+            db._conn.commit()
+        else:
+            removed = retention.purge_batches(db,cutoff,args.batch_size,verbose=False)
+        seconds = perf_counter()-t0
+
+        sleep(0.2)
+        stop.set()
+        writer.join()
+        writes = percentiles(samples)
+        print('%-8s %8d plays removed in %6.2f s   concurrent add_track p50 %7.2f ms  p99 %8.2f ms  max %8.2f ms'%(
+              mode,removed,seconds,writes['p50_ms'],writes['p99_ms'],writes['max_ms']))
+        db.close()
+
+def bench_compare(args):
+    '''
+    Compare two suite results files. Exits non-zero if anything got
+    slower by more than --threshold.
+    '''
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    if old['meta']['workload'] != new['meta']['workload'] or old['meta']['backend'] != new['meta']['backend']:
+        print('Warning: the two runs used different workloads or backends')
+
+    regressions = 0
+    for name in sorted(set(old['results']) & set(new['results'])):
+        o = old['results'][name]
+        n = new['results'][name]
+        if 'rows_per_second' in o:
+            # Throughput, bigger is better
+            change = o['rows_per_second']/n['rows_per_second'] - 1
+            before,after,unit = o['rows_per_second'],n['rows_per_second'],'rows/s'
+        elif args.metric in o:
+            change = n[args.metric]/o[args.metric] - 1 if o[args.metric] else 0.0
+            before,after,unit = o[args.metric],n[args.metric],args.metric
+        else:
+            continue
+        # Tiny absolute slowdowns on very fast queries are just noise
+        slower = change > args.threshold and (unit == 'rows/s' or after-before >= args.min_ms)
+        regressions += slower
+        print('%-30s %12.3f -> %12.3f %-8s %+7.1f%%%s'%(
+              name,before,after,unit,change*100,'  REGRESSION' if slower else ''))
+
+    if regressions:
+        print('%d regressions over %.0f%%'%(regressions,args.threshold*100))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Playlist database benchmarks')
+    parser.add_argument('--config',help='Config file with the [database] credentials',default=None)
+    parser.add_argument('--database',help='Scratch database to use. IT IS DROPPED.',default='PlaylistDB_bench')
+    parser.add_argument('--backend',choices=['mysql','sqlite'],default='mysql')
+    parser.add_argument('--path',help='Scratch SQLite file to use. IT IS DROPPED.',default='PlaylistDB_bench.sqlite')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    ingest = subparsers.add_parser('ingest',help='Per-row vs batched playlist inserts')
+    ingest.add_argument('--plays',type=int,default=5000)
+    ingest.add_argument('--stations',type=int,default=10)
+    ingest.add_argument('--tracks',type=int,default=2000)
+    ingest.add_argument('--batch-size',type=int,default=1000)
+    ingest.set_defaults(func=bench_ingest)
+
+    stations = subparsers.add_parser('stations',help='get_station_data as the station count grows')
+    stations.add_argument('--counts',type=int,nargs='+',default=[10,100,500])
+    stations.add_argument('--plays',type=int,default=50,help='Plays per station')
+    stations.add_argument('--tracks',type=int,default=2000)
+    stations.set_defaults(func=bench_stations)
+
+    export = subparsers.add_parser('export',help='Memory use of streaming history export vs fetchall')
+    export.add_argument('--counts',type=int,nargs='+',default=[10000,100000,500000])
+    export.add_argument('--tracks',type=int,default=5000)
+    export.set_defaults(func=bench_export)
+
+    backends = subparsers.add_parser('backends',help='The same workload on MySQL and SQLite')
+    backends.add_argument('--backends',nargs='+',choices=['mysql','sqlite'],default=['mysql','sqlite'])
+    backends.add_argument('--plays',type=int,default=20000)
+    backends.add_argument('--single',type=int,default=1000,help='How many of the plays go in one at a time')
+    backends.add_argument('--stations',type=int,default=20)
+    backends.add_argument('--tracks',type=int,default=2000)
+    backends.add_argument('--queries',type=int,default=1000)
+    backends.set_defaults(func=bench_backends)
+
+    asyncbench = subparsers.add_parser('async',help='Poll cycle time, serial PlaylistDatabase vs AsyncPlaylistDatabase (MySQL, needs aiomysql)')
+    asyncbench.add_argument('--counts',type=int,nargs='+',default=[10,50,200])
+    asyncbench.add_argument('--cycles',type=int,default=3)
+    asyncbench.add_argument('--latency',type=float,default=0.05,help='Simulated seconds to scrape a station')
+    asyncbench.add_argument('--concurrency',type=int,default=20)
+    asyncbench.add_argument('--tracks',type=int,default=2000)
+    asyncbench.set_defaults(func=bench_async)
+
+    pollerbench = subparsers.add_parser('poller',help="main.py's poll cycle with one worker vs a pool, with hung stations")
+    pollerbench.add_argument('--stations',type=int,default=200)
+    pollerbench.add_argument('--workers',type=int,nargs='+',default=[1,10,20])
+    pollerbench.add_argument('--latency',type=float,default=0.05,help='Seconds each scrape takes, on average')
+    pollerbench.add_argument('--hung',type=int,default=2,help='Stations whose scrape never answers')
+    pollerbench.add_argument('--station-timeout',type=float,default=2)
+    pollerbench.add_argument('--cycles',type=int,default=1)
+    pollerbench.set_defaults(func=bench_poller)
+
+    schedulerbench = subparsers.add_parser('scheduler',help='Simulated scrapes, missed songs, and detection latency, fixed cycle vs StationScheduler')
+    schedulerbench.add_argument('--fast',type=int,default=60,help='Stations playing 2.5-4 minute songs')
+    schedulerbench.add_argument('--slow',type=int,default=30,help='Stations playing 4-7 minute songs')
+    schedulerbench.add_argument('--talk',type=int,default=10,help='Stations with 15-60 minute segments')
+    schedulerbench.add_argument('--hours',type=int,default=24)
+    schedulerbench.add_argument('--warmup-hours',type=int,default=24,help='History to learn from, polled the old way')
+    schedulerbench.add_argument('--min-interval',type=int,default=20)
+    schedulerbench.add_argument('--max-interval',type=int,default=600)
+    schedulerbench.add_argument('--seed',type=int,default=1)
+    schedulerbench.set_defaults(func=bench_scheduler)
+
+    videobench = subparsers.add_parser('videochecks',help='videos.list calls per cycle, a call per play vs cached and batched VideoChecker')
+    videobench.add_argument('--stations',type=int,default=100)
+    videobench.add_argument('--cycles',type=int,default=50)
+    videobench.add_argument('--tracks',type=int,default=20000,help='Videos in the catalog')
+    videobench.add_argument('--gone',type=float,default=0.02,help='Fraction of videos taken down')
+    videobench.add_argument('--zipf',type=float,default=1.0,help='Popularity skew')
+    videobench.add_argument('--workers',type=int,default=10)
+    videobench.add_argument('--api-latency',type=float,default=0.05)
+    videobench.add_argument('--seed',type=int,default=1)
+    videobench.set_defaults(func=bench_video_checks)
+
+    searchbench = subparsers.add_parser('searchcache',help='search.list calls for songs spelled differently, with and without SearchCache')
+    searchbench.add_argument('--plays',type=int,default=10000)
+    searchbench.add_argument('--songs',type=int,default=3000)
+    searchbench.add_argument('--variants',type=int,default=3,help='Spellings of each song')
+    searchbench.add_argument('--zipf',type=float,default=1.0,help='Popularity skew')
+    searchbench.add_argument('--seed',type=int,default=1)
+    searchbench.set_defaults(func=bench_search_cache)
+
+    quotabench = subparsers.add_parser('quota',help='Simulated days of youtube calls past the quota, with and without QuotaBudget')
+    quotabench.add_argument('--stations',type=int,default=40)
+    quotabench.add_argument('--daily-units',type=int,default=100000)
+    quotabench.add_argument('--demand',type=float,default=2.0,help='What the stations would spend, in days of quota')
+    quotabench.add_argument('--known',type=float,default=0.6,help='Fraction of songs we already have a video for')
+    quotabench.add_argument('--priority',type=float,default=3.0,help='Weight of the priority stations')
+    quotabench.add_argument('--seed',type=int,default=1)
+    quotabench.set_defaults(func=bench_quota)
+
+    threadbench = subparsers.add_parser('threads',help='Throughput and cross-thread answers with many threads on one PlaylistDatabase')
+    threadbench.add_argument('--counts',type=int,nargs='+',default=[1,4,16])
+    threadbench.add_argument('--ops',type=int,default=2000,help='Operations per thread')
+    threadbench.add_argument('--write-every',type=int,default=10,help='Every Nth operation is a write, 0 for none')
+    threadbench.add_argument('--with-blocks',action='store_true',help='Wrap every call in "with db:" like the frontend')
+    threadbench.set_defaults(func=bench_threads)
+
+    querystats = subparsers.add_parser('querystats',help='Overhead of the per-statement query instrumentation')
+    querystats.add_argument('--queries',type=int,default=10000)
+    querystats.set_defaults(func=bench_query_stats)
+
+    suite = subparsers.add_parser('suite',help='Synthetic Zipf workload, latency percentiles for the main queries')
+    suite.add_argument('--scale',choices=sorted(SCALES),default=None,help='A preset size, overrides the workload flags')
+    suite.add_argument('--stations',type=int,default=200)
+    suite.add_argument('--tracks',type=int,default=20000)
+    suite.add_argument('--days',type=int,default=14)
+    suite.add_argument('--plays-per-day',type=int,default=96,help='Per station')
+    suite.add_argument('--zipf',type=float,default=1.1,help='Zipf exponent of track popularity')
+    suite.add_argument('--seed',type=int,default=1)
+    suite.add_argument('--batch-size',type=int,default=1000)
+    suite.add_argument('--queries',type=int,default=2000)
+    suite.add_argument('--searches',type=int,default=200)
+    suite.add_argument('--station-data-calls',type=int,default=50)
+    suite.add_argument('--output',help='Write the results here as JSON',default=None)
+    suite.set_defaults(func=bench_suite)
+
+    search = subparsers.add_parser('search',help='Frontend search, LIKE scan vs full-text index, as the catalog grows')
+    search.add_argument('--counts',type=int,nargs='+',default=[1000,10000,100000])
+    search.add_argument('--searches',type=int,default=200)
+    search.add_argument('--seed',type=int,default=1)
+    search.set_defaults(func=bench_search)
+
+    trackstats = subparsers.add_parser('trackstats',help='Track page statistics, aggregating history vs TrackStats')
+    trackstats.add_argument('--stations',type=int,default=100)
+    trackstats.add_argument('--tracks',type=int,default=5000)
+    trackstats.add_argument('--days',type=int,default=14)
+    trackstats.add_argument('--plays-per-day',type=int,default=96,help='Per station')
+    trackstats.add_argument('--seed',type=int,default=1)
+    trackstats.add_argument('--pages',type=int,default=50)
+    trackstats.add_argument('--page-size',type=int,default=10)
+    trackstats.set_defaults(func=bench_track_stats)
+
+    rollups = subparsers.add_parser('rollups',help='Top-N and trend questions, GROUP BY the history vs daily rollups')
+    rollups.add_argument('--stations',type=int,default=100)
+    rollups.add_argument('--tracks',type=int,default=5000)
+    rollups.add_argument('--days',type=int,default=90)
+    rollups.add_argument('--plays-per-day',type=int,default=96,help='Per station')
+    rollups.add_argument('--range-days',type=int,default=90,help='Days the questions cover, ending at the last play')
+    rollups.add_argument('--queries',type=int,default=20)
+    rollups.add_argument('--seed',type=int,default=1)
+    rollups.set_defaults(func=bench_rollups)
+
+    retentionbench = subparsers.add_parser('retention',help='Purging old plays in one DELETE vs batches, with a writer running')
+    retentionbench.add_argument('--stations',type=int,default=100)
+    retentionbench.add_argument('--tracks',type=int,default=5000)
+    retentionbench.add_argument('--days',type=int,default=30)
+    retentionbench.add_argument('--plays-per-day',type=int,default=96,help='Per station')
+    retentionbench.add_argument('--purge-percent',type=int,default=50,help='How much of the history is old')
+    retentionbench.add_argument('--batch-size',type=int,default=1000)
+    retentionbench.add_argument('--seed',type=int,default=1)
+    retentionbench.set_defaults(func=bench_retention)
+
+    compare = subparsers.add_parser('compare',help='Compare two suite --output files')
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.add_argument('--metric',choices=['mean_ms','p50_ms','p95_ms','p99_ms','max_ms'],default='p95_ms')
+    compare.add_argument('--threshold',type=float,default=0.2,help='Fractional slowdown that counts as a regression')
+    compare.add_argument('--min-ms',type=float,default=0.1,help='Ignore slowdowns smaller than this')
+    compare.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+#
+# Bulk import historical plays (scraped archives, old dumps) straight into
+# the database, without going through add_track_to_station_playlist one
+# row at a time.
+#
+# The dump is a CSV file with a header row and these columns:
+#
+#   play_time, artist, album, title, youtube_link, station
+#
+# youtube_link is optional and so is station if you pass --station. This
+# is the same layout export_history.py writes, so an export can be loaded
+# straight back in.
+#
+# The rows are staged into a temporary table (with LOAD DATA LOCAL INFILE
+# if the server allows it, otherwise with large multi-row inserts), then
+# artists, albums, and tracks are created with set-based INSERT ... SELECT
+# statements, and finally the plays go in. Plays that are already in the
+# database (same track, station and time) are skipped and counted.
+#
+#   python3 bulk_import.py --config PlaylistDatabaseConfig.ini dump.csv
+#
+
+import os
+import csv
+import argparse
+import datetime
+import tempfile
+from time import perf_counter
+
+import mysql.connector as mysql
+
+from PlaylistDatabase import PlaylistDatabase, _chunks, refresh_track_stats, refresh_daily_plays
+from youtube_links import make_short_link, get_video_id
+
+STAGING_TABLE = 'PlaylistImport'
+
+class ImportStats():
+    '''
+    Counters for one import, printed as we go
+    '''
+    def __init__(self):
+        self.started = perf_counter()
+        self.read = 0
+        self.skipped_bad = 0
+        self.staged = 0
+        self.unknown_station = 0
+        self.inserted = 0
+        self.duplicates = 0
+
+    def rate(self,count):
+        return count/max(perf_counter()-self.started,1e-9)
+
+    def __str__(self):
+        return ('%d read, %d bad rows skipped, %d staged, %d for unknown stations, '
+                '%d plays added, %d duplicates skipped (%.0f rows/s)')%(
+                self.read,self.skipped_bad,self.staged,self.unknown_station,
+                self.inserted,self.duplicates,self.rate(self.read))
+
+def _parse_time(value):
+    for fmt in ('%Y-%m-%d %H:%M:%S','%Y-%m-%d %H:%M:%S.%f','%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(value,fmt)
+        except ValueError:
+            pass
+    return None
+
+def read_dump(path,station=None,stats=None):
+    '''
+    Yield cleaned up (station, artist, album, title, youtube_link,
+    video_id, play_time) tuples from a CSV dump.
+    Rows with no artist, title, station, or a bad time are skipped the
+    same way add_track_to_station_playlist skips them.
+    '''
+    with open(path,newline='') as f:
+        for row in csv.DictReader(f):
+            if stats is not None:
+                stats.read += 1
+
+            station_name = row.get('station') or station
+            artist = row.get('artist','')
+            title = row.get('title','')
+            play_time = _parse_time(row.get('play_time',''))
+            if not station_name or artist == '' or title == '' or play_time is None:
+                if stats is not None:
+                    stats.skipped_bad += 1
+                continue
+
+            link = make_short_link(row.get('youtube_link') or '')
+            yield (station_name,artist,row.get('album',''),title,link,
+                   get_video_id(link),play_time.strftime('%Y-%m-%d %H:%M:%S'))
+
+def create_staging_table(cur):
+    cur.execute('DROP TEMPORARY TABLE IF EXISTS ' + STAGING_TABLE)
+    cur.execute('''CREATE TEMPORARY TABLE ''' + STAGING_TABLE + ''' (
+        id INTEGER NOT NULL AUTO_INCREMENT,
+        station_name VARCHAR(256) NOT NULL,
+        artist_name VARCHAR(256) NOT NULL,
+        album_name VARCHAR(256) NOT NULL,
+        track_name VARCHAR(256) NOT NULL,
+        youtube_link TEXT,
+        video_id CHAR(11),
+        play_time DATETIME NOT NULL,
+
+        PRIMARY KEY (id)
+    )''')
+
+def _tsv_field(value):
+    '''
+    Escape a value for LOAD DATA's default tab separated format
+    '''
+    if value is None:
+        return '\\N'
+    return (value.replace('\\','\\\\').replace('\t','\\t')
+            .replace('\n','\\n').replace('\r','\\r'))
+
+def stage_with_load_data(conn,rows,stats,chunk_size):
+    '''
+    Write the rows to a temporary tab separated file and LOAD DATA it.
+    The server (local_infile) and the connection both have to allow it.
+    '''
+    cur = conn.cursor()
+    with tempfile.NamedTemporaryFile('w',suffix='.tsv',delete=False,encoding='utf-8') as f:
+        path = f.name
+        for row in rows:
+            f.write('\t'.join(_tsv_field(v) for v in row))
+            f.write('\n')
+            stats.staged += 1
+            if stats.staged % chunk_size == 0:
+                print('Written %d rows to the load file (%.0f rows/s)'%(stats.staged,stats.rate(stats.read)))
+    try:
+        print('Loading %d rows...'%(stats.staged,))
+        cur.execute('''LOAD DATA LOCAL INFILE %s INTO TABLE ''' + STAGING_TABLE + '''
+        CHARACTER SET utf8mb4
+        (station_name,artist_name,album_name,track_name,youtube_link,video_id,play_time)''',(path,))
+    finally:
+        os.remove(path)
+
+def stage_with_inserts(conn,rows,stats,chunk_size):
+    '''
+    Stage the rows with multi-row inserts, chunk_size rows per statement
+    '''
+    cur = conn.cursor()
+    for chunk in _chunks(rows,chunk_size):
+        cur.executemany('''INSERT INTO ''' + STAGING_TABLE + '''
+        (station_name,artist_name,album_name,track_name,youtube_link,video_id,play_time)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)''',chunk)
+        stats.staged += len(chunk)
+        print('Staged %d rows (%.0f rows/s)'%(stats.staged,stats.rate(stats.read)))
+
+def resolve(conn,stats):
+    '''
+    Create every artist, album, and track the staged plays need
+    with one statement each.
+    '''
+    cur = conn.cursor()
+
+    cur.execute('''SELECT COUNT(*) FROM ''' + STAGING_TABLE + ''' AS i
+    LEFT JOIN Station ON Station.station_name = i.station_name WHERE Station.id IS NULL''')
+    stats.unknown_station = cur.fetchone()[0]
+    if stats.unknown_station:
+        cur.execute('''SELECT DISTINCT i.station_name FROM ''' + STAGING_TABLE + ''' AS i
+        LEFT JOIN Station ON Station.station_name = i.station_name WHERE Station.id IS NULL''')
+        print('Skipping plays for stations that don\'t exist: ' + ', '.join(r[0] for r in cur.fetchall()))
+
+    t0 = perf_counter()
+    cur.execute('''INSERT IGNORE INTO Artist(artist_name)
+    SELECT DISTINCT i.artist_name FROM ''' + STAGING_TABLE + ''' AS i''')
+    print('Artists: %d new (%.1f s)'%(cur.rowcount,perf_counter()-t0))
+
+    t0 = perf_counter()
+    cur.execute('''INSERT IGNORE INTO Album(album_name,artist_id)
+    SELECT DISTINCT i.album_name, Artist.id FROM ''' + STAGING_TABLE + ''' AS i
+    JOIN Artist ON Artist.artist_name = i.artist_name''')
+    print('Albums: %d new (%.1f s)'%(cur.rowcount,perf_counter()-t0))
+
+    # Old dumps shouldn't replace a link someone has already picked,
+    # only fill in tracks that don't have one
+    t0 = perf_counter()
+    cur.execute('''INSERT INTO Track(track_name,youtube_link,video_id,filesystem_link,album_id,artist_id)
+    SELECT i.track_name, MAX(i.youtube_link), MAX(i.video_id), '', Album.id, Artist.id FROM ''' + STAGING_TABLE + ''' AS i
+    JOIN Artist ON Artist.artist_name = i.artist_name
+    JOIN Album ON Album.album_name = i.album_name AND Album.artist_id = Artist.id
+    GROUP BY i.track_name, Album.id, Artist.id
+    ON DUPLICATE KEY UPDATE
+    video_id=IF(Track.youtube_link IS NULL OR Track.youtube_link = '', VALUES(video_id), Track.video_id),
+    youtube_link=IF(Track.youtube_link IS NULL OR Track.youtube_link = '', VALUES(youtube_link), Track.youtube_link)''')
+    print('Tracks: done (%.1f s)'%(perf_counter()-t0,))
+    conn.commit()
+
+def insert_plays(conn,stats,chunk_size):
+    '''
+    Insert the staged plays, chunk_size staged rows per statement so no
+    single statement holds its locks for too long. Plays already in the
+    playlist are skipped by UNIQUE(track_id,station_id,play_time).
+
+    The stats and daily rollups of the tracks and days the plays touch
+    are refreshed once at the end, so they lag behind until the import
+    finishes.
+    '''
+    cur = conn.cursor()
+    cur.execute('SELECT MIN(id), MAX(id) FROM ' + STAGING_TABLE)
+    first,last = cur.fetchone()
+    if first is None:
+        return
+
+    staged = STAGING_TABLE + ''' AS i
+        JOIN Station ON Station.station_name = i.station_name
+        JOIN Artist ON Artist.artist_name = i.artist_name
+        JOIN Album ON Album.album_name = i.album_name AND Album.artist_id = Artist.id
+        JOIN Track ON Track.track_name = i.track_name AND Track.album_id = Album.id AND Track.artist_id = Artist.id
+        WHERE i.id >= %s AND i.id < %s'''
+
+    started = perf_counter()
+    candidates = 0
+    for low in range(first,last+1,chunk_size):
+        cur.execute('''INSERT IGNORE INTO Playlist(track_id,station_id,play_time)
+        SELECT Track.id, Station.id, i.play_time FROM ''' + staged,(low,low+chunk_size))
+        stats.inserted += cur.rowcount
+        conn.commit()
+
+        done = min(low+chunk_size,last+1) - first
+        print('Plays: %d/%d staged rows done, %d added (%.0f rows/s)'%(
+              done,last-first+1,stats.inserted,done/max(perf_counter()-started,1e-9)))
+
+    # Everything for a known station that didn't go in was already there
+    stats.duplicates = stats.staged - stats.unknown_station - stats.inserted
+    if not stats.inserted:
+        return
+
+    # The tracks and days may already have had plays, so their stats and
+    # rollups are counted again rather than added to. A popular track or
+    # a busy day is in most chunks, and is only counted once here.
+    t0 = perf_counter()
+    cur.execute('SELECT DISTINCT Track.id FROM ' + staged,(first,last+1))
+    track_ids = sorted(row[0] for row in cur.fetchall())
+    for chunk in _chunks(track_ids,1000):
+        refresh_track_stats(cur,chunk)
+        conn.commit()
+    print('Track stats: %d tracks refreshed (%.1f s)'%(len(track_ids),perf_counter()-t0))
+
+    t0 = perf_counter()
+    cur.execute('SELECT DISTINCT Station.id, DATE(i.play_time) FROM ' + staged,(first,last+1))
+    station_days = sorted(cur.fetchall())
+    for chunk in _chunks(station_days,100):
+        refresh_daily_plays(cur,chunk)
+        conn.commit()
+    print('Daily plays: %d station days refreshed (%.1f s)'%(len(station_days),perf_counter()-t0))
+
+def bulk_import(db,path,station=None,load_data=True,chunk_size=50000):
+    '''
+    Import a CSV dump. Returns the ImportStats.
+    '''
+    stats = ImportStats()
+    conn = db._connect(allow_local_infile=load_data)
+    try:
+        create_staging_table(conn.cursor())
+        rows = read_dump(path,station,stats)
+
+        if load_data:
+            try:
+                stage_with_load_data(conn,rows,stats,chunk_size)
+            except mysql.errors.Error as e:
+                print('LOAD DATA LOCAL INFILE failed (' + str(e) + '). Falling back to multi-row inserts.')
+                create_staging_table(conn.cursor())
+                stats = ImportStats()
+                rows = read_dump(path,station,stats)
+                stage_with_inserts(conn,rows,stats,chunk_size)
+        else:
+            stage_with_inserts(conn,rows,stats,chunk_size)
+
+        resolve(conn,stats)
+        insert_plays(conn,stats,chunk_size)
+    finally:
+        conn.close()
+
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk import historical plays from a CSV dump')
+    parser.add_argument('dump',help='CSV file to import')
+    parser.add_argument('--config',help='Config file with the [database] credentials',default='PlaylistDatabaseConfig.ini')
+    parser.add_argument('--station',default=None,help='Station for dumps without a station column')
+    parser.add_argument('--no-load-data',action='store_true',help='Stage with multi-row inserts instead of LOAD DATA LOCAL INFILE')
+    parser.add_argument('--chunk-size',type=int,default=50000,help='Rows per staging insert and per playlist insert')
+    args = parser.parse_args()
+
+    db = PlaylistDatabase(config_file=args.config,connect=False)
+    stats = bulk_import(db,args.dump,args.station,not args.no_load_data,args.chunk_size)
+    print('Done. ' + str(stats))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+from time import monotonic
+from collections import OrderedDict
+from threading import Lock
+
+class LRUCache():
+    '''
+    A small bounded dictionary that evicts the least recently used
+    entry once it is full. It keeps hit/miss/eviction counters so
+    callers can tell if it's actually helping.
+
+    With a ttl (seconds) entries also expire, for caches of things
+    other processes can change. put can give an entry its own ttl.
+    '''
+
+    def __init__(self,max_size=10000,ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (value, monotonic time it expires or None)
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self,key):
+        return key in self._data
+
+    def get(self,key,default=None):
+        '''
+        Look up a key. A hit makes it the most recently used entry.
+        '''
+        with self._lock:
+            try:
+                value,expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires <= monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self,key,value,ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data[key] = (value,None if ttl is None else monotonic()+ttl)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self,key):
+        with self._lock:
+            self._data.pop(key,None)
+
+    def invalidate_where(self,predicate):
+        '''
+        Drop every entry where predicate(key,value) is true.
+        This walks the whole cache so keep it for rare events like deletes.
+        '''
+        with self._lock:
+            stale = [k for k,(v,expires) in self._data.items() if predicate(k,v)]
+            for k in stale:
+                del self._data[k]
+            return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size':len(self._data),
+            'max_size':self.max_size,
+            'hits':self.hits,
+            'misses':self.misses,
+            'evictions':self.evictions,
+            'expirations':self.expirations,
+            'hit_rate':(self.hits/lookups) if lookups else 0.0,
+        }
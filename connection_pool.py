@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+from time import monotonic
+from threading import Condition
+
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool():
+    '''
+    A fixed size pool of database connections.
+
+    Connections are made with the connect() callable that's passed in,
+    so the pool doesn't care what driver is behind it. On checkout a
+    connection that has been idle for a while is checked with validate()
+    and replaced if the socket has gone stale. Connections older than
+    max_lifetime seconds are closed and re-made instead of being handed out.
+    '''
+
+    def __init__(self,connect,size=5,max_lifetime=3600,validate=None,validate_idle=5,timeout=30):
+        self._connect = connect
+        self._validate = validate
+        self.size = size
+        self.max_lifetime = max_lifetime
+        self.validate_idle = validate_idle
+        self.timeout = timeout
+
+        # (connection, created, returned) tuples ready to hand out
+        self._idle = []
+        # Number of connections that exist, in use or idle
+        self._count = 0
+        # When each connection was created, by id(connection)
+        self._created = {}
+        self._cond = Condition()
+
+        self.connects = 0
+        self.checkouts = 0
+        self.reconnects = 0
+
+    def _new_connection(self):
+        conn = self._connect()
+        self._created[id(conn)] = monotonic()
+        self.connects += 1
+        return conn
+
+    def _discard(self,conn):
+        self._created.pop(id(conn),None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def get(self):
+        '''
+        Borrow a connection. Blocks for up to timeout seconds if
+        every connection is in use.
+        '''
+        with self._cond:
+            deadline = monotonic() + self.timeout
+            while not self._idle and self._count >= self.size:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout('No database connection free after ' + str(self.timeout) + ' seconds')
+                self._cond.wait(remaining)
+
+            self.checkouts += 1
+            if self._idle:
+                conn,created,returned = self._idle.pop()
+            else:
+                # Reserve the slot before we let go of the lock to connect
+                self._count += 1
+                conn = None
+
+        if conn is None:
+            try:
+                return self._new_connection()
+            except:
+                self._release_slot()
+                raise
+
+        now = monotonic()
+        stale = (now - created) > self.max_lifetime
+        if not stale and self._validate is not None and (now - returned) > self.validate_idle:
+            try:
+                self._validate(conn)
+            except Exception:
+                stale = True
+
+        if stale:
+            self._discard(conn)
+            self.reconnects += 1
+            try:
+                return self._new_connection()
+            except:
+                self._release_slot()
+                raise
+
+        return conn
+
+    def put(self,conn,broken=False):
+        '''
+        Give a connection back. Broken or expired connections are closed
+        instead of going back in the pool.
+        '''
+        created = self._created.get(id(conn))
+        if broken or created is None or (monotonic() - created) > self.max_lifetime:
+            self._discard(conn)
+            self._release_slot()
+            return
+
+        with self._cond:
+            self._idle.append((conn,created,monotonic()))
+            self._cond.notify()
+
+    def _release_slot(self):
+        with self._cond:
+            self._count -= 1
+            self._cond.notify()
+
+    def close(self):
+        '''
+        Close every idle connection. Connections that are checked out
+        are closed when they are returned.
+        '''
+        with self._cond:
+            idle = self._idle
+            self._idle = []
+            self._count -= len(idle)
+        for conn,created,returned in idle:
+            self._discard(conn)
+        # Anything still out is too old to reuse now
+        self.max_lifetime = -1
+
+    def stats(self):
+        return {
+            'size':self.size,
+            'open':self._count,
+            'idle':len(self._idle),
+            'connects':self.connects,
+            'checkouts':self.checkouts,
+            'reconnects':self.reconnects,
+        }
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+#
+# Maintenance for the daily play rollups (DailyStationPlays,
+# DailyTrackPlays and DailyArtistPlays) that top_tracks, top_artists
+# and the *_trend functions read.
+#
+# rebuild works a range of days out again from the playlist history,
+# one station and --chunk-days days at a time with a commit after each.
+# The end day isn't included. Leave out days retention.py has purged,
+# their plays are only in the rollups now.
+#
+#   python3 daily_plays.py --config PlaylistDatabaseConfig.ini rebuild 2017-01-01 2017-04-01
+#
+# Without the days it's the whole history. The migration that adds the
+# rollups leaves them empty, so run that once after it on a database
+# that already has history. Until then top_tracks and the trends work
+# the rollups out from the history, which is slow.
+#
+#   python3 daily_plays.py --config PlaylistDatabaseConfig.ini rebuild
+#
+
+import argparse
+import datetime
+
+from PlaylistDatabase import PlaylistDatabase
+
+def day(value):
+    return datetime.datetime.strptime(value,'%Y-%m-%d').date()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild the daily play rollups')
+    parser.add_argument('action',choices=['rebuild'])
+    parser.add_argument('start',type=day,nargs='?',help='First day, YYYY-MM-DD (the first play if left out)')
+    parser.add_argument('end',type=day,nargs='?',help='Day after the last, YYYY-MM-DD (after the last play if left out)')
+    parser.add_argument('--station',help='Only this station')
+    parser.add_argument('--chunk-days',type=int,default=31,help='Days per transaction')
+    parser.add_argument('--config',help='Config file with the [database] credentials',default='PlaylistDatabaseConfig.ini')
+    args = parser.parse_args()
+
+    db = PlaylistDatabase(config_file=args.config)
+    days = db.rebuild_daily_plays(args.start,args.end,args.station,args.chunk_days)
+    print('Done. %d station days with plays.'%(days,))
+    db.close()
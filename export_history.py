@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+#
+# Export a station's play history to CSV, JSON lines, or Parquet.
+#
+# Rows are streamed out of the database and written as they arrive, so
+# this uses the same amount of memory for a day or for years of plays.
+# Parquet needs pyarrow (pip3 install pyarrow); the other formats don't.
+#
+#   python3 export_history.py --station KEXP --start 2017-01-01 --end 2018-01-01 \
+#       --format csv --output kexp_2017.csv
+#
+
+import csv
+import sys
+import json
+import argparse
+import datetime
+
+from PlaylistDatabase import PlaylistDatabase
+
+# Columns, in output order, and the key iter_station_history uses for each
+COLUMNS = [
+    ('play_time','time'),
+    ('artist','artist'),
+    ('album','album'),
+    ('title','name'),
+    ('youtube_link','youtube'),
+    ('filesystem_link','filesystem'),
+]
+
+def _time_string(value):
+    if isinstance(value,datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return str(value)
+
+def write_csv(rows,out):
+    writer = csv.writer(out)
+    writer.writerow([c for c,k in COLUMNS])
+    count = 0
+    for row in rows:
+        writer.writerow([_time_string(row[k]) if c == 'play_time' else row[k] for c,k in COLUMNS])
+        count += 1
+    return count
+
+def write_jsonl(rows,out):
+    count = 0
+    for row in rows:
+        out.write(json.dumps(dict((c,_time_string(row[k]) if c == 'play_time' else row[k]) for c,k in COLUMNS)))
+        out.write('\n')
+        count += 1
+    return count
+
+def write_parquet(rows,path,row_group_size=50000):
+    '''
+    Parquet is written one row group at a time so only row_group_size
+    rows are ever held in memory.
+    '''
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit('Parquet output needs pyarrow: pip3 install pyarrow')
+
+    schema = pa.schema([('play_time',pa.timestamp('s'))] + [(c,pa.string()) for c,k in COLUMNS[1:]])
+    writer = pq.ParquetWriter(path,schema)
+
+    def flush(batch):
+        columns = dict((c,[r[k] for r in batch]) for c,k in COLUMNS)
+        writer.write_table(pa.table(columns,schema=schema))
+
+    count = 0
+    batch = []
+    try:
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= row_group_size:
+                flush(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            flush(batch)
+            count += len(batch)
+    finally:
+        writer.close()
+
+    return count
+
+def export(db,station,start,end,fmt,output,chunk_size=1000):
+    '''
+    Write the station's history between start and end to output
+    (a path, or '-' for stdout). Returns the number of rows written.
+    '''
+    with db:
+        rows = db.iter_station_history(station,start,end,chunk_size=chunk_size)
+
+        if fmt == 'parquet':
+            if output == '-':
+                raise SystemExit('Parquet output needs a file name')
+            return write_parquet(rows,output)
+
+        writers = {'csv':write_csv,'jsonl':write_jsonl}
+        if output == '-':
+            return writers[fmt](rows,sys.stdout)
+        with open(output,'w',newline='') as out:
+            return writers[fmt](rows,out)
+
+def _date(value):
+    for fmt in ('%Y-%m-%d %H:%M:%S','%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value,fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('Dates look like 2017-01-31 or "2017-01-31 13:00:00"')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a station\'s play history')
+    parser.add_argument('--config',help='Config file with the [database] credentials',default='PlaylistDatabaseConfig.ini')
+    parser.add_argument('--station',required=True,help='Station name')
+    parser.add_argument('--start',type=_date,default=None,help='First play time to include')
+    parser.add_argument('--end',type=_date,default=None,help='Only include plays before this')
+    parser.add_argument('--format',choices=['csv','jsonl','parquet'],default='csv')
+    parser.add_argument('--output',default='-',help='Output file, - for stdout')
+    parser.add_argument('--chunk-size',type=int,default=1000,help='Rows fetched from the database at a time')
+    args = parser.parse_args()
+
+    db = PlaylistDatabase(config_file=args.config,connect=False)
+    count = export(db,args.station,args.start,args.end,args.format,args.output,args.chunk_size)
+    print('Exported %d plays.'%(count,),file=sys.stderr)
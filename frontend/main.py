@@ -1,5 +1,6 @@
-from flask import Flask, request, render_template,url_for,redirect
+from flask import Flask, Response, request, render_template,url_for,redirect
 from PlaylistDatabase import PlaylistDatabase
+from youtube_links import get_youtube_id
 
 #import IPython
 
@@ -7,37 +8,36 @@ db = PlaylistDatabase(config_file='/home/pi/PlaylistDatabase/PlaylistDatabaseCon
 
 app = Flask(__name__)
 
-def get_youtube_id(video):
+# Search results per page
+SEARCH_PAGE_SIZE = 100
 
-    # Strip anything leading up to the ID
-    video = video.split('://youtu.be/')[-1]
-    video = video.split('youtube.com/watch?v=')[-1]
+# Written by main.py every minute
+SCHEDULER_STATUS_FILE = '/home/pi/PlaylistDatabase/scheduler_status.json'
+QUOTA_STATUS_FILE = '/home/pi/PlaylistDatabase/quota_status.json'
 
-    # Try to strip any requests
-    if '?' in video:
-        video = video[0:video.find('?')]
-    # Strip more junk (playlists)
-    if '&' in video:
-        video = video[0:video.find('&')]
-
-    return video
-        
 def lookup_track_by_id(ytid):
-    video = 'https://youtu.be/'+get_youtube_id(ytid)
     
-    with db as cursor:
-       cursor.execute('''SELECT Track.id, Track.track_name, Artist.artist_name, Album.album_name, Track.youtube_link from Track JOIN Artist JOIN Album WHERE Track.youtube_link = %s AND Track.album_id=Album.id AND Track.artist_id=Artist.id''',(video,))
-       tracks = cursor.fetchall()
+    with db:
+       tracks = db.lookup_tracks_by_video(ytid)
     
     return tracks
 
-def get_track_last_play_stats(track_id):
+def get_track_last_play_stats(stats):
+
+    # Never played
+    if stats is None:
+        return 'Never'
 
-    return 'Unknown'
+    stations = ', '.join('%s (%d)'%(name,count) for name,count,last_play in stats['stations'])
+    return '%s, %d plays on %s'%(stats['last_play'].strftime('%Y-%m-%d %H:%M'),stats['play_count'],stations)
 
 def make_track_info_dict(track_list):
     tracks = []
 
+    # One lookup in TrackStats for the whole page
+    with db:
+        stats = db.get_track_stats([t[0] for t in track_list])
+
     for t in track_list:
 
         track_id, track_name,artist_name,album_name,youtube_link = t
@@ -49,7 +49,7 @@ def make_track_info_dict(track_list):
         this_track['artist'] = artist_name
         this_track['album'] = album_name
         this_track['youtube_id'] = get_youtube_id(youtube_link)
-        this_track['last_play'] = get_track_last_play_stats(track_id)
+        this_track['last_play'] = get_track_last_play_stats(stats.get(track_id))
 
         #this_track['replace_url'] = url_for('replace_ytid',uid=track_id)
         this_track['uid_url'] = url_for('uid_info',uid=track_id)
@@ -108,8 +108,10 @@ def replace_ytid(uid):
 
     new_id = 'https://youtu.be/' + get_youtube_id(new_id)
 
-    with db as cursor:
-        cursor.execute('''UPDATE Track SET youtube_link=%s WHERE Track.id=%s''',(new_id,track_dict['uid']))
+    # This keeps reads on the primary for a while afterwards, so the
+    # page we redirect to has the new video even if the replicas don't yet
+    with db:
+        db.set_track_youtube_link(track_dict['uid'],new_id)
         print('uid: ' + uid + ' new_id: ' + new_id)
 
     return redirect(track_dict['uid_url'])
@@ -159,25 +161,60 @@ def make_track_search():
     show_video = request.form.getlist('show_video')
     show_video = (show_video == ['on'])
 
-    video = 'https://youtu.be/'+get_youtube_id(url)
-   
-    with db as cursor: 
-        cursor.execute('''SELECT Track.id, Track.track_name, Artist.artist_name, Album.album_name, Track.youtube_link from Track JOIN Artist JOIN Album WHERE Track.track_name LIKE %s AND Track.youtube_link LIKE %s AND Album.album_name LIKE %s AND Artist.artist_name LIKE %s AND Track.album_id=Album.id AND Track.artist_id=Artist.id''',('%'+title+'%',video+'%','%'+album+'%','%'+artist+'%',))
+    # It comes back from the page, but anyone can post anything
+    try:
+        offset = max(0,int(request.form.get('offset',0)))
+    except ValueError:
+        offset = 0
+
+    video_id = get_youtube_id(url)
+    video = 'https://youtu.be/'+video_id
 
-        tracks = cursor.fetchall()
+    with db:
+        tracks = db.search_tracks(title,album,artist,video_id,limit=SEARCH_PAGE_SIZE,offset=offset)
 
     track_info = make_track_info(tracks,show_video)
 
-    return render_template('track_search_result.html',search_results=track_info,youtube_id=video)
+    # A full page means there may be more
+    next_offset = offset+SEARCH_PAGE_SIZE if len(tracks) == SEARCH_PAGE_SIZE else None
+
+    return render_template('track_search_result.html',search_results=track_info,youtube_id=video,
+                           form=request.form,next_offset=next_offset)
 
 @app.route('/latest')
 def show_lastest():
 
     # Get the lastest track from each channel
 
-    station_data = db.get_station_data()
+    with db:
+        station_data = db.get_station_data()
     return(str(station_data))
 
+@app.route('/metrics')
+def metrics():
+
+    # Query, cache, and pool counters for Prometheus to scrape
+    return Response(db.metrics(),mimetype='text/plain; version=0.0.4')
+
+def status_file_response(status_file):
+    try:
+        with open(status_file) as f:
+            return Response(f.read(),mimetype='application/json')
+    except FileNotFoundError:
+        return Response('{"error": "main.py has not written a status yet"}',status=503,mimetype='application/json')
+
+@app.route('/scheduler')
+def scheduler_status():
+
+    # When each station is next polled and why, as main.py last saw it
+    return status_file_response(SCHEDULER_STATUS_FILE)
+
+@app.route('/quota')
+def quota_status():
+
+    # Today's youtube quota spending by station and by endpoint
+    return status_file_response(QUOTA_STATUS_FILE)
+
 @app.route('/')
 def main():
     return redirect(url_for('make_track_search'))
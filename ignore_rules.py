@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import re
+
+# How a rule's pattern is compared against an artist or title
+EXACT = 'exact'        # Equal, byte for byte
+CASEFOLD = 'casefold'  # Equal, ignoring case
+REGEX = 'regex'        # re.search() finds the pattern anywhere in it
+MATCH_TYPES = (EXACT,CASEFOLD,REGEX)
+
+# What a rule is compared against
+ARTIST = 'artist'
+TITLE = 'title'
+FIELDS = (ARTIST,TITLE)
+
+def check_rule(field,match_type,pattern):
+    '''
+    Raise ValueError if a rule can't be used
+    '''
+    if field not in FIELDS:
+        raise ValueError('Ignore rule field must be one of ' + str(FIELDS) + ', not ' + repr(field))
+    if match_type not in MATCH_TYPES:
+        raise ValueError('Ignore rule match type must be one of ' + str(MATCH_TYPES) + ', not ' + repr(match_type))
+    if match_type == REGEX:
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            raise ValueError('Bad ignore rule regex ' + repr(pattern) + ': ' + str(e))
+
+class IgnoreMatcher():
+    '''
+    All of one station's rules for one field, compiled once.
+    Exact and casefolded rules are set lookups. Regex rules are each
+    compiled on their own, since joining them into one alternation
+    breaks inline flags, named groups, and backreferences that are
+    fine in a rule by itself.
+    '''
+
+    def __init__(self,rules=()):
+        exact = set()
+        casefolded = set()
+        regexes = []
+        for match_type,pattern in rules:
+            if match_type == EXACT:
+                exact.add(pattern)
+            elif match_type == CASEFOLD:
+                casefolded.add(pattern.casefold())
+            elif match_type == REGEX:
+                regexes.append(re.compile(pattern))
+
+        self._exact = frozenset(exact)
+        self._casefolded = frozenset(casefolded)
+        self._regexes = tuple(regexes)
+        self.rules = tuple(rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def matches(self,value):
+        if value is None:
+            return False
+        if value in self._exact:
+            return True
+        if self._casefolded and value.casefold() in self._casefolded:
+            return True
+        return any(regex.search(value) is not None for regex in self._regexes)
+
+class IgnoreList(list):
+    '''
+    The patterns of a station's rules for one field, as a list (that's
+    what get_station_data has always handed out), except that `in`
+    goes through the compiled matcher instead of scanning the list.
+    Changing the list doesn't change the rules; use the PlaylistDatabase
+    ignore rule functions for that.
+    '''
+
+    def __init__(self,matcher):
+        list.__init__(self,[pattern for match_type,pattern in matcher.rules])
+        self.matcher = matcher
+
+    def __contains__(self,value):
+        return self.matcher.matches(value)
+
+class StationIgnoreRules():
+    '''
+    The compiled artist and title rules for a station
+    '''
+
+    def __init__(self,rules=()):
+        '''
+        rules is an iterable of (field,match_type,pattern)
+        '''
+        rules = list(rules)
+        self.artists = IgnoreMatcher([(m,p) for f,m,p in rules if f == ARTIST])
+        self.titles = IgnoreMatcher([(m,p) for f,m,p in rules if f == TITLE])
+
+    def ignores(self,artist,title):
+        return self.artists.matches(artist) or self.titles.matches(title)
+
+    def __repr__(self):
+        return 'StationIgnoreRules(artists=' + str(len(self.artists)) + ', titles=' + str(len(self.titles)) + ')'
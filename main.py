@@ -1,9 +1,49 @@
 #!/usr/bin/env python3
 
-from time import sleep
-import random
+#
+# Polls every active station and adds any new song to the database and
+# the station's youtube playlist.
+#
+# Each station is polled when its song is likely to have ended, going by
+# how long its songs have been (see station_schedule.py), rather than
+# every 120(ish) seconds. Stations that keep playing the same thing get
+# polled less and less, down to once every --max-interval seconds. What
+# the scheduler is up to is written to --status-file every minute, which
+# the frontend serves at /scheduler.
+#
+# Whether a known song's video is still up is cached, checks from the
+# workers are batched into one videos.list call, and every video in the
+# catalog is re-checked once every --video-sweep-hours in the
+# background (see video_check.py).
+#
+# Youtube searches are cached in the database for --search-cache-days,
+# by a normalized "artist title" query, so a song whose album text came
+# out different this time doesn't cost another search (search_cache.py).
+#
+# Every youtube call goes through a QuotaBudget (quota.py) that shares
+# the day's quota between the stations, by the [quota] and
+# [quota_priorities] sections of the config file. Calls it refuses are
+# skipped, or for playlist inserts queued until there's quota again.
+# What's been spent is written to --quota-status-file every minute,
+# which the frontend serves at /quota.
+#
+# Stations are updated --workers at a time, each worker with its own
+# database connection (from the pool) and its own youtube clients. A
+# station that takes more than --station-timeout seconds is left behind
+# so it can't hold up the rest. The scrape and the youtube requests are
+# given the same timeout, so a worker stuck on one is freed again
+# (the lookup gets it as channel_dict['timeout'] for its requests).
+#
+#   python3 main.py --workers 10 --station-timeout 60
+#
+
+import os
+import json
+from time import time
+import argparse
+from configparser import ConfigParser
 import signal as sig
-from threading import Event
+from threading import Event, local
 from datetime import datetime as dt
 from traceback import print_exc
 
@@ -11,27 +51,111 @@ from traceback import print_exc
 from apiclient.errors import HttpError
 import youtube_search
 import youtube_playlist
+from youtube_links import get_youtube_id
 
 # The playlist database
 from PlaylistDatabase import PlaylistDatabase
+from station_pool import StationPoller
+from station_schedule import StationScheduler
+from video_check import VideoChecker
+from search_cache import SearchCache
+from quota import QuotaBudget, QuotaDeferred, HIGH, NORMAL, LOW, TRIM_ITEMS
+from ignore_rules import StationIgnoreRules, IgnoreList
 
 # The secret sauce - a function that takes in the channel dict
 # and figures out if there's a new song
 from lookup import lookup_info_from_channel_dict
 
 end_event = Event() 
-pldb = PlaylistDatabase(config_file='PlaylistDatabaseConfig.ini',connect=False) # The database
-searcher = youtube_search.YoutubeSearcher() # When searching for songs in youtube
-ytpl = youtube_playlist.YoutubePlaylist() # For manipulating youtube playlists
+pldb = None # The database, made in main() once we know how many workers there are
+video_checker = None # Made in main() too
+search_cache = None # And this
+budget = None # And the youtube quota
+
+# Station name -> (artist, title) it was playing at its last poll, added
+# or not. Only one update of a station runs at a time.
+last_seen = {}
+
+# Handed to the lookup so it leaves ignored songs in, see grabinfo
+NO_RULES = StationIgnoreRules()
+
+# Seconds before a scrape or youtube request gives up, --station-timeout
+request_timeout = None
+
+# How often (seconds) the station list is re-read, the status file
+# written, and a summary printed
+STATION_REFRESH = 300
+STATUS_INTERVAL = 60
+SUMMARY_INTERVAL = 600
+
+# Plays each station's song lengths are first learned from
+HISTORY_PLAYS = 50
+
+# Deferred youtube jobs run per trip round the main loop
+DEFERRED_PER_LOOP = 2
+
+# The google API client isn't thread safe, so every worker thread makes
+# its own searcher and playlist client the first time it needs them
+youtube_clients = local()
+
+def get_youtube_clients():
+    if not hasattr(youtube_clients,'searcher'):
+        youtube_clients.searcher = youtube_search.YoutubeSearcher(request_timeout) # When searching for songs in youtube
+        youtube_clients.ytpl = youtube_playlist.YoutubePlaylist(request_timeout) # For manipulating youtube playlists
+    return youtube_clients.searcher,youtube_clients.ytpl
 
 def siginthandler(signum,frame):
     print('Got signal')
     end_event.set()    
 
-def grabinfo(channel_dict,db):
+def check_videos(video_ids):
+    # On whichever thread needs the answer, with its own client. A batch
+    # is shared between stations, so no one station pays for it.
+    searcher,ytpl = get_youtube_clients()
+    calls = -(-len(video_ids)//searcher.MAX_VIDEO_IDS)
+    return budget.call('videos.list',None,HIGH,searcher.valid_videos,video_ids,units=calls)
+
+def search_youtube(query,max_results):
+    searcher,ytpl = get_youtube_clients()
+    return budget.call('search.list',getattr(youtube_clients,'station',None),NORMAL,
+                       searcher.youtube_search,query,max_results)
+
+def catalog_video_ids(after_id,limit):
+    # The sweep can wait for a day with quota to spare
+    if not budget.allow('videos.list',None,LOW):
+        print('Video sweep: stopping, saving the youtube quota for the stations')
+        return []
+    with pldb:
+        return pldb.get_video_ids(after_id,limit)
+
+def add_to_playlist(name,ytid,playlist_id):
+    '''
+    Add a video to a station's youtube playlist, making room if it's full.
+    Raises QuotaDeferred if the budget won't have it.
+    '''
+    searcher,ytpl = get_youtube_clients()
+    try:
+        budget.call('playlistItems.insert',name,NORMAL,ytpl.add_video_to_playlist,ytid,playlist_id)
+    except HttpError as e:
+        if e._get_reason() == 'Playlist contains maximum number of items.':
+            print('%s: playlist is too large. Removing the last %d items.'%(name,TRIM_ITEMS))
+            budget.call('playlist.trim',name,LOW,ytpl.remove_last_videos_from_playlist,playlist_id,TRIM_ITEMS)
+            budget.call('playlistItems.insert',name,NORMAL,ytpl.add_video_to_playlist,ytid,playlist_id)
+
+def video_is_valid(ytid):
+    try:
+        return video_checker.is_valid(ytid)
+    except QuotaDeferred:
+        # Can't check without quota, so trust it
+        return True
+
+def grabinfo(channel_dict,db,searcher,ytpl):
     '''
     Given a channel dictionary containing information about a channel
-    Scrape the artist and title
+    Scrape the artist and title. Returns (added, changed): whether a
+    song was added, and whether the station has moved on to a song it
+    wasn't playing at the last poll. A new song that is ignored, can't
+    be found on youtube, or is skipped for lack of quota still changed.
     '''
     site=channel_dict['site']
     lastartist = channel_dict['lastartist']
@@ -41,7 +165,7 @@ def grabinfo(channel_dict,db):
     name = channel_dict['name']
     playlist_id = channel_dict['playlist']
     #playlist_date = channel_dict['playlist']['date']
-    print('Updating channel %s'%(name,))
+    print('%s: updating'%(name,))
 
     # This function checks the state of the channel. If there is a new
     # song that should be added to the DB/Youtube then it will return it.
@@ -52,76 +176,274 @@ def grabinfo(channel_dict,db):
     # we give it the entire dict). In a custom implmentation this can
     # actually do whatever you want but I wanted to abstract as much 
     # of the functionality as possible out of the main.
-    artist,song,album = lookup_info_from_channel_dict(channel_dict)
+    #
+    # Except the ignore rules, which are checked here so the scheduler
+    # still hears about an ignored song.
+    artist,song,album = lookup_info_from_channel_dict(dict(channel_dict,ignore=NO_RULES,
+                                                           ignoreartists=IgnoreList(NO_RULES.artists),
+                                                           ignoretitles=IgnoreList(NO_RULES.titles),
+                                                           timeout=request_timeout))
     
-    print('Last song: "' + str(lastsong) + '" Last artist: "' + str(lastartist) + '"')
-    print('This song: "' + str(song) + '" This artist: "' + str(artist) + '" This album: "' + str(album)+'"')
+    # Other stations are printing at the same time, so every line says whose it is
+    print(name + ': last song: "' + str(lastsong) + '" Last artist: "' + str(lastartist) + '"')
+    print(name + ': this song: "' + str(song) + '" This artist: "' + str(artist) + '" This album: "' + str(album)+'"')
     
+    changed = False
     if artist != None:
+        changed = last_seen.get(name) != (artist,song)
+        last_seen[name] = (artist,song)
+        if channel_dict['ignore'].ignores(artist,song):
+            print('%s: ignoring this song.'%(name,))
+            return False,changed
             
         # Before we look up the song on youtube see if there
         # is already an entry for this one
         try:
-            print('Looking up in database...')
+            print('%s: looking up in database...'%(name,))
             url = db.look_up_song_youtube(artist,album,song)
-            # Getting this ID assumes we always have a youtube short URL
-            ytid = url.split('youtu.be/')[1] # HTTPS Indifferent
+            ytid = get_youtube_id(url)
 
             # Make sure the video hasn't been taken down.
-            if not searcher.is_video_valid(ytid):
-                # Trigger it to look up the track again.
-                print('Video ' + ytid + ' has ben taken down. Re-searching.')
-                raise LookupError
+            if not video_is_valid(ytid):
+                # The link may be from a cache entry older than a fix
+                # made in the frontend, so ask the database itself
+                # before replacing it
+                url = db.look_up_song_youtube(artist,album,song,use_cache=False)
+                if get_youtube_id(url) == ytid or not video_is_valid(get_youtube_id(url)):
+                    # Trigger it to look up the track again.
+                    print(name + ': video ' + ytid + ' has ben taken down. Re-searching.')
+                    raise LookupError
+                ytid = get_youtube_id(url)
+                print('%s: link was changed since we cached it, using %s'%(name,url))
 
         except LookupError:
             # Ok, look it up             
-            print('Song not found in DB. Looking up in youtube.')   
-            (url,ytid)=searcher.get_most_viewed_link(artist+' '+song)
+            print('%s: song not found in DB. Looking up in youtube.'%(name,))
+            try:
+                (url,ytid)=search_cache.get_most_viewed_link(artist+' '+song)
+            except QuotaDeferred:
+                print('%s: no youtube quota to search with, skipping this song.'%(name,))
+                return False,changed
             
         if url!='':
-            print('URL Found. Adding to station DB playlist.')
+            print('%s: URL Found. Adding to station DB playlist.'%(name,))
             time_now = dt.now()
-            print('Url: %s'%url)
+            print('%s: url: %s'%(name,url))
             db.add_track_to_station_playlist(name,artist,album,song,time_now,url)
-            print('Adding to youtube playlist')
+            print('%s: adding to youtube playlist'%(name,))
             try:
-                ytpl.add_video_to_playlist(ytid,playlist_id)
-            except HttpError as e:
-                if e._get_reason() == 'Playlist contains maximum number of items.':
-                    print('Playlist is too large. Removing the last 100 items.')
-                    ytpl.remove_last_videos_from_playlist(playlist_id)
-                    ytpl.add_video_to_playlist(id,playlist_id)
-            print('Done')
+                add_to_playlist(name,ytid,playlist_id)
+            except QuotaDeferred:
+                print('%s: no youtube quota, adding to the playlist later.'%(name,))
+                budget.defer('playlistItems.insert',name,NORMAL,add_to_playlist,name,ytid,playlist_id)
+            print('%s: done'%(name,))
+            return True,changed
         else:
-            print('Url not found.')
+            print('%s: url not found.'%(name,))
+    return False,changed
+
+def update_station(channel_dict):
+    '''
+    One worker's job: update a station on this thread's own database
+    connection and youtube clients
+    '''
+    searcher,ytpl = get_youtube_clients()
+    # Who the youtube calls on this thread are charged to
+    youtube_clients.station = channel_dict['name']
+    with pldb:
+        # The station list is only re-read every few minutes, so get
+        # the last song now or we'd add the same one again
+        channel_dict = pldb.get_station_data(channel_dict['name'])
+        if not channel_dict['active']:
+            print('Skipping channel: ' + channel_dict['name'])
+            return False,False
+        return grabinfo(channel_dict,pldb,searcher,ytpl)
 
+def refresh_stations(scheduler,stations,now):
+    '''
+    Re-read the active stations. New ones get their song lengths from
+    their recent plays. Returns station name -> channel dict.
+    '''
+    with pldb:
+        active = dict((c['name'],c) for c in pldb.get_station_data(stations_only=True) if c['active'])
+        scheduler.set_stations(active,now)
+        budget.set_stations(active)
+        for name in active:
+            if name not in stations:
+                tracks = pldb.get_latest_station_tracks(name,HISTORY_PLAYS)
+                scheduler.learn(name,[t['time'] for t in tracks],now)
+    return active
 
-def main():
+def make_budget(config_file):
+    '''
+    The youtube quota budget from the [quota] and [quota_priorities]
+    sections of the config file
+    '''
+    config = ConfigParser()
+    # Station names are case sensitive
+    config.optionxform = str
+    config.read(config_file)
+    quota = config['quota'] if config.has_section('quota') else {}
+    priorities = {}
+    if config.has_section('quota_priorities'):
+        priorities = dict((name,float(weight)) for name,weight in config['quota_priorities'].items())
+    return QuotaBudget(daily_units=int(quota.get('daily_units',10000)),reserve=float(quota.get('reserve',0.05)),
+                       priorities=priorities,reset_utc_hour=int(quota.get('reset_utc_hour',8)))
+
+def setup_youtube(config_file,db,search_cache_days=30,quota_status_file=None,video_check_ttl=None):
+    '''
+    Make the quota budget, video checker, and search cache grabinfo
+    uses. db is where the search cache lives. main_async.py sets up
+    the same way.
+    '''
+    global video_checker, search_cache, budget
+
+    budget = make_budget(config_file)
+    # Today's spending from before a restart
+    if quota_status_file is not None:
+        try:
+            with open(quota_status_file) as f:
+                if budget.restore(json.load(f)):
+                    print('Youtube quota: %d units spent today already'%(budget.status()['spent'],))
+        except (OSError,ValueError,KeyError):
+            pass
+
+    if video_check_ttl is not None:
+        video_checker = VideoChecker(check_videos,ttl=video_check_ttl)
+    else:
+        video_checker = VideoChecker(check_videos)
+
+    search_cache = SearchCache(search_youtube,db,max_age=search_cache_days*86400,video_checker=video_checker)
+
+def write_status(status_file,status):
+    # Write then rename, so the frontend never reads half a file
+    temp_file = status_file + '.tmp'
+    with open(temp_file,'w') as f:
+        json.dump(status,f,indent=1)
+    os.replace(temp_file,status_file)
+
+
+def main(config_file='PlaylistDatabaseConfig.ini',workers=10,station_timeout=60,
+         min_interval=20,max_interval=600,status_file='scheduler_status.json',video_sweep_hours=24,
+         search_cache_days=30,quota_status_file='quota_status.json'):
+    global pldb, request_timeout
+
+    # A connection for every worker plus one for this thread. The
+    # config file's pool_size wins if it has one.
+    pldb = PlaylistDatabase(config_file=config_file,connect=False,pool_size=workers+1)
+
+    # Scrapes and youtube calls that never answer fail instead of
+    # holding a worker forever. Only those requests, not every socket
+    # (the database has its own timeouts).
+    request_timeout = station_timeout
+
+    # Make this thread's clients now so a missing login is found before
+    # the workers start
+    get_youtube_clients()
+
+    # A sweep refreshes every answer well before it expires
+    setup_youtube(config_file,pldb,search_cache_days,quota_status_file,
+                  2*video_sweep_hours*3600 if video_sweep_hours > 0 else None)
+    if video_sweep_hours > 0:
+        video_checker.start_sweeping(catalog_video_ids,video_sweep_hours*3600)
+
+    poller = StationPoller(update_station,workers,station_timeout)
+    scheduler = StationScheduler(min_interval,max_interval)
+
+    stations = {}
+    next_refresh = next_status = 0
+    next_summary = time() + SUMMARY_INTERVAL
+    polls = added = errors = 0
 
-    # Run this script every 120(ish) seconds and try to get the next song
     while (not end_event.isSet()):
-        sleeptime = random.randint(100,140)
+        now = time()
         try:
-            # Re-open and close the conntection every time 
-            with pldb:
-                for channel_dict in pldb.get_station_data():
-                    print() 
-                    if(channel_dict['active']):
-                        grabinfo(channel_dict,pldb)
-                        #sleeptime-=10
-                    else:
-                        print('Skipping channel: ' + channel_dict['name'])
+            if now >= next_refresh:
+                stations = refresh_stations(scheduler,stations,now)
+                next_refresh = now + STATION_REFRESH
+
+            # Only take as many as there are free workers, the rest
+            # stay due and go first next time round
+            free = workers - poller.busy()
+            if free > 0:
+                for name in scheduler.due(now,free):
+                    if not poller.submit(stations[name]):
+                        print('%s: still stuck in an earlier update'%(name,))
+                        scheduler.record(name,False,error=True)
+
+            results = poller.collect(timeout=1)
+
+            # Playlist inserts that had to wait for quota
+            ran = budget.run_deferred(DEFERRED_PER_LOOP)
+            for name,result in results:
+                failed = result['error'] or result['timed_out'] or result.get('skipped',False)
+                scheduler.record(name,result['changed'],error=failed)
+                polls += 1
+                added += result['added']
+                errors += failed
+
+            now = time()
+            if now >= next_status:
+                status = scheduler.status(now)
+                status['busy_workers'] = poller.busy()
+                status['workers'] = workers
+                write_status(status_file,status)
+                write_status(quota_status_file,budget.status(now))
+                next_status = now + STATUS_INTERVAL
+
+            if now >= next_summary:
+                print('Scheduler: %d stations, %d polls, %d songs added, %d errors in the last %d seconds'%(
+                      len(stations),polls,added,errors,SUMMARY_INTERVAL))
+                print('Song cache: ' + str(pldb.song_cache_stats()))
+                print('Video checks: ' + str(video_checker.stats()))
+                with pldb:
+                    search_cache.evict()
+                print('Search cache: ' + str(search_cache.stats()))
+                quota = budget.status(now)
+                print('Youtube quota: %d of %d units spent today, %d calls waiting (%d dropped), breaker %s'%(
+                      quota['spent'],quota['daily_units'],quota['deferred'],quota['dropped'],
+                      'open' if quota['breaker_open'] else 'closed'))
+                polls = added = errors = 0
+                next_summary = now + SUMMARY_INTERVAL
+
+            if not results and not ran and not poller.busy():
+                # Nothing running, wait for the next station to come due
+                next_due = scheduler.next_due()
+                end_event.wait(min(1,max(0,next_due - now)) if next_due is not None else 1)
         except:
             print_exc()
             print('Got exception')
+            end_event.wait(10)
 
-        if sleeptime <=0:
-            sleeptime=10
-        print('Sleeping for %d seconds'%(sleeptime,))
-        while (sleeptime > 0) and (not end_event.isSet()):
-            sleep(1)
-            sleeptime -=1
+    video_checker.stop()
+    poller.close()
+    write_status(quota_status_file,budget.status())
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Poll every station and add new songs')
+    parser.add_argument('--config',default='PlaylistDatabaseConfig.ini')
+    parser.add_argument('--workers',type=int,default=10,help='Stations updated at once')
+    parser.add_argument('--station-timeout',type=int,default=60,help='Seconds before giving up on a station')
+    parser.add_argument('--min-interval',type=int,default=20,help='Least seconds between polls of a station')
+    parser.add_argument('--max-interval',type=int,default=600,help='Most seconds between polls of a station')
+    parser.add_argument('--status-file',default=None,
+                        help='Where the scheduler status goes (default scheduler_status.json next to the config)')
+    parser.add_argument('--video-sweep-hours',type=float,default=24,
+                        help='Hours between re-checks of every video in the catalog (0 for never)')
+    parser.add_argument('--search-cache-days',type=float,default=30,help='Days a youtube search result is reused for')
+    parser.add_argument('--quota-status-file',default=None,
+                        help='Where the youtube quota spending goes (default quota_status.json next to the config)')
+    args = parser.parse_args()
+
+    config_dir = os.path.dirname(os.path.abspath(args.config))
+    status_file = args.status_file
+    if status_file is None:
+        status_file = os.path.join(config_dir,'scheduler_status.json')
+    quota_status_file = args.quota_status_file
+    if quota_status_file is None:
+        quota_status_file = os.path.join(config_dir,'quota_status.json')
+
     sig.signal(sig.SIGINT,siginthandler)
-    main()
+    main(args.config,args.workers,args.station_timeout,args.min_interval,args.max_interval,status_file,args.video_sweep_hours,
+         args.search_cache_days,quota_status_file)
+    print('Waiting for any station updates still running...')
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+#
+# main.py's poll loop on asyncio and AsyncPlaylistDatabase.
+#
+# Every active station is updated at the same time (up to --concurrency
+# at once) instead of one after another, so a slow station site or a
+# slow query only holds up its own station. Scraping and the youtube
+# API are blocking libraries, so each station's update is main.grabinfo
+# run in a thread, with the same search cache, quota budget, and video
+# checks as main.py. Its database calls are handed back to the event
+# loop and run on AsyncPlaylistDatabase's pool.
+#
+#   python3 main_async.py --concurrency 20
+#
+
+import os
+import random
+import asyncio
+import argparse
+import signal as sig
+from time import perf_counter
+from traceback import print_exc
+from concurrent.futures import ThreadPoolExecutor
+
+import main as poller
+from AsyncPlaylistDatabase import AsyncPlaylistDatabase
+
+class BlockingDatabase():
+    '''
+    AsyncPlaylistDatabase for code running in another thread, like
+    main.grabinfo and the search cache. Each call is run on the event
+    loop and waited for.
+    '''
+
+    def __init__(self,db,loop):
+        self._db = db
+        self._loop = loop
+
+    def __getattr__(self,name):
+        func = getattr(self._db,name)
+        if not asyncio.iscoroutinefunction(func):
+            # The cache functions
+            return func
+        def call(*args,**kwargs):
+            return asyncio.run_coroutine_threadsafe(func(*args,**kwargs),self._loop).result()
+        return call
+
+def update_station(channel_dict,db):
+    '''
+    One station's update, on an executor thread
+    '''
+    # Who the youtube calls on this thread are charged to
+    poller.youtube_clients.station = channel_dict['name']
+    searcher,ytpl = poller.get_youtube_clients()
+    return poller.grabinfo(channel_dict,db,searcher,ytpl)
+
+async def poll_cycle(db,blocking_db,concurrency):
+    '''
+    Update every active station once. Returns how many were updated.
+    '''
+    loop = asyncio.get_event_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def update(channel_dict):
+        async with semaphore:
+            try:
+                await loop.run_in_executor(None,update_station,channel_dict,blocking_db)
+            except Exception:
+                # One bad station shouldn't stop the others
+                print_exc()
+                print('Got exception updating ' + channel_dict['name'])
+
+    stations = [c for c in await db.get_station_data() if c['active']]
+    poller.budget.set_stations(dict((c['name'],c) for c in stations))
+    await asyncio.gather(*[update(c) for c in stations])
+
+    # Playlist inserts that had to wait for quota
+    await loop.run_in_executor(None,poller.budget.run_deferred,poller.DEFERRED_PER_LOOP)
+    return len(stations)
+
+async def main(config_file,concurrency,search_cache_days=30,quota_status_file='quota_status.json'):
+    end_event = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(sig.SIGINT,end_event.set)
+    # A thread for every station being updated
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+
+    async with AsyncPlaylistDatabase(config_file=config_file,pool_size=concurrency) as db:
+        blocking_db = BlockingDatabase(db,loop)
+        poller.setup_youtube(config_file,blocking_db,search_cache_days,quota_status_file)
+
+        # Run every 120(ish) seconds and try to get the next song
+        while not end_event.is_set():
+            sleeptime = random.randint(100,140)
+            t0 = perf_counter()
+            try:
+                count = await poll_cycle(db,blocking_db,concurrency)
+                print('Updated %d stations in %.1f seconds'%(count,perf_counter()-t0))
+                await loop.run_in_executor(None,poller.search_cache.evict)
+                poller.write_status(quota_status_file,poller.budget.status())
+            except Exception:
+                print_exc()
+                print('Got exception')
+
+            print('Sleeping for %d seconds'%(sleeptime,))
+            try:
+                await asyncio.wait_for(end_event.wait(),sleeptime)
+            except asyncio.TimeoutError:
+                pass
+
+        poller.video_checker.stop()
+        poller.write_status(quota_status_file,poller.budget.status())
+
+    print('Got signal')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Poll every station concurrently')
+    parser.add_argument('--config',default='PlaylistDatabaseConfig.ini')
+    parser.add_argument('--concurrency',type=int,default=10,help='Stations updated at once')
+    parser.add_argument('--search-cache-days',type=float,default=30,help='Days a youtube search result is reused for')
+    parser.add_argument('--quota-status-file',default=None,
+                        help='Where the youtube quota spending goes (default quota_status.json next to the config)')
+    args = parser.parse_args()
+
+    quota_status_file = args.quota_status_file
+    if quota_status_file is None:
+        quota_status_file = os.path.join(os.path.dirname(os.path.abspath(args.config)),'quota_status.json')
+
+    asyncio.get_event_loop().run_until_complete(main(args.config,args.concurrency,args.search_cache_days,
+                                                     quota_status_file))
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+
+#
+# Versioned schema migrations for the playlist database (MySQL).
+# The SQLite backend keeps its own list, see backends.py.
+#
+# PlaylistDatabase runs any pending migrations when it connects. If the
+# configured user isn't allowed to change the schema (see INSTALLING)
+# run this file as a user that is:
+#
+#   python3 migrations.py --config PlaylistDatabaseConfig.ini
+#
+# Migrations in MANUAL_MIGRATIONS lock a busy table against writes while
+# they run, so they're left for this to do at a quiet time. PlaylistDatabase
+# says when one is waiting and carries on without it.
+#
+# and check that the hot queries use their indexes with:
+#
+#   python3 migrations.py --config PlaylistDatabaseConfig.ini --check
+#
+# Every migration must be safe to run again on a database where it (or
+# part of it) has already been applied. Only ever add to the end of
+# MIGRATIONS.
+#
+
+import ast
+import sys
+import argparse
+import datetime
+
+# Only one process gets to migrate at a time
+MIGRATION_LOCK = 'PlaylistDB_migrate'
+MIGRATION_LOCK_TIMEOUT = 60
+
+def table_exists(cur,table):
+    cur.execute('''SELECT COUNT(*) FROM information_schema.TABLES
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s''',(table,))
+    return cur.fetchone()[0] > 0
+
+def column_exists(cur,table,column):
+    cur.execute('''SELECT COUNT(*) FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s''',(table,column))
+    return cur.fetchone()[0] > 0
+
+def index_exists(cur,table,index):
+    cur.execute('''SELECT COUNT(*) FROM information_schema.STATISTICS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s''',(table,index))
+    return cur.fetchone()[0] > 0
+
+def add_index(cur,table,index,columns):
+    '''
+    Add an index without blocking reads or writes to the table
+    '''
+    if index_exists(cur,table,index):
+        return
+    cur.execute('ALTER TABLE ' + table + ' ADD INDEX ' + index + ' (' + columns + '), ALGORITHM=INPLACE, LOCK=NONE')
+
+def mark_rebuild_pending(cur,name,how):
+    '''
+    Summary tables start out empty, since filling them from a big
+    history at startup would hold up every process waiting to migrate.
+    If there's any history this notes that the table named name has to
+    be rebuilt (PlaylistDatabase reads from the history until it has)
+    and says how.
+    '''
+    cur.execute('''CREATE TABLE IF NOT EXISTS PendingRebuild (
+        name VARCHAR(64) NOT NULL,
+        since DATETIME NOT NULL,
+
+        PRIMARY KEY (name)
+    )''')
+    cur.execute('''SELECT Playlist.id FROM Playlist LIMIT 1''')
+    if cur.fetchall():
+        cur.execute('''INSERT IGNORE INTO PendingRebuild(name,since) VALUES (%s, %s)''',
+                    (name,datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        print(name + ' needs to be filled from the history, run: ' + how)
+
+#
+# The migrations. Each one takes a cursor.
+#
+
+def _station_ignore_rules(cur):
+    '''
+    One row per ignore rule instead of the str(list) in
+    Station.ignore_artists and Station.ignore_titles. The old lists are
+    copied in as exact rules and the old columns are left alone.
+    '''
+    if table_exists(cur,'StationIgnoreRule'):
+        return
+
+    cur.execute('''CREATE TABLE IF NOT EXISTS StationIgnoreRule (
+        id  INTEGER NOT NULL AUTO_INCREMENT UNIQUE,
+        station_id INTEGER NOT NULL,
+        field VARCHAR(16) NOT NULL,
+        match_type VARCHAR(16) NOT NULL,
+        pattern VARCHAR(256) NOT NULL,
+
+        PRIMARY KEY (id),
+        FOREIGN KEY (station_id) REFERENCES Station(id) ON UPDATE CASCADE,
+        UNIQUE(station_id,field,match_type,pattern)
+    )''')
+
+    cur.execute('''SELECT Station.id, Station.ignore_artists, Station.ignore_titles FROM Station''')
+    rules = []
+    for station_id,ignore_artists,ignore_titles in cur.fetchall():
+        for field,value in (('artist',ignore_artists),('title',ignore_titles)):
+            try:
+                patterns = ast.literal_eval(value) if value else []
+            except (ValueError,SyntaxError):
+                print('Could not read the ' + field + ' ignore list for station ' + str(station_id))
+                continue
+            for pattern in patterns:
+                rules.append((station_id,field,'exact',pattern))
+
+    if rules:
+        cur.executemany('''
+        INSERT IGNORE INTO StationIgnoreRule(station_id,field,match_type,pattern)
+        VALUES ( %s, %s, %s, %s )''',rules)
+
+def _playlist_station_play_time_index(cur):
+    '''
+    get_latest_station_tracks and get_station_data find a station's
+    newest plays. With only KEY(station_id) that sorts the station's
+    whole history.
+    '''
+    add_index(cur,'Playlist','station_play_time','station_id, play_time')
+
+def _track_video_id(cur):
+    '''
+    The 11 character youtube video ID, so tracks can be found by video
+    with an index instead of scanning youtube_link.
+    '''
+    if not column_exists(cur,'Track','video_id'):
+        cur.execute('ALTER TABLE Track ADD COLUMN video_id CHAR(11) NULL, ALGORITHM=INPLACE, LOCK=NONE')
+    add_index(cur,'Track','video_id','video_id')
+
+def _track_search_fulltext(cur):
+    '''
+    FULLTEXT indexes on the track, album, and artist names for the
+    frontend's search. Building the first one rebuilds the table and
+    InnoDB won't take writes to it while that happens (LOCK=NONE isn't
+    allowed for FULLTEXT), so this one is manual. Until it's run the
+    search uses substring matches, and running servers switch over
+    within FULLTEXT_RECHECK_INTERVAL (backends.py) of it finishing.
+    '''
+    for table,index,column in (('Track','track_name_ft','track_name'),
+                               ('Album','album_name_ft','album_name'),
+                               ('Artist','artist_name_ft','artist_name')):
+        if not index_exists(cur,table,index):
+            cur.execute('ALTER TABLE ' + table + ' ADD FULLTEXT INDEX ' + index + ' (' + column + ')')
+
+def _track_stats(cur):
+    '''
+    Play counts and last play times per track, and per track and
+    station, so track pages don't have to aggregate the history.
+    PlaylistDatabase keeps them up to date as plays are added, and
+    track_stats.py rebuild fills them from the history.
+    '''
+    cur.execute('''CREATE TABLE IF NOT EXISTS TrackStats (
+        track_id INTEGER NOT NULL,
+        play_count INTEGER NOT NULL,
+        last_play DATETIME NOT NULL,
+
+        PRIMARY KEY (track_id),
+        FOREIGN KEY (track_id) REFERENCES Track(id) ON UPDATE CASCADE ON DELETE CASCADE
+    )''')
+
+    cur.execute('''CREATE TABLE IF NOT EXISTS TrackStationStats (
+        track_id INTEGER NOT NULL,
+        station_id INTEGER NOT NULL,
+        play_count INTEGER NOT NULL,
+        last_play DATETIME NOT NULL,
+
+        PRIMARY KEY (track_id,station_id),
+        FOREIGN KEY (track_id) REFERENCES Track(id) ON UPDATE CASCADE ON DELETE CASCADE,
+        FOREIGN KEY (station_id) REFERENCES Station(id) ON UPDATE CASCADE ON DELETE CASCADE
+    )''')
+
+    mark_rebuild_pending(cur,'track_stats','python3 track_stats.py rebuild')
+
+def _daily_plays(cur):
+    '''
+    Plays per day per station, per station and track, and per station
+    and artist, for top-N and trend questions that would otherwise
+    GROUP BY the whole history. PlaylistDatabase keeps them up to date
+    as plays are added, and daily_plays.py rebuild fills them from the
+    history.
+    '''
+    cur.execute('''CREATE TABLE IF NOT EXISTS DailyStationPlays (
+        station_id INTEGER NOT NULL,
+        day DATE NOT NULL,
+        play_count INTEGER NOT NULL,
+
+        PRIMARY KEY (station_id,day),
+        FOREIGN KEY (station_id) REFERENCES Station(id) ON UPDATE CASCADE ON DELETE CASCADE
+    )''')
+
+    cur.execute('''CREATE TABLE IF NOT EXISTS DailyTrackPlays (
+        station_id INTEGER NOT NULL,
+        day DATE NOT NULL,
+        track_id INTEGER NOT NULL,
+        play_count INTEGER NOT NULL,
+
+        PRIMARY KEY (station_id,day,track_id),
+        KEY (track_id,day),
+        KEY (day,track_id,play_count),
+        FOREIGN KEY (station_id) REFERENCES Station(id) ON UPDATE CASCADE ON DELETE CASCADE,
+        FOREIGN KEY (track_id) REFERENCES Track(id) ON UPDATE CASCADE ON DELETE CASCADE
+    )''')
+
+    cur.execute('''CREATE TABLE IF NOT EXISTS DailyArtistPlays (
+        station_id INTEGER NOT NULL,
+        day DATE NOT NULL,
+        artist_id INTEGER NOT NULL,
+        play_count INTEGER NOT NULL,
+
+        PRIMARY KEY (station_id,day,artist_id),
+        KEY (artist_id,day),
+        KEY (day,artist_id,play_count),
+        FOREIGN KEY (station_id) REFERENCES Station(id) ON UPDATE CASCADE ON DELETE CASCADE,
+        FOREIGN KEY (artist_id) REFERENCES Artist(id) ON UPDATE CASCADE ON DELETE CASCADE
+    )''')
+
+    mark_rebuild_pending(cur,'daily_plays','python3 daily_plays.py rebuild')
+
+def _search_cache(cur):
+    '''
+    Youtube search results by normalized query, so a song we've searched
+    for before (but can't match exactly, because the album text came out
+    different) doesn't cost another search.list.
+    '''
+    cur.execute('''CREATE TABLE IF NOT EXISTS SearchCache (
+        query VARCHAR(255) NOT NULL,
+        video_ids VARCHAR(600) NOT NULL,
+        searched_at DATETIME NOT NULL,
+        last_used DATETIME NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0,
+
+        PRIMARY KEY (query),
+        KEY (searched_at),
+        KEY (last_used)
+    )''')
+
+# (version, name, function). Versions must be in order and never reused.
+MIGRATIONS = [
+    (1,'station ignore rules',_station_ignore_rules),
+    (2,'Playlist (station_id, play_time) index',_playlist_station_play_time_index),
+    (3,'Track.video_id',_track_video_id),
+    (4,'full-text search indexes',_track_search_fulltext),
+    (5,'TrackStats and TrackStationStats',_track_stats),
+    (6,'daily play rollups',_daily_plays),
+    (7,'youtube search cache',_search_cache),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# Versions only run by "python3 migrations.py", never on startup
+MANUAL_MIGRATIONS = {4}
+
+def create_version_table(cur):
+    cur.execute('''CREATE TABLE IF NOT EXISTS SchemaVersion (
+        version INTEGER NOT NULL,
+        name VARCHAR(256) NOT NULL,
+        applied DATETIME NOT NULL,
+
+        PRIMARY KEY (version)
+    )''')
+
+def applied_versions(cur):
+    '''
+    The versions applied to the database. A manual migration can be
+    missing from the middle.
+    '''
+    if not table_exists(cur,'SchemaVersion'):
+        return set()
+    cur.execute('''SELECT SchemaVersion.version FROM SchemaVersion''')
+    return set(row[0] for row in cur.fetchall())
+
+def pending(cur,manual=True):
+    '''
+    The migrations that haven't been applied yet, leaving out the
+    manual ones unless manual is True
+    '''
+    applied = applied_versions(cur)
+    return [m for m in MIGRATIONS if m[0] not in applied and (manual or m[0] not in MANUAL_MIGRATIONS)]
+
+def migrate(conn,verbose=True,manual=False):
+    '''
+    Apply every pending migration in order, and the manual ones too if
+    manual is True. Each one is recorded as soon as it's done, so an
+    interrupted run picks up where it left off. Returns the list of
+    versions applied.
+    '''
+    cur = conn.cursor()
+
+    # Cheap check first so the common case is one query
+    todo = pending(cur)
+    if not manual:
+        for version,name,func in todo:
+            if version in MANUAL_MIGRATIONS and verbose:
+                print('Schema migration ' + str(version) + ' (' + name + ') locks tables while it runs, ' +
+                      'apply it at a quiet time with "python3 migrations.py"')
+        todo = [m for m in todo if m[0] not in MANUAL_MIGRATIONS]
+    if not todo:
+        return []
+
+    cur.execute('SELECT GET_LOCK(%s,%s)',(MIGRATION_LOCK,MIGRATION_LOCK_TIMEOUT))
+    if cur.fetchone()[0] != 1:
+        raise RuntimeError('Timed out waiting for another process to finish migrating')
+
+    applied = []
+    try:
+        create_version_table(cur)
+        # Someone else may have migrated while we waited for the lock
+        for version,name,func in pending(cur,manual):
+            if verbose:
+                print('Applying schema migration ' + str(version) + ': ' + name)
+            func(cur)
+            cur.execute('''INSERT INTO SchemaVersion(version,name,applied) VALUES (%s, %s, %s)''',
+                        (version,name,datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            conn.commit()
+            applied.append(version)
+    finally:
+        cur.execute('SELECT RELEASE_LOCK(%s)',(MIGRATION_LOCK,))
+        cur.fetchall()
+
+    return applied
+
+def migrate_if_allowed(conn,verbose=True):
+    '''
+    Like migrate(), but a user without ALTER/CREATE privileges just gets
+    a warning instead of an exception. Anything that needs the newer
+    schema will fail until someone runs the migrations.
+    '''
+    import mysql.connector as mysql
+    from mysql.connector import errorcode
+
+    try:
+        return migrate(conn,verbose)
+    except mysql.errors.ProgrammingError as e:
+        if e.errno not in (errorcode.ER_TABLEACCESS_DENIED_ERROR,errorcode.ER_DBACCESS_DENIED_ERROR,
+                           errorcode.ER_SPECIFIC_ACCESS_DENIED_ERROR):
+            raise
+        conn.rollback()
+        print('WARNING: The database schema is out of date and this user cannot update it.')
+        print('Run "python3 migrations.py --config <config file>" as a user with ALTER privileges.')
+        return []
+
+#
+# Query plan checks
+#
+
+# (description, query, params, table, index it should use)
+HOT_QUERIES = [
+    ('latest tracks for a station',
+     '''SELECT Playlist.track_id, Playlist.play_time FROM Playlist WHERE Playlist.station_id = %s
+     ORDER BY Playlist.play_time DESC LIMIT 1''',
+     (1,),'Playlist','station_play_time'),
+    ('latest play time per station',
+     '''SELECT Station.id, (SELECT MAX(Playlist.play_time) FROM Playlist
+     WHERE Playlist.station_id = Station.id) FROM Station''',
+     (),'Playlist','station_play_time'),
+    ('track by video id',
+     '''SELECT Track.id FROM Track WHERE Track.video_id = %s''',
+     ('dQw4w9WgXcQ',),'Track','video_id'),
+    ('track search by title',
+     '''SELECT Track.id FROM Track WHERE MATCH(Track.track_name) AGAINST (%s IN BOOLEAN MODE)''',
+     ('+rhapsody*',),'Track','track_name_ft'),
+]
+
+def check_query_plans(cur):
+    '''
+    EXPLAIN the hot queries and make sure they use the indexes the
+    migrations add. Returns a list of problems, empty if all is well.
+    '''
+    problems = []
+    for description,query,params,table,index in HOT_QUERIES:
+        cur.execute('EXPLAIN ' + query,params)
+        columns = [d[0] for d in cur.description]
+        rows = [dict(zip(columns,r)) for r in cur.fetchall()]
+
+        used = [r.get('key') for r in rows if r.get('table') == table]
+        if index not in used:
+            problems.append(description + ': expected index ' + index + ' on ' + table + ', plan used ' + str(used))
+    return problems
+
+
+if __name__ == '__main__':
+    import mysql.connector as mysql
+    from configparser import ConfigParser
+
+    parser = argparse.ArgumentParser(description='Apply playlist database schema migrations')
+    parser.add_argument('--config',help='Config file with the [database] credentials',default='PlaylistDatabaseConfig.ini')
+    parser.add_argument('--check',action='store_true',help='Only check that the hot queries use their indexes')
+    args = parser.parse_args()
+
+    config = ConfigParser()
+    config.read(args.config)
+    conn = mysql.connect(user=config['database']['user'],password=config['database']['password'],
+                         host=config['database']['host'],database=config['database'].get('database','PlaylistDB'))
+
+    if args.check:
+        problems = check_query_plans(conn.cursor())
+        for p in problems:
+            print(p)
+        if not problems:
+            print('All hot queries use their indexes.')
+        conn.close()
+        sys.exit(1 if problems else 0)
+    else:
+        applied = migrate(conn,manual=True)
+        print('Schema is at version ' + str(LATEST_VERSION) + ' (applied ' + str(len(applied)) + ')')
+
+    conn.close()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+#
+# Query instrumentation for PlaylistDatabase.
+#
+# Every cursor PlaylistDatabase hands out (including the ones the
+# frontend and the repair scripts get from "with db as cursor") is
+# wrapped in an InstrumentedCursor. It records, per statement template:
+#
+#   * how many times it ran
+#   * a latency histogram
+#   * how many rows were fetched back
+#
+# and prints any statement slower than the threshold, with its
+# parameters. The cost is two perf_counter() calls and a dictionary
+# update per statement.
+#
+
+import re
+import sys
+from time import perf_counter
+from threading import Lock
+from functools import lru_cache
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+
+_WHITESPACE = re.compile(r'\s+')
+# IN lists and multi-row VALUES are built with a placeholder per item.
+# Collapse them so every length counts as the same statement.
+_PLACEHOLDER_LIST = re.compile(r'%s(?:\s*,\s*%s)+')
+_ROW_LIST = re.compile(r'(\((?:%s\.\.\.|%s)\))(?:\s*,\s*\1)+')
+
+@lru_cache(maxsize=1024)
+def template(query):
+    '''
+    The statement with its whitespace and placeholder lists normalized
+    '''
+    query = _WHITESPACE.sub(' ',query).strip()
+    query = _PLACEHOLDER_LIST.sub('%s...',query)
+    return _ROW_LIST.sub(r'\1...',query)
+
+class _Statement():
+
+    __slots__ = ('calls','errors','seconds','rows','buckets','slowest')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.buckets = [0]*(len(BUCKETS)+1)
+        self.slowest = 0.0
+
+class QueryStats():
+    '''
+    Per-template counters, shared by every cursor of a PlaylistDatabase.
+    slow_query_seconds of None turns the slow query log off.
+    '''
+
+    def __init__(self,slow_query_seconds=0.5,log=None):
+        self.slow_query_seconds = slow_query_seconds
+        self.log = log if log is not None else self._print
+        self._statements = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def _print(message):
+        print(message,file=sys.stderr)
+
+    def record(self,query,seconds,params=None,error=False):
+        '''
+        Count one execution. Returns the statement's counters so
+        rows fetched later can be added to them.
+        '''
+        key = template(query)
+        with self._lock:
+            s = self._statements.get(key)
+            if s is None:
+                s = self._statements[key] = _Statement()
+            s.calls += 1
+            s.errors += error
+            s.seconds += seconds
+            if seconds > s.slowest:
+                s.slowest = seconds
+            for ii,bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    s.buckets[ii] += 1
+                    break
+            else:
+                s.buckets[-1] += 1
+
+        if self.slow_query_seconds is not None and seconds >= self.slow_query_seconds:
+            self.log('Slow query (%.3f s): %s %r'%(seconds,key,params))
+        return s
+
+    def add_rows(self,statement,rows):
+        with self._lock:
+            statement.rows += rows
+
+    def stats(self):
+        '''
+        A dictionary of template to its counters. 'buckets' are
+        cumulative counts for each BUCKETS bound, then everything.
+        '''
+        out = {}
+        with self._lock:
+            for key,s in self._statements.items():
+                cumulative = []
+                total = 0
+                for count in s.buckets:
+                    total += count
+                    cumulative.append(total)
+                out[key] = {
+                    'calls':s.calls,
+                    'errors':s.errors,
+                    'seconds':s.seconds,
+                    'mean_seconds':s.seconds/s.calls if s.calls else 0.0,
+                    'max_seconds':s.slowest,
+                    'rows':s.rows,
+                    'buckets':cumulative,
+                }
+        return out
+
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+
+    def prometheus(self,prefix='playlistdb_query'):
+        '''
+        The counters in Prometheus' text exposition format
+        '''
+        def label(key):
+            return key.replace('\\','\\\\').replace('"','\\"').replace('\n',' ')
+
+        lines = [
+            '# HELP ' + prefix + '_duration_seconds Statement latency by template',
+            '# TYPE ' + prefix + '_duration_seconds histogram',
+        ]
+        rows = [
+            '# HELP ' + prefix + '_rows_total Rows fetched by template',
+            '# TYPE ' + prefix + '_rows_total counter',
+        ]
+        errors = [
+            '# HELP ' + prefix + '_errors_total Statements that raised, by template',
+            '# TYPE ' + prefix + '_errors_total counter',
+        ]
+        for key,s in sorted(self.stats().items()):
+            q = 'query="' + label(key) + '"'
+            for bound,count in zip(BUCKETS,s['buckets']):
+                lines.append('%s_duration_seconds_bucket{%s,le="%g"} %d'%(prefix,q,bound,count))
+            lines.append('%s_duration_seconds_bucket{%s,le="+Inf"} %d'%(prefix,q,s['calls']))
+            lines.append('%s_duration_seconds_sum{%s} %.6f'%(prefix,q,s['seconds']))
+            lines.append('%s_duration_seconds_count{%s} %d'%(prefix,q,s['calls']))
+            rows.append('%s_rows_total{%s} %d'%(prefix,q,s['rows']))
+            errors.append('%s_errors_total{%s} %d'%(prefix,q,s['errors']))
+        return '\n'.join(lines + rows + errors) + '\n'
+
+class InstrumentedCursor():
+    '''
+    Wraps a DB-API cursor and reports to a QueryStats. Rows are counted
+    as they're fetched, against the last statement executed.
+    '''
+
+    def __init__(self,cursor,stats):
+        self._cursor = cursor
+        self._stats = stats
+        self._statement = None
+
+    def _run(self,method,query,params,logged_params):
+        t0 = perf_counter()
+        try:
+            result = method(query,params)
+        except:
+            self._statement = self._stats.record(query,perf_counter()-t0,logged_params,error=True)
+            raise
+        self._statement = self._stats.record(query,perf_counter()-t0,logged_params)
+        return result
+
+    def execute(self,query,params=()):
+        return self._run(self._cursor.execute,query,params,params)
+
+    def executemany(self,query,seq_of_params):
+        # Only the first row's parameters go in the slow query log
+        seq_of_params = list(seq_of_params)
+        return self._run(self._cursor.executemany,query,seq_of_params,seq_of_params[:1])
+
+    def _count(self,rows):
+        if self._statement is not None and rows:
+            self._stats.add_rows(self._statement,rows)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        self._count(row is not None)
+        return row
+
+    def fetchmany(self,*args,**kwargs):
+        rows = self._cursor.fetchmany(*args,**kwargs)
+        self._count(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._count(len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._count(1)
+            yield row
+
+    def __getattr__(self,name):
+        return getattr(self._cursor,name)
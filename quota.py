@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+import calendar
+import datetime
+from time import time
+from threading import Lock
+from traceback import print_exc
+
+# Quota units each YouTube Data API call costs
+COSTS = {
+    'search.list':100,
+    'videos.list':1,
+    'playlistItems.list':1,
+    'playlistItems.insert':50,
+    'playlistItems.delete':50,
+    'playlists.insert':50,
+}
+
+# youtube_playlist.remove_last_videos_from_playlist, run when a playlist
+# is full (MAX_PLAYLIST_ITEMS): it pages through every item with
+# playlistItems.list, 50 at a time, then deletes the last TRIM_ITEMS
+MAX_PLAYLIST_ITEMS = 5000
+TRIM_ITEMS = 100
+COSTS['playlist.trim'] = (-(-MAX_PLAYLIST_ITEMS//50)*COSTS['playlistItems.list'] +
+                          TRIM_ITEMS*COSTS['playlistItems.delete'])
+
+# How much a call matters, for deciding what goes first when quota
+# runs low.
+# Cheap calls that save expensive ones, like checking a video before
+# searching for a new one
+HIGH = 'high'
+# Adding the song we just heard
+NORMAL = 'normal'
+# Anything that can wait for tomorrow, like the video sweep and
+# trimming full playlists
+LOW = 'low'
+
+class QuotaDeferred(Exception):
+    '''
+    The budget said no (or youtube said the quota is gone). The call
+    wasn't made.
+    '''
+
+def is_quota_error(e):
+    '''
+    True for the HttpError youtube gives once the day's quota is gone
+    '''
+    content = getattr(e,'content',None) or b''
+    if isinstance(content,str):
+        content = content.encode()
+    return b'quotaExceeded' in content or b'dailyLimitExceeded' in content
+
+class QuotaBudget():
+    '''
+    Keeps track of the youtube quota we've spent today and decides which
+    calls to make with what's left.
+
+    The day's daily_units (less a reserve, which only HIGH calls can
+    use) are shared between the stations by priority. A station can go
+    over its share while the day's spending is on pace, i.e. no more of
+    the quota has gone than of the day. Once it isn't, NORMAL calls from
+    stations over their share are refused. LOW calls only go ahead
+    while spending is on pace and the station is within its share.
+
+    If youtube says the quota is gone anyway (someone else used the same
+    project, or our costs are off) the breaker opens and nothing is
+    called until the quota resets, at midnight Pacific time (8:00 UTC
+    by default, an hour late in the summer, which is the safe side).
+
+    Calls that were refused can be deferred and run later with
+    run_deferred(), highest priority station first.
+    '''
+
+    def __init__(self,daily_units=10000,reserve=0.05,priorities=None,reset_utc_hour=8,max_deferred=500,now=None):
+        self.daily_units = daily_units
+        self.reserve = reserve
+        # Station name -> weight, 1 for any station not in here
+        self.priorities = dict(priorities or {})
+        self.reset_utc_hour = reset_utc_hour
+        self.max_deferred = max_deferred
+        self._lock = Lock()
+
+        self._stations = set()
+        self._deferred = []
+        self.dropped = 0
+        self.yesterday = None
+        self._reset(self._quota_day(time() if now is None else now))
+
+    def _reset(self,day):
+        self._day = day
+        self._spent = 0
+        # Station name (None for calls no one station asked for) -> units
+        self._by_station = {}
+        # Endpoint -> {'calls':..., 'units':..., 'denied':...}
+        self._by_endpoint = {}
+        # When the open breaker closes, or None
+        self._breaker = None
+
+    def _quota_day(self,now):
+        return (datetime.datetime.utcfromtimestamp(now) - datetime.timedelta(hours=self.reset_utc_hour)).date()
+
+    def _day_start(self,day):
+        return calendar.timegm(day.timetuple()) + self.reset_utc_hour*3600
+
+    def _roll(self,now):
+        day = self._quota_day(now)
+        # A call that started before a reset finishing after it
+        # shouldn't undo the reset
+        if day > self._day:
+            self.yesterday = {'day':str(self._day),'spent':self._spent,'stations':dict(self._by_station)}
+            self._reset(day)
+            print('Youtube quota reset, %d units for today'%(self.daily_units,))
+
+    def _endpoint(self,endpoint):
+        if endpoint not in self._by_endpoint:
+            self._by_endpoint[endpoint] = {'calls':0,'units':0,'denied':0}
+        return self._by_endpoint[endpoint]
+
+    def set_stations(self,names):
+        '''
+        The stations the quota is shared between
+        '''
+        with self._lock:
+            self._stations = set(names)
+
+    def priority(self,station):
+        return self.priorities.get(station,1)
+
+    def share(self,station):
+        '''
+        Units a station gets today before it's cut back
+        '''
+        total = sum(self.priority(s) for s in self._stations | {station})
+        return self.daily_units*(1-self.reserve)*self.priority(station)/total
+
+    def _on_pace(self,now,units):
+        # A little slack so the start of the day isn't all refusals
+        elapsed = (now - self._day_start(self._day))/86400
+        return self._spent + units <= self.daily_units*(1-self.reserve)*min(1,elapsed + 0.05)
+
+    def _within_share(self,station,units):
+        return station is None or self._by_station.get(station,0) + units <= self.share(station)
+
+    def _allow(self,station,value,units,now):
+        # With the lock held
+        self._roll(now)
+        if self._breaker is not None:
+            return False
+        left = self.daily_units - self._spent
+        if units > left:
+            return False
+        if value == HIGH:
+            return True
+        if left - units < self.daily_units*self.reserve:
+            return False
+        if value == NORMAL:
+            return self._within_share(station,units) or self._on_pace(now,units)
+        return self._within_share(station,units) and self._on_pace(now,units)
+
+    def _charge(self,endpoint,station,units,now):
+        # With the lock held
+        self._roll(now)
+        self._spent += units
+        self._by_station[station] = self._by_station.get(station,0) + units
+        spent = self._endpoint(endpoint)
+        spent['calls'] += 1
+        spent['units'] += units
+
+    def allow(self,endpoint,station=None,value=NORMAL,units=None,now=None):
+        '''
+        True if a call should be made now. Nothing is charged.
+        '''
+        units = COSTS[endpoint] if units is None else units
+        now = time() if now is None else now
+        with self._lock:
+            return self._allow(station,value,units,now)
+
+    def charge(self,endpoint,station=None,units=None,now=None):
+        '''
+        Count a call that was made
+        '''
+        units = COSTS[endpoint] if units is None else units
+        now = time() if now is None else now
+        with self._lock:
+            self._charge(endpoint,station,units,now)
+
+    def trip(self,now=None):
+        '''
+        Youtube says the quota's gone. Hold every call until it resets.
+        '''
+        now = time() if now is None else now
+        with self._lock:
+            self._roll(now)
+            if self._breaker is None:
+                self._breaker = self._day_start(self._day) + 86400
+                print('Youtube quota used up (%d units by our count), holding calls until %s'%(
+                      self._spent,datetime.datetime.fromtimestamp(self._breaker).strftime('%Y-%m-%d %H:%M')))
+
+    def call(self,endpoint,station,value,func,*args,units=None,now=None,**kwargs):
+        '''
+        func(*args,**kwargs) if the budget allows it, charged to station.
+        Raises QuotaDeferred if it doesn't, or if youtube says the quota
+        is gone.
+        '''
+        units = COSTS[endpoint] if units is None else units
+        now = time() if now is None else now
+        # Checked and charged in one go, so threads racing for the last
+        # of the quota can't all be allowed before any of them is charged.
+        # Youtube charges for calls that fail too.
+        with self._lock:
+            allowed = self._allow(station,value,units,now)
+            if allowed:
+                self._charge(endpoint,station,units,now)
+            else:
+                self._endpoint(endpoint)['denied'] += 1
+        if not allowed:
+            raise QuotaDeferred('%s for %s'%(endpoint,station))
+        try:
+            return func(*args,**kwargs)
+        except Exception as e:
+            if is_quota_error(e):
+                self.trip(now)
+                raise QuotaDeferred('%s for %s'%(endpoint,station)) from e
+            raise
+
+    def defer(self,endpoint,station,value,func,*args,units=None):
+        '''
+        Queue func(*args) for run_deferred(). func makes its calls through
+        call() itself. If the queue is full the oldest job of the lowest
+        priority station is dropped.
+        '''
+        with self._lock:
+            self._deferred.append((endpoint,station,value,units,func,args))
+            if len(self._deferred) > self.max_deferred:
+                lowest = min(range(len(self._deferred)),key=lambda ii: (self.priority(self._deferred[ii][1]),ii))
+                self._deferred.pop(lowest)
+                self.dropped += 1
+
+    def run_deferred(self,limit=5,now=None):
+        '''
+        Run up to limit deferred jobs that the budget allows now, highest
+        priority station first. Returns how many ran.
+        '''
+        with self._lock:
+            jobs = sorted(self._deferred,key=lambda job: -self.priority(job[1]))
+        ran = 0
+        for job in jobs:
+            if ran >= limit:
+                break
+            endpoint,station,value,units,func,args = job
+            if not self.allow(endpoint,station,value,units,now):
+                continue
+            with self._lock:
+                self._deferred.remove(job)
+            try:
+                func(*args)
+                ran += 1
+            except QuotaDeferred:
+                # Still not enough, back it goes
+                with self._lock:
+                    self._deferred.insert(0,job)
+                break
+            except Exception:
+                print_exc()
+                print('%s: deferred %s failed, dropping it'%(station,endpoint))
+        return ran
+
+    def status(self,now=None):
+        '''
+        Today's spending by station and by endpoint, and what's waiting
+        '''
+        now = time() if now is None else now
+        with self._lock:
+            self._roll(now)
+            stations = {}
+            for station in self._stations | set(s for s in self._by_station if s is not None):
+                stations[station] = {
+                    'units':self._by_station.get(station,0),
+                    'share':round(self.share(station)),
+                    'priority':self.priority(station),
+                    'deferred':sum(1 for job in self._deferred if job[1] == station),
+                }
+            return {
+                'day':str(self._day),
+                'daily_units':self.daily_units,
+                'spent':self._spent,
+                'left':self.daily_units - self._spent,
+                'reserve':round(self.daily_units*self.reserve),
+                'on_pace':self._on_pace(now,0),
+                'breaker_open':self._breaker is not None,
+                'resets_at':datetime.datetime.fromtimestamp(self._day_start(self._day) + 86400).strftime('%Y-%m-%d %H:%M:%S'),
+                'shared_units':self._by_station.get(None,0),
+                'stations':stations,
+                'endpoints':dict((e,dict(spent)) for e,spent in self._by_endpoint.items()),
+                'deferred':len(self._deferred),
+                'dropped':self.dropped,
+                'yesterday':self.yesterday,
+            }
+
+    def restore(self,status,now=None):
+        '''
+        Pick up today's spending from an earlier status(), so restarting
+        doesn't hand out the day's quota twice
+        '''
+        now = time() if now is None else now
+        with self._lock:
+            self._roll(now)
+            if status.get('day') != str(self._day):
+                return False
+            self._spent = status['spent']
+            self._by_station = dict((name,s['units']) for name,s in status['stations'].items())
+            if status.get('shared_units'):
+                self._by_station[None] = status['shared_units']
+            self._by_endpoint = dict((e,dict(spent)) for e,spent in status['endpoints'].items())
+            if status.get('breaker_open'):
+                self._breaker = self._day_start(self._day) + 86400
+            return True
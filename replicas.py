@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+from time import monotonic
+from threading import Lock
+
+class ReplicaSet():
+    '''
+    Read replicas of the primary database, handed out round robin.
+
+    Each replica's lag is checked at most every check_interval seconds,
+    on its own connection, with lag(). A replica more than max_lag
+    seconds behind, or one that isn't replicating or can't be reached,
+    is out of rotation until a later check finds it caught up. connect()
+    opens a connection to a host, so this doesn't care what driver is
+    behind it.
+    '''
+
+    def __init__(self,hosts,connect,lag,max_lag=10,check_interval=5):
+        self.hosts = list(hosts)
+        self._connect = connect
+        self._lag = lag
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+
+        # host -> (seconds behind or None, when it was checked)
+        self._state = {}
+        # host -> connection used for lag checks
+        self._monitors = {}
+        # Hosts a thread is checking right now
+        self._checking = set()
+        self._next = 0
+        self._lock = Lock()
+
+        self.picks = 0
+        self.removals = 0
+
+    def _check(self,host):
+        '''
+        How far behind host is. None if it isn't replicating or
+        can't be reached.
+        '''
+        try:
+            conn = self._monitors.get(host)
+            if conn is None:
+                conn = self._monitors[host] = self._connect(host)
+            return self._lag(conn)
+        except Exception:
+            conn = self._monitors.pop(host,None)
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            return None
+
+    def _refresh(self,host,now):
+        '''
+        Check host's lag if it's due. The check runs outside the lock so
+        a slow or unreachable replica doesn't hold up the other threads,
+        and only one thread checks a host at a time.
+        '''
+        with self._lock:
+            lag,checked = self._state.get(host,(None,None))
+            if checked is not None and now - checked < self.check_interval:
+                return
+            if host in self._checking:
+                return
+            self._checking.add(host)
+            was_usable = checked is not None and self._in_rotation(lag)
+        try:
+            lag = self._check(host)
+        finally:
+            with self._lock:
+                self._checking.discard(host)
+        with self._lock:
+            self._state[host] = (lag,now)
+            if was_usable and not self._in_rotation(lag):
+                self.removals += 1
+                print('Replica ' + host + ' taken out of rotation, ' +
+                      ('not replicating' if lag is None else str(lag) + ' seconds behind'))
+
+    def _in_rotation(self,lag):
+        return lag is not None and lag <= self.max_lag
+
+    def _lag_of(self,host):
+        return self._state.get(host,(None,None))[0]
+
+    def usable(self,host):
+        '''
+        True if host is in rotation, checking its lag if it's due
+        '''
+        self._refresh(host,monotonic())
+        with self._lock:
+            return self._in_rotation(self._lag_of(host))
+
+    def pick(self):
+        '''
+        The next replica in rotation, or None if none of them are
+        '''
+        now = monotonic()
+        with self._lock:
+            start = self._next
+        for ii in range(len(self.hosts)):
+            host = self.hosts[(start + ii) % len(self.hosts)]
+            self._refresh(host,now)
+            with self._lock:
+                if self._in_rotation(self._lag_of(host)):
+                    self._next = (start + ii + 1) % len(self.hosts)
+                    self.picks += 1
+                    return host
+        return None
+
+    def mark_down(self,host):
+        '''
+        Take host out of rotation until its next check
+        '''
+        with self._lock:
+            if self._in_rotation(self._lag_of(host)):
+                self.removals += 1
+            self._state[host] = (None,monotonic())
+
+    def close(self):
+        with self._lock:
+            monitors = self._monitors
+            self._monitors = {}
+        for conn in monitors.values():
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def stats(self):
+        return {
+            'replicas':dict((host,{'lag':self._lag_of(host),
+                                   'in_rotation':self._in_rotation(self._lag_of(host))})
+                            for host in self.hosts),
+            'max_lag':self.max_lag,
+            'picks':self.picks,
+            'removals':self.removals,
+        }
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+#
+# History retention for the Playlist table.
+#
+# Playlist only ever grows. On MySQL it can be split into monthly RANGE
+# partitions on play_time ("enable"), so a month of history is dropped
+# as a whole instead of deleted row by row, and queries on a play_time
+# range only read the partitions it covers. "rotate" keeps empty
+# partitions ready for the coming months.
+#
+# "purge" removes everything from before the start of the month
+# keep_months ago. With partitions that's a DROP PARTITION. Without
+# them (or on SQLite) rows are deleted in small batches in id order,
+# with a commit after each one, so the poller is never locked out for
+# long. TrackStats is kept in step either way. The daily rollups are
+# left alone, so top_tracks and the trends still cover purged months
+# (which is why purge won't run until they've been filled).
+#
+# "run" is rotate then purge, and is meant for cron:
+#
+#   15 3 * * * python3 retention.py --config PlaylistDatabaseConfig.ini run
+#
+# with the policy in the config file:
+#
+#   [retention]
+#   keep_months=24
+#   months_ahead=3
+#
+
+import argparse
+import datetime
+from time import sleep, perf_counter
+from configparser import ConfigParser
+
+import migrations
+from PlaylistDatabase import PlaylistDatabase, _chunks, _placeholders
+
+# Catches anything past the last monthly partition
+FUTURE_PARTITION = 'pfuture'
+
+def month_start(date):
+    return datetime.datetime(date.year,date.month,1)
+
+def add_months(date,months):
+    '''
+    The first day of the month months after date's
+    '''
+    month = date.year*12 + date.month-1 + months
+    return datetime.datetime(month//12,month%12+1,1)
+
+def retention_cutoff(keep_months,now=None):
+    '''
+    Plays before this are removed. keep_months of 0 keeps everything.
+    '''
+    if not keep_months:
+        return None
+    return add_months(now or datetime.datetime.now(),-keep_months)
+
+def partition_name(month):
+    return 'p%04d%02d'%(month.year,month.month)
+
+def get_partitions(cur):
+    '''
+    (name, upper bound) for each of Playlist's partitions in order. The
+    catch all partition's bound is None. Empty if it isn't partitioned.
+    '''
+    cur.execute('''SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'Playlist' AND PARTITION_NAME IS NOT NULL
+    ORDER BY PARTITION_ORDINAL_POSITION''')
+    partitions = []
+    for name,description in cur.fetchall():
+        if description == 'MAXVALUE':
+            partitions.append((name,None))
+        else:
+            # e.g. '2017-02-01'
+            partitions.append((name,datetime.datetime.strptime(description.strip("'")[:10],'%Y-%m-%d')))
+    return partitions
+
+def _partition_definitions(start,end):
+    '''
+    A partition per month from the one start is in up to end, then the
+    catch all
+    '''
+    definitions = []
+    month = month_start(start)
+    while month < end:
+        upper = add_months(month,1)
+        definitions.append("PARTITION %s VALUES LESS THAN ('%s')"%(partition_name(month),upper.strftime('%Y-%m-%d')))
+        month = upper
+    definitions.append('PARTITION ' + FUTURE_PARTITION + ' VALUES LESS THAN (MAXVALUE)')
+    return '(' + ', '.join(definitions) + ')'
+
+def _check_mysql(db):
+    if db._backend.name != 'mysql':
+        raise ValueError('Partitioning needs the MySQL backend, use purge without it')
+
+def enable_partitioning(db,months_ahead=3):
+    '''
+    Rebuild Playlist as monthly partitions, from its oldest play up to
+    months_ahead months from now. This copies the whole table and
+    blocks writes to it while it does, so stop the poller first.
+
+    Partitioned InnoDB tables can't have foreign keys, so Playlist's
+    are dropped, and every unique key has to include play_time, so the
+    primary key becomes (id, play_time). Returns False if Playlist was
+    already partitioned.
+
+    PlaylistDatabase used those foreign keys to notice a cached station
+    or track ID had been deleted (and look it up again). Without them it
+    checks the IDs exist with a query before every playlist insert
+    instead, see PlaylistDatabase._check_references. Processes started
+    before this ran still trust the cache, another reason to stop them.
+    '''
+    _check_mysql(db)
+    cur = db._cur
+    if get_partitions(cur):
+        return False
+
+    cur.execute('''SELECT MIN(Playlist.play_time) FROM Playlist''')
+    first = cur.fetchone()[0] or datetime.datetime.now()
+
+    cur.execute('''SELECT CONSTRAINT_NAME FROM information_schema.REFERENTIAL_CONSTRAINTS
+    WHERE CONSTRAINT_SCHEMA = DATABASE() AND TABLE_NAME = 'Playlist' ''')
+    for (name,) in cur.fetchall():
+        cur.execute('ALTER TABLE Playlist DROP FOREIGN KEY ' + name)
+
+    alter = 'ALTER TABLE Playlist DROP PRIMARY KEY, ADD PRIMARY KEY (id, play_time)'
+    # "id ... UNIQUE" made a unique index of its own
+    if migrations.index_exists(cur,'Playlist','id'):
+        alter += ', DROP INDEX id'
+    cur.execute(alter)
+
+    cur.execute('ALTER TABLE Playlist PARTITION BY RANGE COLUMNS(play_time) ' +
+                _partition_definitions(first,add_months(datetime.datetime.now(),months_ahead+1)))
+    db._backend.playlist_foreign_keys = False
+    return True
+
+def rotate_partitions(db,months_ahead=3,now=None):
+    '''
+    Split the catch all partition so there's one for every month up to
+    months_ahead from now. It should be empty, which makes this quick.
+    Returns the names of the partitions added.
+    '''
+    _check_mysql(db)
+    cur = db._cur
+    partitions = get_partitions(cur)
+    if not partitions:
+        return []
+
+    bounds = [bound for name,bound in partitions if bound is not None]
+    start = bounds[-1] if bounds else month_start(now or datetime.datetime.now())
+    end = add_months(now or datetime.datetime.now(),months_ahead+1)
+    if start >= end:
+        return []
+
+    cur.execute('ALTER TABLE Playlist REORGANIZE PARTITION ' + FUTURE_PARTITION + ' INTO ' +
+                _partition_definitions(start,end))
+    added = []
+    month = start
+    while month < end:
+        added.append(partition_name(month))
+        month = add_months(month,1)
+    return added
+
+def _remove_track_stats(cur,counts):
+    '''
+    Take plays that were deleted out of TrackStats and TrackStationStats.
+    counts is (track ID, station ID) to the number deleted.
+
+    Only plays older than the cutoff are deleted, so a track's last play
+    only changes if all of its plays go, and then its row is removed.
+    '''
+    tracks = {}
+    for (track_id,station_id),count in counts.items():
+        tracks[track_id] = tracks.get(track_id,0) + count
+
+    cur.executemany('''UPDATE TrackStats SET play_count = play_count - %s WHERE TrackStats.track_id = %s''',
+                    [(count,track_id) for track_id,count in tracks.items()])
+    cur.executemany('''UPDATE TrackStationStats SET play_count = play_count - %s
+    WHERE TrackStationStats.track_id = %s AND TrackStationStats.station_id = %s''',
+                    [(count,track_id,station_id) for (track_id,station_id),count in counts.items()])
+
+    for chunk in _chunks(tracks,1000):
+        cur.execute('''DELETE FROM TrackStationStats WHERE TrackStationStats.play_count <= 0
+        AND TrackStationStats.track_id IN (''' + _placeholders(len(chunk)) + ')',chunk)
+        cur.execute('''DELETE FROM TrackStats WHERE TrackStats.play_count <= 0
+        AND TrackStats.track_id IN (''' + _placeholders(len(chunk)) + ')',chunk)
+
+def purge_partitions(db,cutoff,verbose=True):
+    '''
+    Drop every monthly partition that ends on or before cutoff.
+    Returns the number of plays removed.
+    '''
+    _check_mysql(db)
+    cur = db._cur
+    old = [name for name,bound in get_partitions(cur) if bound is not None and bound <= cutoff]
+    if not old:
+        return 0
+
+    cur.execute('''SELECT Playlist.track_id, Playlist.station_id, COUNT(*) FROM Playlist
+    PARTITION (''' + ','.join(old) + ''') GROUP BY Playlist.track_id, Playlist.station_id''')
+    counts = dict(((track_id,station_id),count) for track_id,station_id,count in cur.fetchall())
+
+    # DROP PARTITION commits on its own, so the stats go first. If the
+    # drop fails "track_stats.py check --fix" puts them right.
+    _remove_track_stats(cur,counts)
+    db._conn.commit()
+    cur.execute('ALTER TABLE Playlist DROP PARTITION ' + ','.join(old))
+
+    removed = sum(counts.values())
+    if verbose:
+        print('Dropped %s (%d plays)'%(', '.join(old),removed))
+    return removed
+
+def purge_batches(db,cutoff,batch_size=1000,pause=0.0,verbose=True):
+    '''
+    Delete plays before cutoff batch_size at a time, walking Playlist
+    in id order so every batch starts where the last one stopped.
+    Returns the number of plays removed.
+    '''
+    cur = db._cur
+    last_id = 0
+    removed = 0
+    t0 = perf_counter()
+
+    while True:
+        cur.execute('''SELECT Playlist.id, Playlist.track_id, Playlist.station_id FROM Playlist
+        WHERE Playlist.id > %s AND Playlist.play_time < %s ORDER BY Playlist.id LIMIT %s''',
+                    (last_id,cutoff.strftime('%Y-%m-%d %H:%M:%S'),batch_size))
+        rows = cur.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        cur.execute('''DELETE FROM Playlist WHERE Playlist.id IN (''' + _placeholders(len(rows)) + ')',
+                    [row[0] for row in rows])
+        counts = {}
+        for playlist_id,track_id,station_id in rows:
+            counts[(track_id,station_id)] = counts.get((track_id,station_id),0) + 1
+        _remove_track_stats(cur,counts)
+        db._conn.commit()
+        removed += len(rows)
+
+        if verbose:
+            print('Up to play %d: %d removed (%.0f rows/s)'%(last_id,removed,removed/(perf_counter()-t0)))
+
+        # Give the poller a chance at the table
+        if pause:
+            sleep(pause)
+
+    return removed
+
+def purge(db,cutoff,batch_size=1000,pause=0.0,verbose=True):
+    '''
+    Remove plays before cutoff, by partition if Playlist has them
+    (cutoffs and partitions both start on the first of a month, so
+    nothing is left over) and in batches if it doesn't. Refuses to while
+    the daily rollups are still to be filled from the history, since
+    the purged plays would be lost from them.
+    '''
+    if db._rebuild_pending('daily_plays'):
+        raise RuntimeError('The daily rollups have not been filled yet, run "python3 daily_plays.py rebuild" before purging')
+    if db._backend.name == 'mysql' and get_partitions(db._cur):
+        return purge_partitions(db,cutoff,verbose)
+    return purge_batches(db,cutoff,batch_size,pause,verbose)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Playlist partitions and history retention')
+    parser.add_argument('action',choices=['enable','rotate','purge','run','show'])
+    parser.add_argument('--config',help='Config file with the [database] credentials',default='PlaylistDatabaseConfig.ini')
+    parser.add_argument('--keep-months',type=int,default=None,help='Months of history to keep, 0 for all of it')
+    parser.add_argument('--months-ahead',type=int,default=None,help='Empty monthly partitions to keep ready')
+    parser.add_argument('--batch-size',type=int,default=1000,help='Plays per delete without partitions')
+    parser.add_argument('--pause',type=float,default=0.0,help='Seconds to wait between delete batches')
+    args = parser.parse_args()
+
+    config = ConfigParser()
+    config.read(args.config)
+    retention = config['retention'] if config.has_section('retention') else {}
+    keep_months = args.keep_months if args.keep_months is not None else int(retention.get('keep_months',0))
+    months_ahead = args.months_ahead if args.months_ahead is not None else int(retention.get('months_ahead',3))
+
+    db = PlaylistDatabase(config_file=args.config)
+
+    if args.action == 'enable':
+        if enable_partitioning(db,months_ahead):
+            print('Playlist is now partitioned by month.')
+        else:
+            print('Playlist is already partitioned.')
+
+    if args.action in ('rotate','run') and db._backend.name == 'mysql' and get_partitions(db._cur):
+        added = rotate_partitions(db,months_ahead)
+        print('Added partitions: ' + (', '.join(added) if added else 'none needed'))
+
+    if args.action in ('purge','run'):
+        cutoff = retention_cutoff(keep_months)
+        if cutoff is None:
+            print('keep_months is 0, keeping all history.')
+        else:
+            print('Removed %d plays from before %s.'%(purge(db,cutoff,args.batch_size,args.pause),cutoff.date()))
+
+    if args.action == 'show':
+        partitions = get_partitions(db._cur) if db._backend.name == 'mysql' else []
+        for name,bound in partitions:
+            print('%-10s < %s'%(name,bound.date() if bound is not None else 'MAXVALUE'))
+        if not partitions:
+            print('Playlist is not partitioned.')
+
+    db.close()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import re
+import datetime
+import unicodedata
+from threading import Lock
+
+from quota import QuotaDeferred
+
+# Quota units a search.list call costs
+SEARCH_COST = 100
+
+# SearchCache.query is a VARCHAR(255)
+MAX_QUERY_LENGTH = 255
+
+_NOT_WORD = re.compile(r'[^\w]+')
+
+def normalize_query(query):
+    '''
+    The cache key for a search: lower case, accents and punctuation
+    gone, one space between words. "Beyoncé - Halo!" and "beyonce halo"
+    are the same search.
+    '''
+    query = unicodedata.normalize('NFKD',query.casefold())
+    query = ''.join(c for c in query if not unicodedata.combining(c))
+    query = query.replace('&',' and ')
+    query = _NOT_WORD.sub(' ',query).replace('_',' ')
+    return ' '.join(query.split())[:MAX_QUERY_LENGTH]
+
+class SearchCache():
+    '''
+    A youtube search that asks the SearchCache table first.
+
+    search(query,max_results) is YoutubeSearcher.youtube_search or
+    anything like it, and db is a PlaylistDatabase (the calling thread's
+    connection is used, so call this inside "with db:" if it's shared).
+    Results are kept for max_age seconds and searches that found nothing
+    for empty_max_age, since youtube might have the song tomorrow.
+
+    With a video_checker (see video_check.py) cached videos that have
+    been taken down are skipped, and if that leaves nothing we search
+    again. If the quota budget won't pay for the check the cached
+    videos are used as they are.
+
+    Looking up a search only reads, so it can go to a replica. Hits are
+    counted in memory and written out by evict().
+    '''
+
+    def __init__(self,search,db,max_age=30*86400,empty_max_age=86400,max_entries=100000,video_checker=None):
+        self._search = search
+        self._db = db
+        self.max_age = max_age
+        self.empty_max_age = empty_max_age
+        self.max_entries = max_entries
+        self._video_checker = video_checker
+        self._lock = Lock()
+
+        # query -> (hits, when the last one was) not written out yet
+        self._pending_hits = {}
+
+        self.hits = 0
+        self.misses = 0
+        # Hits where every video had been taken down
+        self.stale = 0
+        self.evicted = 0
+
+    def _count(self,counter):
+        with self._lock:
+            setattr(self,counter,getattr(self,counter) + 1)
+
+    def youtube_search(self,query,max_results=5):
+        key = normalize_query(query)
+        videos = self._db.get_search_result(key,self.max_age,self.empty_max_age) if key else None
+        if videos and self._video_checker is not None:
+            try:
+                valid = self._video_checker.check_many(videos)
+            except QuotaDeferred:
+                # Still a hit, and a search would cost more anyway
+                valid = dict.fromkeys(videos,True)
+            videos = [v for v in videos if valid[v]] or None
+            if videos is None:
+                self._count('stale')
+        if videos is not None:
+            with self._lock:
+                self.hits += 1
+                count,last_used = self._pending_hits.get(key,(0,None))
+                self._pending_hits[key] = (count+1,datetime.datetime.now())
+            return videos[:max_results]
+
+        self._count('misses')
+        videos = self._search(query,max_results)
+        if key:
+            self._db.put_search_result(key,videos)
+        return videos
+
+    def get_most_viewed_link(self,query,max_results=5):
+        '''
+        YoutubeSearcher.get_most_viewed_link, through the cache
+        '''
+        videos = self.youtube_search(query,max_results)
+        try:
+            video = videos[0]
+            return ('https://www.youtube.com/watch?v='+video,video)
+        except IndexError:
+            return ('','')
+
+    def evict(self):
+        '''
+        Write out the hits since last time, then drop old and least
+        recently used searches. Returns how many went.
+        '''
+        with self._lock:
+            hits = self._pending_hits
+            self._pending_hits = {}
+        if hits:
+            self._db.record_search_hits(hits,commit=False)
+        removed = self._db.evict_search_results(self.max_age,self.max_entries)
+        with self._lock:
+            self.evicted += removed
+        return removed
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits':self.hits,
+            'misses':self.misses,
+            'stale':self.stale,
+            'evicted':self.evicted,
+            'hit_rate':(self.hits/lookups) if lookups else 0.0,
+            'quota_saved':self.hits*SEARCH_COST,
+        }
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+from time import perf_counter
+from threading import Lock
+from traceback import print_exc
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+class StationPoller():
+    '''
+    Updates stations on a fixed number of worker threads.
+
+    update(channel_dict) is called once per submitted station, and
+    returns (added, changed): whether it added a song and whether the
+    station had a new one (added or not). Returning just added means
+    both. A station that takes longer than
+    timeout seconds (counted from when a worker picks it up, not from
+    when it was queued) is given up on. Its thread can't be stopped, so
+    the station can't be submitted again until that update returns.
+    '''
+
+    def __init__(self,update,workers=10,timeout=60):
+        self._update = update
+        self.workers = workers
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers,thread_name_prefix='station')
+
+        # Future -> station name, for updates we're waiting on
+        self._running = {}
+        # Station name -> when its update started
+        self._started = {}
+        # Station name -> future of an update that timed out and is
+        # still running
+        self._stuck = {}
+        self._lock = Lock()
+
+        self.cycles = 0
+
+    def _run(self,channel_dict):
+        t0 = perf_counter()
+        with self._lock:
+            self._started[channel_dict['name']] = t0
+        result = self._update(channel_dict)
+        added,changed = result if isinstance(result,tuple) else (result,result)
+        return bool(added),bool(changed),perf_counter()-t0
+
+    def busy(self):
+        '''
+        Workers in use or spoken for, stuck ones included
+        '''
+        self._forget_stuck()
+        return len(self._running) + len(self._stuck)
+
+    def _forget_stuck(self):
+        for name,future in list(self._stuck.items()):
+            if future.done():
+                print('%s: update from earlier finally returned'%(name,))
+                del self._stuck[name]
+
+    def submit(self,channel_dict):
+        '''
+        Queue a station's update. False if it's still stuck in an
+        earlier one (or already queued).
+        '''
+        name = channel_dict['name']
+        self._forget_stuck()
+        if name in self._stuck or name in self._running.values():
+            return False
+        self._running[self._executor.submit(self._run,channel_dict)] = name
+        return True
+
+    def collect(self,timeout=0.5):
+        '''
+        Wait up to timeout seconds for updates to finish. Returns (station
+        name, result) for each one that finished or timed out, where
+        result has 'added', 'changed', 'seconds', 'error', and 'timed_out'.
+        '''
+        results = []
+        if not self._running:
+            return results
+        done,pending = wait(list(self._running),timeout=timeout,return_when=FIRST_COMPLETED)
+        for future in done:
+            name = self._running.pop(future)
+            with self._lock:
+                self._started.pop(name,None)
+            if future.cancelled():
+                continue
+            try:
+                added,changed,seconds = future.result()
+                results.append((name,{'added':added,'changed':changed,'seconds':seconds,'error':False,'timed_out':False}))
+            except Exception:
+                # One bad station shouldn't stop the others
+                print_exc()
+                print('Got exception updating ' + name)
+                results.append((name,{'added':False,'changed':False,'seconds':0.0,'error':True,'timed_out':False}))
+
+        now = perf_counter()
+        with self._lock:
+            started = dict(self._started)
+        for future in pending:
+            name = self._running[future]
+            if name in started and now - started[name] > self.timeout:
+                print('%s: no answer after %d seconds, moving on'%(name,self.timeout))
+                del self._running[future]
+                self._stuck[name] = future
+                results.append((name,{'added':False,'changed':False,'seconds':now-started[name],'error':False,'timed_out':True}))
+
+        if len(self._stuck) >= self.workers:
+            # Nothing will pick up the rest
+            for future,name in list(self._running.items()):
+                if future.cancel():
+                    del self._running[future]
+                    results.append((name,{'added':False,'changed':False,'seconds':0.0,'error':False,'timed_out':False,
+                                          'skipped':True}))
+        return results
+
+    def poll(self,stations):
+        '''
+        Update every station in the list once and wait for them. Returns
+        stats for the cycle.
+        '''
+        t0 = perf_counter()
+        self.cycles += 1
+
+        skipped = 0
+        for channel_dict in stations:
+            if not self.submit(channel_dict):
+                skipped += 1
+
+        times = []
+        added = errors = timed_out = 0
+        while self._running:
+            for name,result in self.collect():
+                if result.get('skipped'):
+                    skipped += 1
+                elif result['timed_out']:
+                    timed_out += 1
+                elif result['error']:
+                    errors += 1
+                else:
+                    added += result['added']
+                    times.append(result['seconds'])
+
+        times.sort()
+        wall = perf_counter()-t0
+        return {
+            'stations':len(stations),
+            'updated':len(times),
+            'added':added,
+            'errors':errors,
+            'timed_out':timed_out,
+            'skipped':skipped,
+            'wall_s':wall,
+            # What the same updates would have taken one after another
+            'busy_s':sum(times),
+            'p50_s':times[len(times)//2] if times else 0.0,
+            'max_s':times[-1] if times else 0.0,
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+def format_cycle(stats):
+    return ('Cycle: %d stations in %.1f s (%.1f s of updates, %.1fx), %d songs added, '
+            '%d errors, %d timed out, %d skipped, slowest %.1f s'%(
+            stats['stations'],stats['wall_s'],stats['busy_s'],stats['busy_s']/max(stats['wall_s'],1e-9),
+            stats['added'],stats['errors'],stats['timed_out'],stats['skipped'],stats['max_s']))
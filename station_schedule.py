@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+import heapq
+import random
+import datetime
+from time import time
+from collections import deque
+
+def _seconds(t):
+    '''
+    Seconds since the epoch for a datetime, a play time string (which is
+    what sqlite hands back), or seconds
+    '''
+    if isinstance(t,str):
+        t = datetime.datetime.strptime(t[:19],'%Y-%m-%d %H:%M:%S')
+    if isinstance(t,datetime.datetime):
+        return t.timestamp()
+    return t
+
+class StationScheduler():
+    '''
+    Decides when each station is polled next, instead of polling them
+    all every 100-140 seconds.
+
+    Every station has a next due time in a heap. Song lengths are
+    learned per station from the gaps between its plays (learn() for
+    the history, then every change we see). After a new song the
+    station is left alone until the shorter songs it plays would be
+    ending. It's polled once when about two thirds of its songs would
+    have ended and again when nearly all of them would have (the
+    quantiles), and after that it's backed off (doubling from
+    min_interval up to max_interval) for as long as it keeps returning
+    the same song, which is what talk stations and ad breaks look like.
+
+    Times are seconds since the epoch and now can be passed in, so the
+    benchmark can run it on a simulated clock.
+    '''
+
+    def __init__(self,min_interval=20,max_interval=600,default_length=180,max_gap=1800,samples=30,quantiles=(0.65,0.95),
+                 jitter=0.1,seed=None):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.default_length = default_length
+        # Gaps longer than this are the station (or us) being off the air
+        self.max_gap = max_gap
+        self.samples = samples
+        # Fractions of a station's songs that should have ended at each
+        # poll after a new song, before backing off
+        self.quantiles = tuple(quantiles)
+        self.jitter = jitter
+        self._rng = random.Random(seed)
+
+        # (due, station name). Entries that don't match the station's
+        # current due time are stale and skipped.
+        self._heap = []
+        # Station name -> state
+        self._stations = {}
+
+        self.polls = 0
+        self.changes = 0
+
+    def _state(self,name,now):
+        state = self._stations.get(name)
+        if state is None:
+            state = self._stations[name] = {
+                'gaps':deque(maxlen=self.samples),
+                'last_change':None,
+                'last_poll':None,
+                'backoff':0,
+                'checks':0,
+                'due':None,
+                'running':False,
+                'polls':0,
+                'changes':0,
+                'reason':'new station',
+            }
+            # Spread new stations over the first min_interval seconds
+            self._schedule(name,now + self._rng.random()*self.min_interval,'new station')
+        return state
+
+    def _schedule(self,name,due,reason):
+        state = self._stations[name]
+        state['due'] = due
+        state['reason'] = reason
+        heapq.heappush(self._heap,(due,name))
+
+    def song_length_at(self,name,fraction):
+        '''
+        The song length fraction of a station's songs are shorter than
+        '''
+        gaps = sorted(self._stations[name]['gaps'])
+        if len(gaps) < 5:
+            return self.default_length*(0.5 + fraction)
+        return gaps[min(int(len(gaps)*fraction),len(gaps)-1)]
+
+    def song_lengths(self,name):
+        '''
+        (short, typical, long) song length for a station in seconds: the
+        10th, 50th, and 90th percentile of the gaps between its songs
+        '''
+        gaps = sorted(self._stations[name]['gaps']) if name in self._stations else []
+        if len(gaps) < 5:
+            return (self.default_length*0.75,self.default_length,self.default_length*1.5)
+        return tuple(gaps[min(int(len(gaps)*p),len(gaps)-1)] for p in (0.1,0.5,0.9))
+
+    def _add_gap(self,name,gap):
+        if self.min_interval/2 <= gap <= self.max_gap:
+            self._stations[name]['gaps'].append(gap)
+
+    def learn(self,name,play_times,now=None):
+        '''
+        Learn a station's song lengths from some of its play times
+        (datetimes, strings, or seconds, in any order)
+        '''
+        now = time() if now is None else now
+        state = self._state(name,now)
+        times = sorted(_seconds(t) for t in play_times)
+        for earlier,later in zip(times,times[1:]):
+            self._add_gap(name,later-earlier)
+        if times and (state['last_change'] is None or times[-1] > state['last_change']):
+            state['last_change'] = times[-1]
+
+    def set_stations(self,names,now=None):
+        '''
+        Poll these stations from now on, and forget any others
+        '''
+        now = time() if now is None else now
+        names = set(names)
+        for name in list(self._stations):
+            if name not in names:
+                del self._stations[name]
+        for name in names:
+            self._state(name,now)
+
+    def due(self,now=None,limit=None):
+        '''
+        Names of the stations due by now, most overdue first, up to
+        limit of them. They're marked running until record() is called.
+        '''
+        now = time() if now is None else now
+        names = []
+        while self._heap and self._heap[0][0] <= now and (limit is None or len(names) < limit):
+            due,name = heapq.heappop(self._heap)
+            state = self._stations.get(name)
+            if state is None or state['due'] != due or state['running']:
+                continue
+            state['running'] = True
+            names.append(name)
+        return names
+
+    def next_due(self):
+        '''
+        The earliest due time, or None if there are no stations
+        '''
+        while self._heap:
+            due,name = self._heap[0]
+            state = self._stations.get(name)
+            if state is not None and state['due'] == due and not state['running']:
+                return due
+            heapq.heappop(self._heap)
+        return None
+
+    def record(self,name,changed,now=None,error=False):
+        '''
+        A poll of name finished. changed is True if it had a new song.
+        Schedules the next poll and returns when it's due.
+        '''
+        now = time() if now is None else now
+        state = self._stations.get(name)
+        if state is None:
+            # Removed while it was running
+            return None
+        previous_poll = state['last_poll']
+        state['running'] = False
+        state['polls'] += 1
+        state['last_poll'] = now
+        self.polls += 1
+
+        if changed:
+            # The song started some time since the last poll. Taking the
+            # middle keeps the gaps from creeping up to match however
+            # long we happened to wait.
+            started = (previous_poll + now)/2 if previous_poll is not None else now
+            if state['last_change'] is not None:
+                self._add_gap(name,started - state['last_change'])
+            state['last_change'] = started
+            state['changes'] += 1
+            state['backoff'] = 0
+            state['checks'] = 0
+            self.changes += 1
+
+        since = now - state['last_change'] if state['last_change'] is not None else None
+        if since is not None and state['checks'] < len(self.quantiles):
+            fraction = self.quantiles[state['checks']]
+            state['checks'] += 1
+            end = self.song_length_at(name,fraction)
+            interval = max(self.min_interval,end - since)
+            reason = ('new song' if changed else 'same song for %ds'%(since,)) + ', %d%% of songs end by %ds'%(
+                      100*fraction,end)
+        else:
+            state['backoff'] += 1
+            interval = min(self.max_interval,self.min_interval*2**state['backoff'])
+            reason = ('error, backing off' if error else
+                      'same song for %s, backing off'%('%ds'%(since,) if since is not None else 'ever'))
+
+        # So stations that changed together don't stay in step
+        interval *= 1 + self.jitter*(self._rng.random()*2 - 1)
+        due = now + max(self.min_interval*(1-self.jitter),min(self.max_interval,interval))
+        self._schedule(name,due,reason)
+        return due
+
+    def status(self,now=None):
+        '''
+        What the scheduler thinks of every station, soonest due first
+        '''
+        now = time() if now is None else now
+        stations = []
+        for name,state in self._stations.items():
+            short,typical,long = self.song_lengths(name)
+            stations.append({
+                'name':name,
+                'due_in':round(state['due'] - now,1) if state['due'] is not None else None,
+                'running':state['running'],
+                'reason':state['reason'],
+                'song_length':round(typical),
+                'song_length_range':[round(short),round(long)],
+                'samples':len(state['gaps']),
+                'since_change':round(now - state['last_change']) if state['last_change'] is not None else None,
+                'backoff':state['backoff'],
+                'polls':state['polls'],
+                'changes':state['changes'],
+            })
+        stations.sort(key=lambda s: s['due_in'] if s['due_in'] is not None else float('inf'))
+        return {
+            'time':datetime.datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S'),
+            'stations':stations,
+            'polls':self.polls,
+            'changes':self.changes,
+        }
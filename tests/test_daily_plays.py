@@ -0,0 +1,82 @@
+import os
+import shutil
+import datetime
+import tempfile
+import unittest
+from unittest import mock
+
+import migrations
+import PlaylistDatabase as playlist_database
+import retention
+from PlaylistDatabase import PlaylistDatabase
+
+class DailyPlaysTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory,'test.sqlite')
+        self.db = PlaylistDatabase(backend='sqlite',path=self.path,initialize=True)
+        self.db.create_station('A','a.site',[],[],'A.Playlist')
+        self.db.create_station('B','b.site',[],[],'B.Playlist')
+        for station,title,day,hour in (('A','One',1,12),('A','One',2,12),('A','Two',2,13),('B','Two',5,12),('B','Two',5,13)):
+            self.db.add_track_to_station_playlist(station,'Artist',title,title,datetime.datetime(2017,1,day,hour))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def migrated_history(self):
+        '''
+        A database that had this history before the migration made the
+        (empty) rollups
+        '''
+        cur = self.db._conn.cursor()
+        for table in ('DailyStationPlays','DailyTrackPlays','DailyArtistPlays'):
+            cur.execute('DELETE FROM ' + table)
+        migrations.mark_rebuild_pending(cur,'daily_plays','daily_plays.py rebuild')
+        self.db._conn.commit()
+        return PlaylistDatabase(backend='sqlite',path=self.path)
+
+    def answers(self,db):
+        return ([row[1:] for row in db.top_tracks('2017-01-01','2017-02-01')],
+                db.top_artists('2017-01-01','2017-02-01','A'),
+                db.station_trend('A','2017-01-01','2017-01-04'),
+                db.track_trend(db.top_tracks('2017-01-01','2017-02-01')[0][0],'2017-01-01','2017-02-01',granularity='month'))
+
+    def test_read_from_history_until_rebuilt(self):
+        expected = self.answers(self.db)
+        self.assertEqual(expected[0],[('Two','Artist','Two',3),('One','Artist','One',2)])
+
+        db = self.migrated_history()
+        try:
+            self.assertEqual(self.answers(db),expected)
+            with self.assertRaises(RuntimeError):
+                retention.purge(db,datetime.datetime(2017,1,1))
+
+            # A range doesn't count as filling them
+            db.rebuild_daily_plays('2017-01-01','2017-01-03',verbose=False)
+            self.assertTrue(db._rebuild_pending('daily_plays'))
+
+            self.assertEqual(db.rebuild_daily_plays(chunk_days=2,verbose=False),3)
+            self.assertFalse(db._rebuild_pending('daily_plays'))
+            self.assertEqual(self.answers(db),expected)
+        finally:
+            db.close()
+
+    def test_pending_is_checked_again_later(self):
+        db = self.migrated_history()
+        try:
+            with mock.patch.object(playlist_database,'monotonic',return_value=1000.0):
+                self.assertTrue(db._rebuild_pending('daily_plays'))
+
+            # Filled by daily_plays.py in another process
+            self.db.rebuild_daily_plays(verbose=False)
+            with mock.patch.object(playlist_database,'monotonic',return_value=1001.0):
+                self.assertTrue(db._rebuild_pending('daily_plays'))
+            with mock.patch.object(playlist_database,'monotonic',return_value=1000.0 + playlist_database.REBUILD_CHECK_INTERVAL):
+                self.assertFalse(db._rebuild_pending('daily_plays'))
+        finally:
+            db.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ignore_rules import IgnoreMatcher, StationIgnoreRules, check_rule, EXACT, CASEFOLD, REGEX, ARTIST, TITLE
+from PlaylistDatabase import PlaylistDatabase
+
+class IgnoreMatcherTest(unittest.TestCase):
+
+    def test_exact_and_casefold(self):
+        matcher = IgnoreMatcher([(EXACT,'Station ID'),(CASEFOLD,'commercial')])
+        self.assertTrue(matcher.matches('Station ID'))
+        self.assertFalse(matcher.matches('station id'))
+        self.assertTrue(matcher.matches('COMMERCIAL'))
+        self.assertFalse(matcher.matches(None))
+
+    def test_inline_flags(self):
+        # Each of these is a valid rule on its own
+        rules = [(REGEX,'(?i)commercial'),(REGEX,'(?i)station id')]
+        for match_type,pattern in rules:
+            check_rule(TITLE,match_type,pattern)
+        matcher = IgnoreMatcher(rules)
+        self.assertTrue(matcher.matches('A COMMERCIAL break'))
+        self.assertTrue(matcher.matches('Station ID'))
+        self.assertFalse(matcher.matches('A song'))
+
+    def test_backreferences(self):
+        matcher = IgnoreMatcher([(REGEX,'(a)x'),(REGEX,r'(b)\1')])
+        self.assertTrue(matcher.matches('bb'))
+        self.assertTrue(matcher.matches('ax'))
+        self.assertFalse(matcher.matches('ba'))
+
+    def test_duplicate_named_groups(self):
+        matcher = IgnoreMatcher([(REGEX,'(?P<x>ad)'),(REGEX,'(?P<x>promo)')])
+        self.assertTrue(matcher.matches('promo'))
+        self.assertTrue(matcher.matches('ad'))
+
+    def test_station_rules(self):
+        rules = StationIgnoreRules([(ARTIST,REGEX,'(?i)^dj '),(TITLE,EXACT,'News')])
+        self.assertTrue(rules.ignores('DJ Someone','A song'))
+        self.assertTrue(rules.ignores('Artist','News'))
+        self.assertFalse(rules.ignores('Artist','A song'))
+
+class StationIgnoreRulesDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = PlaylistDatabase(backend='sqlite',path=os.path.join(self.directory,'test.sqlite'),initialize=True)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def test_regex_rules_with_flags_and_backreferences(self):
+        self.db.create_station('A','a.site',[],[],'A.Playlist')
+        self.db.create_station('B','b.site',[],[],'B.Playlist')
+        self.db.add_station_ignore_rule('A','title','(?i)commercial',REGEX)
+        self.db.add_station_ignore_rule('A','title',r'(b)\1',REGEX)
+
+        # Every station still loads, not just the one with the rules
+        stations = dict((s['name'],s) for s in self.db.get_station_data())
+        self.assertEqual(set(stations),{'A','B'})
+        self.assertIn('A Commercial',stations['A']['ignoretitles'])
+        self.assertIn('bb',stations['A']['ignoretitles'])
+        self.assertNotIn('A Commercial',stations['B']['ignoretitles'])
+
+if __name__ == '__main__':
+    unittest.main()
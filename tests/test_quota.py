@@ -0,0 +1,48 @@
+import threading
+import unittest
+from time import sleep
+
+from quota import QuotaBudget, QuotaDeferred, HIGH
+
+# 12:00 UTC, well into the quota day
+NOON = 1483272000
+
+class QuotaBudgetTest(unittest.TestCase):
+
+    def test_call_checks_and_charges_together(self):
+        # Room for exactly 10 videos.list calls
+        budget = QuotaBudget(daily_units=10,reserve=0,now=NOON)
+        made = []
+
+        def check():
+            # Keep calls open so they overlap
+            sleep(0.001)
+            made.append(1)
+
+        def worker():
+            for ii in range(5):
+                try:
+                    budget.call('videos.list','A',HIGH,check,now=NOON)
+                except QuotaDeferred:
+                    pass
+
+        threads = [threading.Thread(target=worker) for ii in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        status = budget.status(now=NOON)
+        self.assertEqual(status['spent'],10)
+        self.assertEqual(len(made),10)
+        self.assertEqual(status['endpoints']['videos.list']['denied'],30)
+
+    def test_refused_call_not_charged(self):
+        budget = QuotaBudget(daily_units=150,reserve=0,now=NOON)
+        budget.call('search.list','A',HIGH,lambda: None,now=NOON)
+        with self.assertRaises(QuotaDeferred):
+            budget.call('search.list','A',HIGH,lambda: None,now=NOON)
+        self.assertEqual(budget.status(now=NOON)['spent'],100)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import threading
+import unittest
+
+from replicas import ReplicaSet
+
+class ReplicaSetTest(unittest.TestCase):
+
+    def test_round_robin_skips_lagging(self):
+        lags = {'a':0,'b':60,'c':1}
+        replicas = ReplicaSet(['a','b','c'],lambda host: host,lambda conn: lags[conn],max_lag=10)
+        self.assertEqual([replicas.pick() for ii in range(4)],['a','c','a','c'])
+        self.assertFalse(replicas.usable('b'))
+
+    def test_unreachable_out_of_rotation(self):
+        def connect(host):
+            raise OSError('no route to host')
+        replicas = ReplicaSet(['a'],connect,lambda conn: 0)
+        self.assertIsNone(replicas.pick())
+        self.assertFalse(replicas.stats()['replicas']['a']['in_rotation'])
+
+    def test_slow_check_does_not_block_others(self):
+        checking = threading.Event()
+        release = threading.Event()
+        def lag(conn):
+            if conn == 'slow':
+                checking.set()
+                release.wait(5)
+            return 0
+        replicas = ReplicaSet(['slow','fast'],lambda host: host,lag,check_interval=0)
+        thread = threading.Thread(target=replicas.usable,args=('slow',))
+        thread.start()
+        try:
+            self.assertTrue(checking.wait(5))
+            # Would wait on the lock if the slow check held it
+            self.assertTrue(replicas.usable('fast'))
+            self.assertEqual(replicas.pick(),'fast')
+        finally:
+            release.set()
+            thread.join()
+        self.assertTrue(replicas.usable('slow'))
+
+if __name__ == '__main__':
+    unittest.main()
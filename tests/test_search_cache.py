@@ -0,0 +1,88 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from PlaylistDatabase import PlaylistDatabase
+from quota import QuotaDeferred
+from search_cache import SearchCache, normalize_query
+from video_check import VideoChecker
+
+class NormalizeQueryTest(unittest.TestCase):
+
+    def test_same_search(self):
+        self.assertEqual(normalize_query('Beyoncé - Halo!'),normalize_query('beyonce halo'))
+        self.assertEqual(normalize_query('Simon & Garfunkel  The Boxer'),'simon and garfunkel the boxer')
+
+class SearchCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory,'test.sqlite')
+        self.db = PlaylistDatabase(backend='sqlite',path=self.path,initialize=True)
+        self.searches = []
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def search(self,query,max_results):
+        self.searches.append(query)
+        return ['aaaaaaaaaaa','bbbbbbbbbbb']
+
+    def hits_in_database(self,query):
+        other = PlaylistDatabase(backend='sqlite',path=self.path)
+        try:
+            other._cur.execute('''SELECT SearchCache.hits FROM SearchCache WHERE SearchCache.query = %s''',(query,))
+            row = other._cur.fetchone()
+            return None if row is None else row[0]
+        finally:
+            other.close()
+
+    def test_hit_after_first_search(self):
+        cache = SearchCache(self.search,self.db)
+        self.assertEqual(cache.get_most_viewed_link('Artist - Song!')[1],'aaaaaaaaaaa')
+        self.assertEqual(cache.get_most_viewed_link('artist song')[1],'aaaaaaaaaaa')
+        self.assertEqual(len(self.searches),1)
+        self.assertEqual(cache.stats()['hits'],1)
+        self.assertEqual(cache.stats()['quota_saved'],100)
+
+    def test_hits_written_by_evict(self):
+        cache = SearchCache(self.search,self.db)
+        cache.youtube_search('artist song')
+        cache.youtube_search('artist song')
+        cache.youtube_search('artist song')
+        self.assertEqual(self.hits_in_database('artist song'),0)
+        cache.evict()
+        self.assertEqual(self.hits_in_database('artist song'),2)
+
+    def test_lookup_does_not_commit(self):
+        cache = SearchCache(self.search,self.db)
+        cache.youtube_search('artist song')
+        # Something the caller hasn't committed yet
+        self.db.put_search_result('pending',['ccccccccccc'],commit=False)
+        cache.youtube_search('artist song')
+        self.assertIsNone(self.hits_in_database('pending'))
+        self.db._conn.commit()
+        self.assertEqual(self.hits_in_database('pending'),0)
+
+    def test_hit_when_check_deferred(self):
+        def check(video_ids):
+            raise QuotaDeferred('videos.list for None')
+        cache = SearchCache(self.search,self.db,video_checker=VideoChecker(check))
+        self.db.put_search_result('artist song',['aaaaaaaaaaa'])
+        self.assertEqual(cache.youtube_search('artist song'),['aaaaaaaaaaa'])
+        self.assertEqual(self.searches,[])
+        self.assertEqual(cache.stats()['hits'],1)
+
+    def test_evict_by_age_and_size(self):
+        for ii in range(5):
+            self.db.put_search_result('query %d'%(ii,),['aaaaaaaaaaa'])
+        cache = SearchCache(self.search,self.db,max_age=0)
+        self.assertEqual(cache.evict(),0)
+        self.db._cur.execute('''UPDATE SearchCache SET searched_at = '2000-01-01 00:00:00' WHERE query = %s''',('query 0',))
+        self.db._conn.commit()
+        self.assertEqual(cache.evict(),1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import shutil
+import datetime
+import tempfile
+import unittest
+
+from PlaylistDatabase import PlaylistDatabase
+
+class SongCacheTest(unittest.TestCase):
+    '''
+    The poller and the frontend are separate processes, each with its own
+    PlaylistDatabase and song cache
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory,'test.sqlite')
+        self.poller = PlaylistDatabase(backend='sqlite',path=path,initialize=True)
+        self.frontend = PlaylistDatabase(backend='sqlite',path=path)
+        self.poller.create_station('A','a.site',[],[],'A.Playlist')
+        self.poller.add_track_to_station_playlist('A','Artist','Album','Title',datetime.datetime(2017,1,1),
+                                                  'https://youtu.be/aaaaaaaaaaa')
+
+    def tearDown(self):
+        self.poller.close()
+        self.frontend.close()
+        shutil.rmtree(self.directory)
+
+    def test_use_cache_false_sees_other_process_changes(self):
+        self.assertEqual(self.poller.look_up_song_youtube('Artist','Album','Title'),'https://youtu.be/aaaaaaaaaaa')
+
+        # /replace
+        track_id = self.frontend.lookup_tracks_by_video('aaaaaaaaaaa')[0][0]
+        self.frontend.set_track_youtube_link(track_id,'https://youtu.be/bbbbbbbbbbb')
+
+        # The poller's cache hasn't heard about it
+        self.assertEqual(self.poller.look_up_song_youtube('Artist','Album','Title'),'https://youtu.be/aaaaaaaaaaa')
+        # but the database has, and the cache is refreshed from it
+        self.assertEqual(self.poller.look_up_song_youtube('Artist','Album','Title',use_cache=False),
+                         'https://youtu.be/bbbbbbbbbbb')
+        self.assertEqual(self.poller.look_up_song_youtube('Artist','Album','Title'),'https://youtu.be/bbbbbbbbbbb')
+
+    def test_stale_track_id_without_playlist_foreign_keys(self):
+        # A partitioned Playlist (retention.enable_partitioning) has no
+        # foreign keys to reject the poller's cached track ID
+        self.poller._backend.playlist_foreign_keys = False
+        self.poller._cur.execute('PRAGMA foreign_keys=OFF')
+
+        # RemoveBadVideo.py, say
+        self.frontend._cur.execute('DELETE FROM Playlist')
+        self.frontend._cur.execute('DELETE FROM Track')
+        self.frontend._conn.commit()
+
+        self.poller.add_track_to_station_playlist('A','Artist','Album','Title',datetime.datetime(2017,1,2),
+                                                  'https://youtu.be/aaaaaaaaaaa')
+        self.assertEqual([(t['name'],t['artist']) for t in self.frontend.get_latest_station_tracks('A',2)],
+                         [('Title','Artist')])
+
+if __name__ == '__main__':
+    unittest.main()
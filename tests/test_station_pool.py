@@ -0,0 +1,31 @@
+import unittest
+
+from station_pool import StationPoller
+
+class StationPollerTest(unittest.TestCase):
+
+    def collect_all(self,update):
+        poller = StationPoller(update,workers=2,timeout=10)
+        try:
+            for name in ('A','B'):
+                poller.submit({'name':name})
+            results = {}
+            while len(results) < 2:
+                results.update(poller.collect(timeout=1))
+            return results
+        finally:
+            poller.close()
+
+    def test_changed_without_adding(self):
+        # An ignored song: nothing added, but the station moved on
+        results = self.collect_all(lambda channel_dict: (False,channel_dict['name'] == 'A'))
+        self.assertEqual((results['A']['added'],results['A']['changed']),(False,True))
+        self.assertEqual((results['B']['added'],results['B']['changed']),(False,False))
+
+    def test_bool_means_both(self):
+        results = self.collect_all(lambda channel_dict: channel_dict['name'] == 'A')
+        self.assertEqual((results['A']['added'],results['A']['changed']),(True,True))
+        self.assertEqual((results['B']['added'],results['B']['changed']),(False,False))
+
+if __name__ == '__main__':
+    unittest.main()
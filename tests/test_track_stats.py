@@ -0,0 +1,69 @@
+import os
+import shutil
+import datetime
+import tempfile
+import unittest
+
+import migrations
+from PlaylistDatabase import PlaylistDatabase
+
+class TrackStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory,'test.sqlite')
+        self.db = PlaylistDatabase(backend='sqlite',path=self.path,initialize=True)
+        self.db.create_station('A','a.site',[],[],'A.Playlist')
+        self.db.create_station('B','b.site',[],[],'B.Playlist')
+        for station,day in (('A',1),('A',2),('B',3)):
+            self.db.add_track_to_station_playlist(station,'Artist','Album','Title',datetime.datetime(2017,1,day))
+        self.track_id = self.track()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def track(self):
+        self.db._cur.execute('''SELECT Track.id FROM Track''')
+        return self.db._cur.fetchone()[0]
+
+    def migrated_history(self):
+        '''
+        A database that had this history before the migration made the
+        (empty) tables
+        '''
+        cur = self.db._conn.cursor()
+        cur.execute('''DELETE FROM TrackStationStats''')
+        cur.execute('''DELETE FROM TrackStats''')
+        migrations.mark_rebuild_pending(cur,'track_stats','track_stats.py rebuild')
+        self.db._conn.commit()
+        return PlaylistDatabase(backend='sqlite',path=self.path)
+
+    def expected(self):
+        return {self.track_id:{'play_count':3,'last_play':datetime.datetime(2017,1,3),
+                               'stations':[('A',2,datetime.datetime(2017,1,2)),('B',1,datetime.datetime(2017,1,3))]}}
+
+    def test_kept_up_to_date(self):
+        self.assertEqual(self.db.get_track_stats([self.track_id]),self.expected())
+
+    def test_read_from_history_until_rebuilt(self):
+        db = self.migrated_history()
+        try:
+            self.assertEqual(db.get_track_stats([self.track_id]),self.expected())
+            # A play before the rebuild only makes it into TrackStats as one play
+            db.add_track_to_station_playlist('B','Artist','Album','Title',datetime.datetime(2017,1,4))
+            self.assertEqual(db.get_track_stats([self.track_id])[self.track_id]['play_count'],4)
+
+            db.rebuild_track_stats(chunk_size=1,verbose=False)
+            self.assertEqual(db.check_track_stats(),[])
+            self.assertEqual(db.get_track_stats([self.track_id])[self.track_id]['play_count'],4)
+        finally:
+            db.close()
+        db = PlaylistDatabase(backend='sqlite',path=self.path)
+        try:
+            self.assertFalse(db._rebuild_pending('track_stats'))
+        finally:
+            db.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import threading
+import unittest
+from unittest import mock
+
+from video_check import VideoChecker
+
+class StubCheck():
+    '''
+    check() for VideoChecker that records every call
+    '''
+
+    def __init__(self,valid=(),error=None):
+        self.valid = set(valid)
+        self.error = error
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self,video_ids):
+        with self._lock:
+            self.calls.append(list(video_ids))
+        if self.error is not None:
+            raise self.error
+        return [v for v in video_ids if v in self.valid]
+
+def ask_at_once(checker,video_ids):
+    '''
+    is_valid for every video on its own thread, all at the same time.
+    Returns video ID -> answer or the exception raised.
+    '''
+    start = threading.Barrier(len(video_ids))
+    answers = {}
+
+    def ask(video_id):
+        start.wait(5)
+        try:
+            answers[video_id] = checker.is_valid(video_id)
+        except Exception as e:
+            answers[video_id] = e
+
+    threads = [threading.Thread(target=ask,args=(v,)) for v in video_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return answers
+
+class VideoCheckerTest(unittest.TestCase):
+
+    def test_check_many_batches(self):
+        video_ids = ['v%03d'%(ii,) for ii in range(120)]
+        check = StubCheck(valid=video_ids[::2])
+        checker = VideoChecker(check)
+        valid = checker.check_many(video_ids)
+        self.assertEqual([len(call) for call in check.calls],[50,50,20])
+        self.assertEqual(sorted(v for v in valid if valid[v]),video_ids[::2])
+
+        # All cached now
+        checker.check_many(video_ids)
+        self.assertEqual(len(check.calls),3)
+
+    def test_waiters_share_a_call(self):
+        check = StubCheck(valid=['a','c'])
+        checker = VideoChecker(check,batch_size=4,max_wait=5)
+        answers = ask_at_once(checker,['a','b','c','d'])
+        self.assertEqual(answers,{'a':True,'b':False,'c':True,'d':False})
+        self.assertEqual(len(check.calls),1)
+        self.assertEqual(sorted(check.calls[0]),['a','b','c','d'])
+
+    def test_batch_size_caps_a_call(self):
+        check = StubCheck(valid=['a'])
+        checker = VideoChecker(check,batch_size=2,max_wait=0.05)
+        answers = ask_at_once(checker,['a','b','c','d','e'])
+        self.assertEqual(answers,{'a':True,'b':False,'c':False,'d':False,'e':False})
+        self.assertTrue(all(len(call) <= 2 for call in check.calls))
+        self.assertEqual(sorted(v for call in check.calls for v in call),['a','b','c','d','e'])
+
+    def test_error_reaches_every_waiter(self):
+        check = StubCheck(error=ValueError('youtube is down'))
+        checker = VideoChecker(check,batch_size=3,max_wait=5)
+        answers = ask_at_once(checker,['a','b','c'])
+        self.assertEqual(len(check.calls),1)
+        for video_id in 'abc':
+            self.assertIsInstance(answers[video_id],ValueError)
+
+        # Nothing was cached, so the next question asks again
+        check.error = None
+        checker.max_wait = 0
+        self.assertFalse(checker.is_valid('a'))
+        self.assertEqual(len(check.calls),2)
+
+    def test_invalid_answers_expire_sooner(self):
+        now = [1000.0]
+        check = StubCheck(valid=['up'])
+        checker = VideoChecker(check,ttl=100,invalid_ttl=10)
+        with mock.patch('cache.monotonic',lambda: now[0]):
+            self.assertEqual(checker.check_many(['up','gone']),{'up':True,'gone':False})
+
+            now[0] += 11
+            self.assertEqual(checker.check_many(['up','gone']),{'up':True,'gone':False})
+            self.assertEqual(check.calls[-1],['gone'])
+
+            now[0] += 90
+            checker.check_many(['up','gone'])
+            self.assertEqual(sorted(check.calls[-1]),['gone','up'])
+        self.assertEqual(len(check.calls),3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+#
+# Maintenance for TrackStats and TrackStationStats, the per track play
+# counts and last play times PlaylistDatabase keeps as plays are added.
+#
+# rebuild works them all out again from the playlist history, a chunk
+# of track IDs at a time with a commit after each chunk. check compares
+# them with the history and prints anything that doesn't agree (--fix
+# works those tracks out again).
+#
+# The migration that adds the tables leaves them empty, so run rebuild
+# once after it on a database that already has history. Until then
+# track pages work the stats out from the history.
+#
+#   python3 track_stats.py --config PlaylistDatabaseConfig.ini check
+#   python3 track_stats.py --config PlaylistDatabaseConfig.ini rebuild
+#
+
+import sys
+import argparse
+
+from PlaylistDatabase import PlaylistDatabase
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild or check the per track play statistics')
+    parser.add_argument('action',choices=['rebuild','check'])
+    parser.add_argument('--config',help='Config file with the [database] credentials',default='PlaylistDatabaseConfig.ini')
+    parser.add_argument('--chunk-size',type=int,default=10000,help='Track IDs per transaction')
+    parser.add_argument('--fix',action='store_true',help='With check, work out the stats of wrong tracks again')
+    args = parser.parse_args()
+
+    db = PlaylistDatabase(config_file=args.config)
+    if args.action == 'rebuild':
+        played = db.rebuild_track_stats(args.chunk_size)
+        print('Done. %d tracks have been played.'%(played,))
+    else:
+        problems = db.check_track_stats(args.chunk_size,fix=args.fix)
+        for p in problems:
+            print(p)
+        if not problems:
+            print('TrackStats agrees with the playlist history.')
+        elif args.fix:
+            print('Fixed %d problems.'%(len(problems),))
+        db.close()
+        sys.exit(1 if problems and not args.fix else 0)
+    db.close()
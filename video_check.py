@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+from time import monotonic
+from threading import Lock, Event, Thread
+from traceback import print_exc
+
+from cache import LRUCache
+
+class VideoChecker():
+    '''
+    Answers "has this youtube video been taken down?" without an API
+    call per question.
+
+    check(ids) returns the set of ids that still exist, as one call no
+    matter how many ids it's given (YoutubeSearcher.valid_videos does
+    this 50 at a time). Answers are cached for ttl seconds, and videos
+    that are gone for invalid_ttl, since we'd rather notice a video that
+    came back than keep re-searching for one that didn't.
+
+    Threads that ask about uncached videos at the same time share a
+    call: the first one waits up to max_wait seconds for others (or for
+    batch_size ids), then asks for all of them.
+
+    sweep() re-checks every video in the catalog batch_size at a time so
+    the cache is warm for the songs the stations play again.
+    '''
+
+    def __init__(self,check,ttl=2*86400,invalid_ttl=3600,batch_size=50,max_wait=0.25,max_size=200000):
+        self._check = check
+        self.ttl = ttl
+        self.invalid_ttl = invalid_ttl
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._cache = LRUCache(max_size,ttl)
+
+        # The batch that's still taking ids, or None
+        self._batch = None
+        self._lock = Lock()
+
+        self._sweeper = None
+        self._stop = Event()
+
+        self.calls = 0
+        self.videos_checked = 0
+        self.invalid = 0
+        self.sweeps = 0
+
+    def _remember(self,video_ids,valid):
+        for video_id in video_ids:
+            if video_id in valid:
+                self._cache.put(video_id,True)
+            else:
+                self._cache.put(video_id,False,self.invalid_ttl)
+                self.invalid += 1
+
+    def _call(self,video_ids):
+        valid = set(self._check(video_ids))
+        with self._lock:
+            self.calls += 1
+            self.videos_checked += len(video_ids)
+        self._remember(video_ids,valid)
+        return valid
+
+    def is_valid(self,video_id):
+        '''
+        True if the video is still up. Raises whatever check() raised if
+        the call for it failed.
+        '''
+        cached = self._cache.get(video_id)
+        if cached is not None:
+            return cached
+
+        with self._lock:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = {'ids':[],'full':Event(),'done':Event(),'valid':None,'error':None}
+            if video_id not in batch['ids']:
+                batch['ids'].append(video_id)
+            if len(batch['ids']) >= self.batch_size:
+                # Anyone after this starts a new one
+                self._batch = None
+                batch['full'].set()
+
+        if leader:
+            batch['full'].wait(self.max_wait)
+            with self._lock:
+                if self._batch is batch:
+                    self._batch = None
+            try:
+                batch['valid'] = self._call(batch['ids'])
+            except Exception as e:
+                batch['error'] = e
+            finally:
+                batch['done'].set()
+        else:
+            batch['done'].wait()
+
+        if batch['error'] is not None:
+            raise batch['error']
+        return video_id in batch['valid']
+
+    def check_many(self,video_ids,refresh=False):
+        '''
+        Video ID -> True if it's still up, for a lot of videos at once.
+        Cached answers are used unless refresh is True.
+        '''
+        results = {}
+        todo = []
+        for video_id in dict.fromkeys(video_ids):
+            cached = None if refresh else self._cache.get(video_id)
+            if cached is None:
+                todo.append(video_id)
+            else:
+                results[video_id] = cached
+        for ii in range(0,len(todo),self.batch_size):
+            chunk = todo[ii:ii+self.batch_size]
+            valid = self._call(chunk)
+            for video_id in chunk:
+                results[video_id] = video_id in valid
+        return results
+
+    def invalidate(self,video_id):
+        '''
+        Forget what we know about a video, for when a track's link changes
+        '''
+        self._cache.invalidate(video_id)
+
+    def sweep(self,get_video_ids,pause=1.0,verbose=True):
+        '''
+        Re-check every video in the catalog. get_video_ids(after_id,limit)
+        is PlaylistDatabase.get_video_ids or something like it. Returns
+        [(track id, video ID)] for the videos that are gone.
+        '''
+        t0 = monotonic()
+        last_id = 0
+        seen = 0
+        gone = []
+        while not self._stop.is_set():
+            rows = get_video_ids(last_id,self.batch_size)
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            seen += len(rows)
+            valid = self.check_many([video_id for track_id,video_id in rows],refresh=True)
+            gone.extend((track_id,video_id) for track_id,video_id in rows if not valid[video_id])
+            # Leave some quota (and database) for the stations
+            if pause:
+                self._stop.wait(pause)
+
+        self.sweeps += 1
+        if verbose:
+            print('Video sweep: %d videos checked, %d gone, %.0f seconds'%(seen,len(gone),monotonic()-t0))
+            for track_id,video_id in gone:
+                print('Video sweep: track %d video %s has been taken down'%(track_id,video_id))
+        return gone
+
+    def start_sweeping(self,get_video_ids,interval=86400,pause=1.0):
+        '''
+        Sweep on a background thread every interval seconds (counted from
+        the start of one sweep to the next) until stop()
+        '''
+        def run():
+            while not self._stop.is_set():
+                started = monotonic()
+                try:
+                    self.sweep(get_video_ids,pause)
+                except Exception:
+                    # Try again next time
+                    print_exc()
+                    print('Got exception sweeping videos')
+                self._stop.wait(max(0,interval - (monotonic()-started)))
+
+        self._sweeper = Thread(target=run,name='video-sweep',daemon=True)
+        self._sweeper.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        stats = self._cache.stats()
+        stats.update({
+            'api_calls':self.calls,
+            'videos_checked':self.videos_checked,
+            'videos_per_call':(self.videos_checked/self.calls) if self.calls else 0.0,
+            'invalid':self.invalid,
+            'sweeps':self.sweeps,
+        })
+        return stats
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+#
+# Synthetic stations, tracks, and play history for benchmarks.
+#
+# Everything comes from one random.Random(seed), so the same settings
+# always make the same workload and results can be compared between
+# commits. Track popularity follows a Zipf distribution (a few songs
+# are on every station all day, most are rarely played) and every
+# station plays a song every few minutes for the whole history.
+#
+
+import random
+import datetime
+import itertools
+from bisect import bisect
+
+# Made up words for artist, album, and track names
+SYLLABLES = ('ka','lo','mi','ra','ven','tor','sa','del','mon','ri','sha','el','an','tu','bel','cor',
+             'di','fa','gan','ho','jo','lu','mar','ne','os','pe','qui','ro','sil','ta','ul','vi',
+             'wen','xa','yo','zer','bri','cla','dra','fle')
+
+# name: (stations, tracks, days, plays per station per day)
+SCALES = {
+    'tiny':(20,2000,3,48),
+    'small':(200,20000,14,96),
+    'medium':(2000,100000,60,96),
+    'large':(5000,500000,180,360),
+}
+
+class Workload():
+    '''
+    A reproducible catalog of tracks and the plays of every station.
+    plays() is a generator, so large histories are never held in memory.
+    '''
+
+    def __init__(self,stations=200,tracks=20000,days=14,plays_per_day=96,zipf_s=1.1,
+                 tracks_per_album=10,albums_per_artist=3,seed=1,start=None):
+        self.num_stations = stations
+        self.num_tracks = tracks
+        self.days = days
+        self.plays_per_day = plays_per_day
+        self.zipf_s = zipf_s
+        self.tracks_per_album = tracks_per_album
+        self.albums_per_artist = albums_per_artist
+        self.seed = seed
+        self.start = start if start is not None else datetime.datetime(2017,1,1)
+
+        self._names = {}
+
+        # Popularity rank r is played with weight 1/r^s
+        self._cum_weights = list(itertools.accumulate(1/(rank**zipf_s) for rank in range(1,tracks+1)))
+
+    @classmethod
+    def scale(cls,name,**kwargs):
+        stations,tracks,days,plays_per_day = SCALES[name]
+        return cls(stations,tracks,days,plays_per_day,**kwargs)
+
+    def params(self):
+        '''
+        Everything that decides the workload, for the results file
+        '''
+        return {
+            'stations':self.num_stations,
+            'tracks':self.num_tracks,
+            'days':self.days,
+            'plays_per_day':self.plays_per_day,
+            'zipf_s':self.zipf_s,
+            'seed':self.seed,
+            'total_plays':self.total_plays(),
+        }
+
+    def total_plays(self):
+        return self.num_stations*self.days*self.plays_per_day
+
+    def station_names(self):
+        return ['Station %05d'%(ii,) for ii in range(self.num_stations)]
+
+    def _name(self,kind,number,max_words):
+        '''
+        A made up name of one to max_words words. Always the same for
+        the same kind, number, and seed.
+        '''
+        key = (kind,number)
+        name = self._names.get(key)
+        if name is None:
+            rng = random.Random('%s %d %d'%(kind,self.seed,number))
+            name = ' '.join(''.join(rng.choice(SYLLABLES) for s in range(rng.randint(2,3))).capitalize()
+                            for w in range(rng.randint(1,max_words)))
+            self._names[key] = name
+        return name
+
+    def track(self,rank):
+        '''
+        (artist, album, title, youtube link) of the track with this
+        popularity rank (0 is the most played)
+        '''
+        album = rank // self.tracks_per_album
+        artist = album // self.albums_per_artist
+        return (self._name('artist',artist,2),self._name('album',album,3),self._name('track',rank,4),
+                'https://youtu.be/' + ('v%010d'%(rank,)))
+
+    def random_ranks(self,rng,count):
+        '''
+        count Zipf distributed popularity ranks
+        '''
+        total = self._cum_weights[-1]
+        return [min(bisect(self._cum_weights,rng.random()*total),self.num_tracks-1) for ii in range(count)]
+
+    def popular_tracks(self,count,seed_offset=0):
+        '''
+        count tracks picked the way plays are, for lookups
+        '''
+        rng = random.Random(self.seed+1000+seed_offset)
+        return [self.track(rank) for rank in self.random_ranks(rng,count)]
+
+    def plays(self):
+        '''
+        Yield (station, artist, album, title, play time, youtube link) in
+        time order, day by day, the way the poller would have added them
+        '''
+        rng = random.Random(self.seed)
+        stations = self.station_names()
+        gap = 86400/self.plays_per_day
+        for day in range(self.days):
+            day_start = self.start + datetime.timedelta(days=day)
+            for slot in range(self.plays_per_day):
+                ranks = self.random_ranks(rng,len(stations))
+                for station_index,(station,rank) in enumerate(zip(stations,ranks)):
+                    # Stations don't all change songs at the same second
+                    seconds = slot*gap + (station_index*7919) % gap
+                    artist,album,title,link = self.track(rank)
+                    yield (station,artist,album,title,day_start+datetime.timedelta(seconds=seconds),link)
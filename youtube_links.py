@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+#
+# The one place that knows how to pull a video ID out of the different
+# kinds of youtube links we get (from the API, from people pasting
+# into the frontend, from old rows in the database).
+#
+
+import re
+
+SHORT_LINK = 'https://youtu.be/'
+
+# Youtube video IDs are always 11 of these
+VIDEO_ID_RE = re.compile(r'^[A-Za-z0-9_-]{11}$')
+
+_LINK_PATTERNS = [
+    re.compile(r'youtu\.be/([A-Za-z0-9_-]{11})'),
+    re.compile(r'[?&]v=([A-Za-z0-9_-]{11})'),
+    re.compile(r'youtube\.com/(?:embed|v|shorts)/([A-Za-z0-9_-]{11})'),
+]
+
+def get_youtube_id(video):
+    '''
+    Given a youtube link (short, long, embed...) or a bare ID, return the ID.
+    Anything we don't recognize gets the query string stripped and is
+    returned as-is.
+    '''
+    video = video.strip()
+
+    for pattern in _LINK_PATTERNS:
+        match = pattern.search(video)
+        if match is not None:
+            return match.group(1)
+
+    # Strip anything leading up to the ID
+    video = video.split('://youtu.be/')[-1]
+    video = video.split('youtube.com/watch?v=')[-1]
+
+    # Try to strip any requests
+    if '?' in video:
+        video = video[0:video.find('?')]
+    # Strip more junk (playlists)
+    if '&' in video:
+        video = video[0:video.find('&')]
+
+    return video
+
+def get_video_id(video):
+    '''
+    Like get_youtube_id but returns None unless the result is a real
+    11 character video ID. This is what goes in Track.video_id.
+    '''
+    if not video:
+        return None
+    video = get_youtube_id(video)
+    if VIDEO_ID_RE.match(video) is None:
+        return None
+    return video
+
+def make_short_link(video):
+    '''
+    The https://youtu.be/ID link we store for a video. Links we can't
+    find an ID in are left alone, other than shortening a watch?v= link.
+    '''
+    video_id = get_video_id(video)
+    if video_id is None:
+        return video.replace('https://www.youtube.com/watch?v=',SHORT_LINK)
+    return SHORT_LINK + video_id
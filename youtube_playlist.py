@@ -47,7 +47,9 @@ class YoutubePlaylist():
   YOUTUBE_API_SERVICE_NAME = "youtube"
   YOUTUBE_API_VERSION = "v3"
   
-  def __init__(self):
+  def __init__(self,timeout=None):
+    # timeout is seconds before a request to the API gives up (None
+    # waits forever)
     flow = flow_from_clientsecrets(self.CLIENT_SECRETS_FILE,
       message=self.MISSING_CLIENT_SECRETS_MESSAGE,
       scope=self.YOUTUBE_READ_WRITE_SCOPE)
@@ -60,7 +62,7 @@ class YoutubePlaylist():
       credentials = run_flow(flow, storage, flags)
 
     self.youtube = build(self.YOUTUBE_API_SERVICE_NAME, self.YOUTUBE_API_VERSION,
-      http=credentials.authorize(httplib2.Http()))
+      http=credentials.authorize(httplib2.Http(timeout=timeout)))
 
   def create_playlist(self,title):
     # This code creates a new, private playlist in the authorized user's channel.
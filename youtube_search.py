@@ -48,7 +48,9 @@ class YoutubeSearcher():
   YOUTUBE_API_SERVICE_NAME = "youtube"
   YOUTUBE_API_VERSION = "v3"
   
-  def __init__(self):
+  def __init__(self,timeout=None):
+    # timeout is seconds before a request to the API gives up (None
+    # waits forever)
     flow = flow_from_clientsecrets(self.CLIENT_SECRETS_FILE,
       message=self.MISSING_CLIENT_SECRETS_MESSAGE,
       scope=self.YOUTUBE_READ_WRITE_SCOPE)
@@ -61,7 +63,7 @@ class YoutubeSearcher():
       credentials = run_flow(flow, storage, flags)
 
     self.youtube = build(self.YOUTUBE_API_SERVICE_NAME, self.YOUTUBE_API_VERSION,
-      http=credentials.authorize(httplib2.Http()))
+      http=credentials.authorize(httplib2.Http(timeout=timeout)))
 
   def get_most_viewed_link(self,query,max_results=5):
     videos = self.youtube_search(query,max_results)
@@ -94,17 +96,30 @@ class YoutubeSearcher():
     #print("Videos:\n", "\n".join(videos), "\n")
     return videos
 
+  # videos.list takes up to this many IDs at once
+  MAX_VIDEO_IDS = 50
+
   def is_video_valid(self,video_id):
     # Check if a video is still valid.
     # (make sure it hasn't been deleted)
-
-    # The part is "id" because it has a quota cost of 0
-    search_response = self.youtube.videos().list(
-      id=video_id,
-      part="id"
-    ).execute()
-
-    return search_response['pageInfo']['totalResults'] > 0
+    return video_id in self.valid_videos([video_id])
+
+  def valid_videos(self,video_ids):
+    # Which of these videos still exist, as a set. One call per 50 of
+    # them, which costs the same quota as checking one.
+    video_ids = list(video_ids)
+    valid = set()
+    for ii in range(0,len(video_ids),self.MAX_VIDEO_IDS):
+      # The part is "id" because it has a quota cost of 0
+      search_response = self.youtube.videos().list(
+        id=','.join(video_ids[ii:ii+self.MAX_VIDEO_IDS]),
+        part="id",
+        maxResults=self.MAX_VIDEO_IDS
+      ).execute()
+
+      for video in search_response.get("items", []):
+        valid.add(video["id"])
+    return valid
 
 if __name__ == "__main__":
   argparser.add_argument("--q", help="Search term", default="Google")